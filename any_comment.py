@@ -2,7 +2,8 @@ import os
 
 from flask import Flask
 
-from app.blueprints import comments, doc, posts, users, root, streams
+from app.blueprints import comments, doc, posts, users, root, streams, exports, feeds
+from app.common import warm_authors
 
 
 def create_app():
@@ -14,8 +15,11 @@ def create_app():
     app.register_blueprint(posts, url_prefix=app.config['PREFIX'])
     app.register_blueprint(comments, url_prefix=app.config['PREFIX'])
     app.register_blueprint(streams, url_prefix=app.config['PREFIX'])
+    app.register_blueprint(exports, url_prefix=app.config['PREFIX'])
+    app.register_blueprint(feeds, url_prefix=app.config['PREFIX'])
     if app.config.get('DEVELOPMENT', False):
         app.register_blueprint(doc)
+    app.before_first_request(warm_authors)
 
     return app
 
@@ -0,0 +1,125 @@
+"""Кэш имён пользователей в памяти процесса."""
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, List, Tuple
+
+USERS_KEY = 'version:users'
+"""Общая версия пользователей: имена авторов встраиваются в комментарии, поэтому их смена меняет все ETag с ними."""
+
+
+def fetch_names(conn, user_ids: Optional[List[int]] = None, limit: Optional[int] = None) -> List[Tuple[int, str]]:
+    """
+    Имена пользователей из базы данных.
+
+    :param conn: Psycopg2 соединение
+    :param list user_ids: Идентификаторы пользователей, None — все пользователи
+    :param int limit: Максимальное количество записей, по умолчанию не ограничено
+    :return: Список пар (идентификатор, имя)
+    :rtype: list
+    """
+    cur = conn.cursor()
+    if user_ids is None:
+        cur.execute("SELECT userid, name FROM users ORDER BY userid LIMIT %s;", [limit])
+    else:
+        cur.execute("SELECT userid, name FROM users WHERE userid = ANY(%s) LIMIT %s;", [user_ids, limit])
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+
+class AuthorCache:
+    """
+    Ограниченный (LRU) кэш имён пользователей.
+
+    Пользователей много меньше, чем комментариев, а имена меняются редко, поэтому запросы комментариев читают только
+    таблицу ``comments``, а имена авторов подставляются из кэша. Содержимое действительно для одной версии
+    пользователей (:data:`USERS_KEY` в Redis, её увеличивают изменение и удаление пользователя): при смене версии кэш
+    очищается, поэтому изменения, сделанные другими процессами, видны сразу.
+    """
+
+    def __init__(self, size: int = 10000):
+        self.size = size
+        self.version = None
+        self._names = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._names
+
+    def _store(self, rows: Iterable[Tuple[int, str]], version: bytes) -> None:
+        with self._lock:
+            if version != self.version:
+                # Пока шёл запрос, версия сменилась — прочитанные имена могут быть уже устаревшими
+                return
+            for user_id, name in rows:
+                self._names[user_id] = name
+                self._names.move_to_end(user_id)
+            while len(self._names) > self.size:
+                self._names.popitem(last=False)
+
+    def _validate(self, version: bytes) -> None:
+        if version != self.version:
+            self._names.clear()
+            self.version = version
+
+    def names(self, conn, user_ids: Iterable[int], version: Optional[bytes]) -> Dict[int, Optional[str]]:
+        """
+        Имена пользователей: из кэша, а недостающие — одним запросом к базе данных.
+
+        :param conn: Psycopg2 соединение
+        :param user_ids: Идентификаторы пользователей
+        :param bytes version: Текущая версия пользователей; None — кэш не используется (нет доступа к Redis)
+        :return: Словарь идентификатор → имя, None для не найденных пользователей
+        :rtype: dict
+        """
+        user_ids = set(user_ids)
+        if version is None:
+            found = dict(fetch_names(conn, list(user_ids)))
+            return {x: found.get(x) for x in user_ids}
+        found = {}
+        with self._lock:
+            self._validate(version)
+            for user_id in user_ids:
+                if user_id in self._names:
+                    found[user_id] = self._names[user_id]
+                    self._names.move_to_end(user_id)
+        missing = [x for x in user_ids if x not in found]
+        if missing:
+            rows = fetch_names(conn, missing)
+            self._store(rows, version)
+            found.update(rows)
+        return {x: found.get(x) for x in user_ids}
+
+    def warm(self, conn, version: bytes) -> int:
+        """
+        Предварительное заполнение кэша (не более ``size`` пользователей).
+
+        :param conn: Psycopg2 соединение
+        :param bytes version: Текущая версия пользователей
+        :return: Количество имён в кэше
+        :rtype: int
+        """
+        rows = fetch_names(conn, limit=self.size)
+        with self._lock:
+            self._validate(version)
+        self._store(rows, version)
+        return len(self)
+
+    def invalidate(self, user_id: Optional[int] = None) -> None:
+        """
+        Удаление имени пользователя из кэша этого процесса, не дожидаясь смены версии.
+
+        :param int user_id: Идентификатор пользователя, None — очистить весь кэш
+        """
+        with self._lock:
+            if user_id is None:
+                self._names.clear()
+            else:
+                self._names.pop(user_id, None)
+
+
+authors = AuthorCache()
+"""Кэш имён пользователей процесса."""
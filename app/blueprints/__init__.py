@@ -1,6 +1,8 @@
 from .comments import comments
 from .doc import doc
 from .event_streams import streams
+from .exports import exports
+from .feed import feeds
 from .posts import posts
 from .root import root
 from .users import users
@@ -5,23 +5,27 @@ from typing import Dict, Any, List, Optional
 import dateutil.parser
 import flask
 from dateutil.tz import tzlocal
-from flask import Blueprint, stream_with_context, Response, redirect, url_for
+from flask import Blueprint, redirect, url_for
 
 from app.blueprints.doc import auto
+from app.cache import conditional, cached_page
 from app.comments import get_comments, get_comment, remove_comment, new_comment, update_comment, first_level_comments, \
-    descendants
-from app.common import db_conn, resp, affected_num_to_code, pagination, DatabaseException, to_json_stream, \
-    AttachmentManager, date_filter
-from app.types import Comment
+    descendants, history, history_stream, thread, get_comments_by_ids, search, stats
+from app.common import db_conn, resp, ids_filter, affected_num_to_code, pagination, DatabaseException, to_json_stream, \
+    AttachmentManager, date_filter, fields_filter, stream_response, tree_limits, replies_limit, activity_interval
+from app.exports import export_response
+from app.posts import get_post
+from app.types import Comment, ENTITY_TYPE
 
 comments = Blueprint('comments', __name__)
 
 
-def comment_validate(data: Optional[Dict[str, Any]] = None) -> (Dict[str, Any], List[str]):
+def comment_validate(data: Optional[Dict[str, Any]] = None, partial: bool = False) -> (Dict[str, Any], List[str]):
     """
     Валидация данных о Комментарии.
 
     :param dict data: (Опционально) Готовый словарь данных для проверки на валидность
+    :param bool partial: Проверять только присутствующие поля (например, при изменении комментария)
     :return: Данные комментария, Найденные ошибки
     :rtype: tuple
     """
@@ -34,7 +38,8 @@ def comment_validate(data: Optional[Dict[str, Any]] = None) -> (Dict[str, Any],
     for field_name in Comment.data_fields:
         val = data.get(field_name)
         if val is None:
-            errors.append("Отсутствует поле '%s'" % field_name)
+            if not partial or field_name in data:
+                errors.append("Отсутствует поле '%s'" % field_name)
             continue
         if field_name in ['text'] and not isinstance(val, str):
             errors.append("Поле '%s' не является строкой" % field_name)
@@ -51,10 +56,26 @@ def comments_list():
 
     Поддерживается пагинация :func:`app.common.pagination`.
 
+    Если задан параметр ``ids`` (:func:`app.common.ids_filter`), то выдаются только запрошенные записи в порядке
+    запроса, а на месте не найденных — null.
+
+    Состав полей страницы комментариев задаётся проекцией :func:`app.common.fields_filter`.
+
     :return: Список всех комментариев
     """
+    ids, errors = ids_filter()
+    if errors:
+        return resp(400, {'errors': errors})
+    if ids is not None:
+        records = get_comments_by_ids(db_conn(), ids)
+        errors = [{'error': 'Комментарий не найден', 'comment_id': x} for x, rec in zip(ids, records) if rec is None]
+        return resp(200, {'response': records, 'total': len(records) - len(errors), 'errors': errors})
+
+    fields, errors = fields_filter()
+    if errors:
+        return resp(400, {'errors': errors})
     offset, per_page = pagination()
-    total, records = get_comments(db_conn(), offset=offset, limit=per_page)
+    total, records = get_comments(db_conn(), offset=offset, limit=per_page, fields=fields)
     return resp(200, {'response': records, 'total': total, 'pages': int(total / per_page) + 1})
 
 
@@ -84,8 +105,63 @@ def post_comment():
     return redirect(url_for('comments.comment', comment_id=record[0]), code=302)
 
 
+@comments.route('/comments/search', methods=['GET'])
+@auto.doc(groups=['comments'])
+def search_comments():
+    """
+    Полнотекстовый поиск по тексту комментариев к посту либо комментариев пользователя.
+
+    Параметры:
+        - q (str) — Поисковый запрос: слова, ``"фразы"``, ``or``, ``-исключения``. Обязательный.
+        - post_id (int) — Искать среди всех комментариев к посту.
+        - user_id (int) — Искать среди комментариев пользователя.
+        - cursor (str) — Курсор следующей страницы из поля *next* предыдущего ответа.
+
+    Должен быть задан хотя бы один из параметров ``post_id``, ``user_id``. Поддерживается фильтрация по дате создания
+    комментария :func:`app.common.date_filter`, размер страницы задаётся параметром ``per_page``
+    :func:`app.common.pagination`.
+
+    :return: Список найденных комментариев по убыванию релевантности и Курсор следующей страницы
+    """
+    args = flask.request.args.to_dict()
+    query = args.get('q', '').strip()
+    if not query:
+        return resp(400, {'errors': [{'error': 'Не задан поисковый запрос', 'q': query}]})
+    after, before, errors = date_filter()
+    if errors:
+        return resp(404, {'errors': errors})
+    scope = {}
+    for name in ['post_id', 'user_id']:
+        value = args.get(name, None)
+        if value is None or value == '':
+            continue
+        try:
+            scope[name] = int(value)
+        except ValueError:
+            errors.append({'error': 'Ожидалось целое число', name: value})
+    if errors:
+        return resp(400, {'errors': errors})
+    if not scope:
+        return resp(400, {'errors': [{'error': 'Не задана область поиска: post_id или user_id'}]})
+
+    entity_id = None
+    if 'post_id' in scope:
+        post = get_post(db_conn(), scope['post_id'])
+        if post is None:
+            return resp(404, {'errors': [{'error': 'Пост не найден', 'post_id': scope['post_id']}]})
+        entity_id = post['entityid']
+    _, per_page = pagination()
+    try:
+        records, next_cursor = search(db_conn(), query, entity_id, scope.get('user_id'), after, before,
+                                      args.get('cursor') or None, per_page)
+    except ValueError:
+        return resp(400, {'errors': [{'error': 'Не удалось распознать курсор', 'cursor': args.get('cursor')}]})
+    return resp(200, {'response': records, 'next': next_cursor})
+
+
 @comments.route('/comments/<int:comment_id>', methods=['GET'])
 @auto.doc(groups=['comments'])
+@conditional(ENTITY_TYPE.comment, users=True)
 def comment(comment_id: int):
     """
     Получить информацию о Комментарии.
@@ -106,19 +182,13 @@ def put_comment(comment_id: int):
     """
     Изменить информацию в Комментарии.
 
+    Изменяются только переданные поля. Если комментарий не найден, удалён либо данные не отличаются от текущих —
+    возвращается статус 404.
+
     :param int comment_id: Идентификатор комментария
     :return: Пустой словарь {} при успехе, иначе Возникшие ошибки
     """
-    record = get_comment(db_conn(), comment_id)
-    if record is None:
-        return resp(404, {"errors": [{"error": "Комментарий не найден", "comment_id": comment_id}]})
-    record['userid'] = record['author']['userid']
-    data = flask.request.get_json()
-    for x in Comment.data_fields:
-        if x not in data:
-            data[x] = record[x]
-
-    (data, errors) = comment_validate(data)
+    (data, errors) = comment_validate(partial=True)
     if errors:
         return resp(400, {"errors": errors})
 
@@ -149,6 +219,8 @@ def delete_comment(comment_id: int):
 
 @comments.route('/comments/<int:comment_id>/first_level', methods=['GET'])
 @auto.doc(groups=['comments'])
+@conditional(ENTITY_TYPE.comment, users=True)
+@cached_page(ENTITY_TYPE.comment, users=True)
 def get_first_level_comments(comment_id: int):
     """
     Показать комментарии первого уровня вложенности к указанному комментарию в порядке возрастания даты создания
@@ -156,19 +228,80 @@ def get_first_level_comments(comment_id: int):
 
     Поддерживается пагинация :func:`app.common.pagination`.
 
+    Состав полей комментариев задаётся проекцией :func:`app.common.fields_filter`.
+
     :param int comment_id: Идентификатор родительского комментария
     :return: Список комментарии первого уровня вложенности
     """
+    fields, errors = fields_filter()
+    if errors:
+        return resp(400, {'errors': errors})
     record = get_comment(db_conn(), comment_id)
     if record is None:
         errors = [{'error': 'Родительский комментарий не найден', 'comment_id': comment_id}]
         return resp(404, {'errors': errors})
 
     offset, per_page = pagination()
-    total, records = first_level_comments(db_conn(), comment_id, offset=offset, limit=per_page)
+    total, records = first_level_comments(db_conn(), comment_id, offset=offset, limit=per_page, fields=fields)
     return resp(200, {'response': records, 'total': total, 'pages': int(total / per_page) + 1})
 
 
+@comments.route('/comments/<int:comment_id>/thread', methods=['GET'])
+@auto.doc(groups=['comments'])
+@conditional(ENTITY_TYPE.comment, users=True, thread=True)
+@cached_page(ENTITY_TYPE.comment, users=True, thread=True, params=['replies'])
+def get_thread(comment_id: int):
+    """
+    Страница обсуждения: комментарии первого уровня к указанному комментарию, каждый с первыми ответами и общим
+    количеством ответов.
+
+    Поддерживается пагинация :func:`app.common.pagination`, количество ответов задаётся
+    :func:`app.common.replies_limit`.
+
+    :param int comment_id: Идентификатор родительского комментария
+    :return: Список комментариев первого уровня вложенности с ответами
+    """
+    replies, errors = replies_limit()
+    if errors:
+        return resp(400, {'errors': errors})
+    record = get_comment(db_conn(), comment_id)
+    if record is None:
+        errors = [{'error': 'Родительский комментарий не найден', 'comment_id': comment_id}]
+        return resp(404, {'errors': errors})
+
+    offset, per_page = pagination()
+    total, records = thread(db_conn(), comment_id, offset=offset, limit=per_page, replies=replies)
+    return resp(200, {'response': records, 'total': total, 'pages': int(total / per_page) + 1})
+
+
+@comments.route('/comments/<int:comment_id>/stats', methods=['GET'])
+@auto.doc(groups=['comments'])
+@conditional(ENTITY_TYPE.comment, thread=True)
+@cached_page(ENTITY_TYPE.comment, thread=True, params=['after', 'before', 'interval'])
+def get_stats(comment_id: int):
+    """
+    Статистика комментариев ветви указанного комментария: количество, глубина, число авторов и активность по времени.
+
+    Поддерживается фильтрация по дате создания комментария :func:`app.common.date_filter`, интервал группировки
+    активности задаётся :func:`app.common.activity_interval`.
+
+    :param int comment_id: Идентификатор родительского комментария
+    :return: Статистика ветви либо Сообщение об ошибке
+    """
+    after, before, errors = date_filter()
+    if errors:
+        return resp(404, {'errors': errors})
+    interval, errors = activity_interval()
+    if errors:
+        return resp(400, {'errors': errors})
+
+    record = stats(db_conn(), comment_id, after, before, interval)
+    if record is None:
+        errors = [{'error': 'Родительский комментарий не найден', 'comment_id': comment_id}]
+        return resp(404, {'errors': errors})
+    return resp(200, {'response': record})
+
+
 @comments.route('/comments/<int:comment_id>/descendants', methods=['GET'], defaults={'fmt': None})
 @comments.route('/comments/<int:comment_id>/descendants.<string:fmt>', methods=['GET'])
 @auto.doc(groups=['comments'])
@@ -176,26 +309,69 @@ def get_descendants(comment_id: int, fmt: str):
     """
     Получение всех дочерних комментариев.
 
-    Поддерживается фильтрация по дате создания комментария :func:`app.common.date_filter`.
+    Поддерживается фильтрация по дате создания комментария :func:`app.common.date_filter`, а для JSON-стрима —
+    ограничение глубины и ширины дерева :func:`app.common.tree_limits`.
+
+    Состав полей комментариев задаётся проекцией :func:`app.common.fields_filter`.
 
     :param comment_id: Идентификатор родительского комментария
     :param fmt: Формат выдачи в виде "расширения" имени файла. При отсутствии — выдача JSON-стрима в теле ответа. \
-        Возможные значения: *json*, *csv*, *xml*
+        Возможные значения: *json*, *csv*, *xml*, *json.gz*, *csv.gz*, *xml.gz*
     :return: Список всех дочерних комментариев в JSON-стриме либо в стриме скачивания файла заданного формата
     """
     after, before, errors = date_filter()
     if errors:
         return resp(404, {'errors': errors})
 
+    max_depth, per_parent_limit, errors = tree_limits()
+    if errors:
+        return resp(400, {'errors': errors})
+
+    fields, errors = fields_filter()
+    if errors:
+        return resp(400, {'errors': errors})
+
+    if not fmt:
+        records = descendants(db_conn(), comment_id, after, before, max_depth, per_parent_limit, fields)
+        return stream_response(to_json_stream(records), 'application/json; charset="utf-8"')
+    if max_depth or per_parent_limit:
+        return resp(400, {'error': 'Ограничения дерева не поддерживаются для выгрузки в файл', 'fmt': fmt})
+    try:
+        AttachmentManager(fmt.lower(), fields)
+    except ValueError:
+        return resp(400, {'error': 'Указан не поддерживаемый формат файла', 'fmt': fmt})
+
+    return export_response(ENTITY_TYPE.comment, comment_id, fmt.lower(), after, before,
+                           lambda: descendants(db_conn(), comment_id, after, before, fields=fields),
+                           "comment%d_descendants.%s" % (comment_id, fmt.lower()), fields)
+
+
+@comments.route('/comments/<int:comment_id>/history', methods=['GET'], defaults={'fmt': None})
+@comments.route('/comments/<int:comment_id>/history.<string:fmt>', methods=['GET'])
+@auto.doc(groups=['comments'])
+def get_history(comment_id: int, fmt: str):
+    """
+    История правок комментария: текущее состояние и все предыдущие версии, начиная с последней.
+
+    Поддерживается пагинация :func:`app.common.pagination`.
+
+    :param comment_id: Идентификатор комментария
+    :param fmt: Формат выдачи в виде "расширения" имени файла. При отсутствии — постраничная выдача в теле ответа. \
+        Возможные значения: *json*, *csv*, *xml*, *json.gz*, *csv.gz*, *xml.gz*
+    :return: Список версий комментария либо стрим скачивания всей истории в файле заданного формата
+    """
     if not fmt:
-        return Response(stream_with_context(to_json_stream(descendants(db_conn(), comment_id, after, before))),
-                        mimetype='application/json; charset="utf-8"')
+        offset, per_page = pagination()
+        total, records = history(db_conn(), comment_id, offset=offset, limit=per_page)
+        if not total:
+            errors = [{'error': 'Комментарий не найден', 'comment_id': comment_id}]
+            return resp(404, {'errors': errors})
+        return resp(200, {'response': records, 'total': total, 'pages': int(total / per_page) + 1})
     try:
         formatter = AttachmentManager(fmt.lower())
-    except NotImplemented:
+    except ValueError:
         return resp(400, {'error': 'Указан не поддерживаемый формат файла', 'fmt': fmt})
 
-    return Response(stream_with_context(formatter.iterate(descendants(db_conn(), comment_id, after, before))),
-                    mimetype=formatter.content_type,
-                    headers={"Content-Disposition": "attachment; filename=comment%d_descendants.%s" % (
-                        comment_id, fmt.lower())})
+    return stream_response(formatter.iterate(history_stream(db_conn(), comment_id)), formatter.content_type,
+                           {"Content-Disposition": "attachment; filename=comment%d_history.%s" % (
+                               comment_id, fmt.lower())}, compress=not formatter.compressed)
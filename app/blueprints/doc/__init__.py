@@ -32,7 +32,9 @@ def doc_group(group: str):
     titles = {
         'users': 'Пользователи',
         'posts': 'Посты',
-        'comments': 'Комментарии'
+        'comments': 'Комментарии',
+        'exports': 'Выгрузки',
+        'feeds': 'Лента'
     }
     if group not in titles:
         return abort(404)
@@ -1,6 +1,7 @@
-from flask import Blueprint, Response, stream_with_context
+from flask import Blueprint
 
-from app.common import redis_conn
+from app.common import redis_conn, resp, stream_response
+from app.events import event_stream, first_level_channel, subtree_channel, stats
 
 streams = Blueprint('streams', __name__)
 
@@ -13,15 +14,28 @@ def first_level_changed_stream(entity_id: int):
     :param int entity_id: Идентификатор родительской сущности
     :return: Стрим, готовый к приёму в EventSource.js
     """
+    return stream_response(event_stream(redis_conn(), first_level_channel(entity_id)), "text/event-stream",
+                           compress=False)
 
-    def _event_stream():
-        pub_sub = redis_conn().pubsub()
-        pub_sub.subscribe('first_level_changed:%d' % entity_id)
-        for message in pub_sub.listen():
-            if type(message['data']) == bytes:
-                msg = message['data'].decode('utf-8')
-            else:
-                msg = message['data']
-            yield 'data: %s\n\n' % msg
-
-    return Response(stream_with_context(_event_stream()), mimetype="text/event-stream")
+
+@streams.route('/streams/subtree_changed/<int:entity_id>', methods=['GET'])
+def subtree_changed_stream(entity_id: int):
+    """
+    Поток событий о любых изменениях комментариев на любом уровне вложенности ниже указанной сущности.
+
+    :param int entity_id: Идентификатор корневой сущности поддерева
+    :return: Стрим, готовый к приёму в EventSource.js
+    """
+    return stream_response(event_stream(redis_conn(), subtree_channel(entity_id)), "text/event-stream",
+                           compress=False)
+
+
+@streams.route('/streams/stats', methods=['GET'])
+def streams_stats():
+    """
+    Метрики потоков событий текущего процесса: число подписчиков, глубина очередей, доставленные и отброшенные
+    сообщения.
+
+    :return: Словарь метрик
+    """
+    return resp(200, {'response': stats.dict()})
@@ -0,0 +1,96 @@
+"""Асинхронные выгрузки комментариев."""
+import os
+
+from flask import Blueprint
+
+from app.blueprints.doc import auto
+from app.common import db_conn, redis_conn, resp, AttachmentManager, date_filter, fields_filter
+from app.exports import cache_dir, send_export
+from app.jobs import submit_job, get_job, STATUS_DONE
+from app.types import ENTITY_TYPE
+
+exports = Blueprint('exports', __name__)
+
+_KINDS = {
+    'posts': ENTITY_TYPE.post,
+    'users': ENTITY_TYPE.user,
+    'comments': ENTITY_TYPE.comment,
+}
+
+
+def _public(job):
+    """Запись о задаче без пути к файлу на сервере."""
+    return {k: v for k, v in job.items() if k != 'path'}
+
+
+@exports.route('/exports/<any(posts, users, comments):kind>/<int:object_id>.<string:fmt>', methods=['POST'])
+@auto.doc(groups=['exports'])
+def post_export(kind: str, object_id: int, fmt: str):
+    """
+    Поставить в очередь выгрузку всех комментариев к посту, пользователю или комментарию.
+
+    Поддерживается фильтрация по дате создания комментария :func:`app.common.date_filter` и проекция полей
+    :func:`app.common.fields_filter`.
+
+    :param str kind: Вид объекта: *posts*, *users*, *comments*
+    :param int object_id: Идентификатор объекта
+    :param str fmt: Формат выгрузки: *json*, *csv*, *xml* либо их сжатые варианты *json.gz*, *csv.gz*, *xml.gz*
+    :return: Запись о задаче выгрузки либо Возникшие ошибки
+    """
+    after, before, errors = date_filter()
+    if errors:
+        return resp(404, {'errors': errors})
+    fields, errors = fields_filter()
+    if errors:
+        return resp(400, {'errors': errors})
+    fmt = fmt.lower()
+    try:
+        AttachmentManager(fmt)
+    except ValueError:
+        return resp(400, {'error': 'Указан не поддерживаемый формат файла', 'fmt': fmt})
+    if cache_dir() is None:
+        return resp(400, {'error': 'Асинхронные выгрузки отключены'})
+
+    conn = db_conn()
+    try:
+        job = submit_job(redis_conn(), conn, _KINDS[kind], object_id, fmt, after, before, fields)
+    finally:
+        conn.close()
+    if job is None:
+        return resp(404, {'errors': [{'error': 'Объект не найден', 'kind': kind, 'object_id': object_id}]})
+    return resp(202, {'response': _public(job)})
+
+
+@exports.route('/exports/<string:job_id>', methods=['GET'])
+@auto.doc(groups=['exports'])
+def export_status(job_id: str):
+    """
+    Получить состояние задачи выгрузки.
+
+    :param str job_id: Идентификатор задачи
+    :return: Запись о задаче выгрузки либо Сообщение об ошибке
+    """
+    job = get_job(redis_conn(), job_id)
+    if job is None:
+        return resp(404, {'errors': [{'error': 'Задача не найдена', 'job_id': job_id}]})
+    return resp(200, {'response': _public(job)})
+
+
+@exports.route('/exports/<string:job_id>/download', methods=['GET'])
+@auto.doc(groups=['exports'])
+def export_download(job_id: str):
+    """
+    Скачать результат выполненной задачи выгрузки.
+
+    :param str job_id: Идентификатор задачи
+    :return: Файл выгрузки либо Сообщение об ошибке
+    """
+    job = get_job(redis_conn(), job_id)
+    if job is None:
+        return resp(404, {'errors': [{'error': 'Задача не найдена', 'job_id': job_id}]})
+    if job['status'] != STATUS_DONE:
+        return resp(409, {'errors': [{'error': 'Выгрузка ещё не готова', 'job_id': job_id,
+                                      'status': job['status']}]})
+    if not os.path.exists(job['path']):
+        return resp(410, {'errors': [{'error': 'Файл выгрузки устарел, поставьте задачу заново', 'job_id': job_id}]})
+    return send_export(job['path'], AttachmentManager(job['fmt']).content_type, job['filename'])
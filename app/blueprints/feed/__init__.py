@@ -0,0 +1,51 @@
+"""Лента комментариев."""
+from flask import Blueprint, request
+
+from app.blueprints.doc import auto
+from app.common import db_conn, resp, ids_filter, pagination, date_filter
+from app.events import setting
+from app.feed import feed
+
+feeds = Blueprint('feeds', __name__)
+
+
+@feeds.route('/feed', methods=['GET'])
+@auto.doc(groups=['feeds'])
+def get_feed():
+    """
+    Лента: комментарии нескольких пользователей и комментарии к нескольким постам от новых к старым.
+
+    Параметры:
+        - users (str) — Идентификаторы пользователей через запятую (:func:`app.common.ids_filter`).
+        - posts (str) — Идентификаторы постов через запятую.
+        - cursor (str) — Курсор следующей страницы из поля *next* предыдущего ответа.
+
+    Должен быть задан хотя бы один источник, всего не больше ``FEED_MAX_SOURCES``. Поддерживается фильтрация по дате
+    создания комментария :func:`app.common.date_filter`, размер страницы задаётся параметром ``per_page``
+    :func:`app.common.pagination`.
+
+    :return: Список комментариев и Курсор следующей страницы
+    """
+    after, before, errors = date_filter()
+    if errors:
+        return resp(404, {'errors': errors})
+    user_ids, errors = ids_filter('users')
+    if errors:
+        return resp(400, {'errors': errors})
+    post_ids, errors = ids_filter('posts')
+    if errors:
+        return resp(400, {'errors': errors})
+    num = len(set(user_ids or [])) + len(set(post_ids or []))
+    if num == 0:
+        return resp(400, {'errors': [{'error': 'Не заданы источники ленты: users или posts'}]})
+    max_sources = int(setting('FEED_MAX_SOURCES', 200))
+    if num > max_sources:
+        return resp(400, {'errors': [{'error': 'Слишком много источников ленты', 'max': max_sources}]})
+
+    _, per_page = pagination()
+    cursor = request.args.get('cursor') or None
+    try:
+        records, next_cursor = feed(db_conn(), user_ids, post_ids, after, before, cursor, per_page)
+    except ValueError:
+        return resp(400, {'errors': [{'error': 'Не удалось распознать курсор', 'cursor': cursor}]})
+    return resp(200, {'response': records, 'next': next_cursor})
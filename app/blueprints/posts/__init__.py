@@ -2,13 +2,16 @@
 from typing import Dict, Any, List, Optional
 
 import flask
-from flask import Blueprint, Response, stream_with_context
+from flask import Blueprint
 
 from app.blueprints.doc import auto
-from app.common import db_conn, resp, affected_num_to_code, pagination, DatabaseException, to_json_stream, \
-    AttachmentManager, date_filter
+from app.cache import conditional, cached_page
+from app.common import db_conn, resp, ids_filter, affected_num_to_code, pagination, DatabaseException, to_json_stream, \
+    AttachmentManager, date_filter, fields_filter, stream_response, tree_limits, replies_limit, activity_interval
+from app.exports import export_response
 from app.posts import get_posts, get_post, Post, remove_post, new_post, update_post, first_level_comments, \
-    descendant_comments
+    descendant_comments, thread, get_posts_by_ids, stats
+from app.types import ENTITY_TYPE
 
 posts = Blueprint('posts', __name__)
 
@@ -45,8 +48,19 @@ def posts_list():
 
     Поддерживается пагинация :func:`app.common.pagination`.
 
+    Если задан параметр ``ids`` (:func:`app.common.ids_filter`), то выдаются только запрошенные записи в порядке
+    запроса, а на месте не найденных — null.
+
     :return: Список всех постов
     """
+    ids, errors = ids_filter()
+    if errors:
+        return resp(400, {'errors': errors})
+    if ids is not None:
+        records = get_posts_by_ids(db_conn(), ids)
+        errors = [{'error': 'Пост не найден', 'post_id': x} for x, rec in zip(ids, records) if rec is None]
+        return resp(200, {'response': records, 'total': len(records) - len(errors), 'errors': errors})
+
     offset, per_page = pagination()
     total, records = get_posts(db_conn(), offset=offset, limit=per_page)
     return resp(200, {'response': records, 'total': total, 'pages': int(total / per_page) + 1})
@@ -73,6 +87,7 @@ def post_post():
 
 @posts.route('/posts/<int:post_id>', methods=['GET'])
 @auto.doc(groups=['posts'])
+@conditional(ENTITY_TYPE.post)
 def post(post_id: int):
     """
     Получить информацио о Посте.
@@ -130,6 +145,8 @@ def delete_post(post_id: int):
 
 @posts.route('/posts/<int:post_id>/first_level', methods=['GET'])
 @auto.doc(groups=['posts'])
+@conditional(ENTITY_TYPE.post, users=True)
+@cached_page(ENTITY_TYPE.post, users=True)
 def get_first_level_comments(post_id: int):
     """
     Показать комментарии первого уровня вложенности к указанному посту в порядке возрастания даты создания
@@ -137,19 +154,80 @@ def get_first_level_comments(post_id: int):
 
     Поддерживается пагинация :func:`app.common.pagination`.
 
+    Состав полей комментариев задаётся проекцией :func:`app.common.fields_filter`.
+
     :param int post_id: Идентификатор поста
     :return: Список комментарии первого уровня вложенности
     """
+    fields, errors = fields_filter()
+    if errors:
+        return resp(400, {'errors': errors})
+    record = get_post(db_conn(), post_id)
+    if record is None:
+        errors = [{'error': 'Пост не найден', 'post_id': post_id}]
+        return resp(404, {'errors': errors})
+
+    offset, per_page = pagination()
+    total, records = first_level_comments(db_conn(), post_id, offset=offset, limit=per_page, fields=fields)
+    return resp(200, {'response': records, 'total': total, 'pages': int(total / per_page) + 1})
+
+
+@posts.route('/posts/<int:post_id>/thread', methods=['GET'])
+@auto.doc(groups=['posts'])
+@conditional(ENTITY_TYPE.post, users=True, thread=True)
+@cached_page(ENTITY_TYPE.post, users=True, thread=True, params=['replies'])
+def get_thread(post_id: int):
+    """
+    Страница обсуждения: комментарии первого уровня к указанному посту, каждый с первыми ответами и общим
+    количеством ответов.
+
+    Поддерживается пагинация :func:`app.common.pagination`, количество ответов задаётся
+    :func:`app.common.replies_limit`.
+
+    :param int post_id: Идентификатор поста
+    :return: Список комментариев первого уровня вложенности с ответами
+    """
+    replies, errors = replies_limit()
+    if errors:
+        return resp(400, {'errors': errors})
     record = get_post(db_conn(), post_id)
     if record is None:
         errors = [{'error': 'Пост не найден', 'post_id': post_id}]
         return resp(404, {'errors': errors})
 
     offset, per_page = pagination()
-    total, records = first_level_comments(db_conn(), post_id, offset=offset, limit=per_page)
+    total, records = thread(db_conn(), post_id, offset=offset, limit=per_page, replies=replies)
     return resp(200, {'response': records, 'total': total, 'pages': int(total / per_page) + 1})
 
 
+@posts.route('/posts/<int:post_id>/stats', methods=['GET'])
+@auto.doc(groups=['posts'])
+@conditional(ENTITY_TYPE.post, thread=True)
+@cached_page(ENTITY_TYPE.post, thread=True, params=['after', 'before', 'interval'])
+def get_stats(post_id: int):
+    """
+    Статистика комментариев к указанному посту: количество, глубина, число авторов и активность по времени.
+
+    Поддерживается фильтрация по дате создания комментария :func:`app.common.date_filter`, интервал группировки
+    активности задаётся :func:`app.common.activity_interval`.
+
+    :param int post_id: Идентификатор поста
+    :return: Статистика ветви либо Сообщение об ошибке
+    """
+    after, before, errors = date_filter()
+    if errors:
+        return resp(404, {'errors': errors})
+    interval, errors = activity_interval()
+    if errors:
+        return resp(400, {'errors': errors})
+
+    record = stats(db_conn(), post_id, after, before, interval)
+    if record is None:
+        errors = [{'error': 'Пост не найден', 'post_id': post_id}]
+        return resp(404, {'errors': errors})
+    return resp(200, {'response': record})
+
+
 @posts.route('/posts/<int:post_id>/descendants', methods=['GET'], defaults={'fmt': None})
 @posts.route('/posts/<int:post_id>/descendants.<string:fmt>', methods=['GET'])
 @auto.doc(groups=['posts'])
@@ -157,26 +235,38 @@ def get_descendants(post_id: int, fmt: str):
     """
     Получение всех комментариев для указанного поста.
 
-    Поддерживается фильтрация по дате создания комментария :func:`app.common.date_filter`.
+    Поддерживается фильтрация по дате создания комментария :func:`app.common.date_filter`, а для JSON-стрима —
+    ограничение глубины и ширины дерева :func:`app.common.tree_limits`.
+
+    Состав полей комментариев задаётся проекцией :func:`app.common.fields_filter`.
 
     :param post_id: Идентификатор поста
     :param fmt: Формат выдачи в виде "расширения" имени файла. При отсутствии — выдача JSON-стрима в теле ответа. \
-        Возможные значения: *json*, *csv*, *xml*
+        Возможные значения: *json*, *csv*, *xml*, *json.gz*, *csv.gz*, *xml.gz*
     :return: Список всех комментариев к посту в JSON-стриме либо в стриме скачивания файла заданного формата
     """
     after, before, errors = date_filter()
     if errors:
         return resp(404, {'errors': errors})
 
+    max_depth, per_parent_limit, errors = tree_limits()
+    if errors:
+        return resp(400, {'errors': errors})
+
+    fields, errors = fields_filter()
+    if errors:
+        return resp(400, {'errors': errors})
+
     if not fmt:
-        return Response(stream_with_context(to_json_stream(descendant_comments(db_conn(), post_id, after, before))),
-                        mimetype='application/json; charset="utf-8"')
+        records = descendant_comments(db_conn(), post_id, after, before, max_depth, per_parent_limit, fields)
+        return stream_response(to_json_stream(records), 'application/json; charset="utf-8"')
+    if max_depth or per_parent_limit:
+        return resp(400, {'error': 'Ограничения дерева не поддерживаются для выгрузки в файл', 'fmt': fmt})
     try:
-        formatter = AttachmentManager(fmt.lower())
-    except NotImplemented:
+        AttachmentManager(fmt.lower(), fields)
+    except ValueError:
         return resp(400, {'error': 'Указан не поддерживаемый формат файла', 'fmt': fmt})
 
-    return Response(stream_with_context(formatter.iterate(descendant_comments(db_conn(), post_id, after, before))),
-                    mimetype=formatter.content_type,
-                    headers={"Content-Disposition": "attachment; filename=post%d_descendants.%s" % (
-                        post_id, fmt.lower())})
+    return export_response(ENTITY_TYPE.post, post_id, fmt.lower(), after, before,
+                           lambda: descendant_comments(db_conn(), post_id, after, before, fields=fields),
+                           "post%d_descendants.%s" % (post_id, fmt.lower()), fields)
@@ -2,13 +2,17 @@
 from typing import Dict, Any, List, Optional
 
 import flask
-from flask import Blueprint, Response, stream_with_context
+from flask import Blueprint
 
 from app.blueprints.doc import auto
-from app.common import db_conn, resp, affected_num_to_code, pagination, DatabaseException, to_json_stream, \
-    AttachmentManager, date_filter
+from app.cache import conditional, cached_page
+from app.common import db_conn, resp, ids_filter, affected_num_to_code, pagination, DatabaseException, to_json_stream, \
+    AttachmentManager, date_filter, fields_filter, stream_response, tree_limits, replies_limit, activity_interval
+from app.exports import export_response
+from app.types import ENTITY_TYPE
 from app.users import get_users, get_user, User, remove_user, new_user, update_user, first_level_comments, \
-    descendant_comments, comments as user_comments
+    descendant_comments, comments as user_comments, edits as user_edits, thread, get_users_by_ids, stats, replies, \
+    mark_replies_read
 
 users = Blueprint('users', __name__)
 
@@ -43,8 +47,19 @@ def users_list():
 
     Поддерживается пагинация :func:`app.common.pagination`.
 
+    Если задан параметр ``ids`` (:func:`app.common.ids_filter`), то выдаются только запрошенные записи в порядке
+    запроса, а на месте не найденных — null.
+
     :return: Список всех пользователей
     """
+    ids, errors = ids_filter()
+    if errors:
+        return resp(400, {'errors': errors})
+    if ids is not None:
+        records = get_users_by_ids(db_conn(), ids)
+        errors = [{'error': 'Пользователь не найден', 'user_id': x} for x, rec in zip(ids, records) if rec is None]
+        return resp(200, {'response': records, 'total': len(records) - len(errors), 'errors': errors})
+
     offset, per_page = pagination()
     total, records = get_users(db_conn(), offset=offset, limit=per_page)
     return resp(200, {'response': records, 'total': total, 'pages': int(total / per_page) + 1})
@@ -71,6 +86,7 @@ def post_user():
 
 @users.route('/users/<int:user_id>', methods=['GET'])
 @auto.doc(groups=['users'])
+@conditional(ENTITY_TYPE.user)
 def user(user_id: int):
     """
     Получить информацио о Пользователе.
@@ -120,6 +136,8 @@ def delete_user(user_id: int):
 
 @users.route('/users/<int:user_id>/first_level', methods=['GET'])
 @auto.doc(groups=['users'])
+@conditional(ENTITY_TYPE.user, users=True)
+@cached_page(ENTITY_TYPE.user, users=True)
 def get_first_level_comments(user_id: int):
     """
     Показать комментарии первого уровня вложенности к указанному пользователю в порядке возрастания даты создания
@@ -127,19 +145,80 @@ def get_first_level_comments(user_id: int):
 
     Поддерживается пагинация :func:`app.common.pagination`.
 
+    Состав полей комментариев задаётся проекцией :func:`app.common.fields_filter`.
+
     :param int user_id: Идентификатор пользователя
     :return: Список комментарии первого уровня вложенности
     """
+    fields, errors = fields_filter()
+    if errors:
+        return resp(400, {'errors': errors})
     record = get_user(db_conn(), user_id)
     if record is None:
         errors = [{'error': 'Пост не найден', 'post_id': user_id}]
         return resp(404, {'errors': errors})
 
     offset, per_page = pagination()
-    total, records = first_level_comments(db_conn(), user_id, offset=offset, limit=per_page)
+    total, records = first_level_comments(db_conn(), user_id, offset=offset, limit=per_page, fields=fields)
+    return resp(200, {'response': records, 'total': total, 'pages': int(total / per_page) + 1})
+
+
+@users.route('/users/<int:user_id>/thread', methods=['GET'])
+@auto.doc(groups=['users'])
+@conditional(ENTITY_TYPE.user, users=True, thread=True)
+@cached_page(ENTITY_TYPE.user, users=True, thread=True, params=['replies'])
+def get_thread(user_id: int):
+    """
+    Страница обсуждения: комментарии первого уровня к указанному пользователю, каждый с первыми ответами и общим
+    количеством ответов.
+
+    Поддерживается пагинация :func:`app.common.pagination`, количество ответов задаётся
+    :func:`app.common.replies_limit`.
+
+    :param int user_id: Идентификатор пользователя
+    :return: Список комментариев первого уровня вложенности с ответами
+    """
+    replies, errors = replies_limit()
+    if errors:
+        return resp(400, {'errors': errors})
+    record = get_user(db_conn(), user_id)
+    if record is None:
+        errors = [{'error': 'Пользователь не найден', 'user_id': user_id}]
+        return resp(404, {'errors': errors})
+
+    offset, per_page = pagination()
+    total, records = thread(db_conn(), user_id, offset=offset, limit=per_page, replies=replies)
     return resp(200, {'response': records, 'total': total, 'pages': int(total / per_page) + 1})
 
 
+@users.route('/users/<int:user_id>/stats', methods=['GET'])
+@auto.doc(groups=['users'])
+@conditional(ENTITY_TYPE.user, thread=True)
+@cached_page(ENTITY_TYPE.user, thread=True, params=['after', 'before', 'interval'])
+def get_stats(user_id: int):
+    """
+    Статистика комментариев к указанному пользователю: количество, глубина, число авторов и активность по времени.
+
+    Поддерживается фильтрация по дате создания комментария :func:`app.common.date_filter`, интервал группировки
+    активности задаётся :func:`app.common.activity_interval`.
+
+    :param int user_id: Идентификатор пользователя
+    :return: Статистика ветви либо Сообщение об ошибке
+    """
+    after, before, errors = date_filter()
+    if errors:
+        return resp(404, {'errors': errors})
+    interval, errors = activity_interval()
+    if errors:
+        return resp(400, {'errors': errors})
+
+    record = stats(db_conn(), user_id, after, before, interval)
+    if record is None:
+        errors = [{'error': 'Пользователь не найден', 'user_id': user_id}]
+        return resp(404, {'errors': errors})
+    return resp(200, {'response': record})
+
+
 @users.route('/users/<int:user_id>/descendants', methods=['GET'], defaults={'fmt': None})
 @users.route('/users/<int:user_id>/descendants.<string:fmt>', methods=['GET'])
 @auto.doc(groups=['users'])
@@ -147,29 +226,41 @@ def get_descendants(user_id: int, fmt: str):
     """
     Получение всех комментариев для указанного пользователя.
 
-    Поддерживается фильтрация по дате создания комментария :func:`app.common.date_filter`.
+    Поддерживается фильтрация по дате создания комментария :func:`app.common.date_filter`, а для JSON-стрима —
+    ограничение глубины и ширины дерева :func:`app.common.tree_limits`.
+
+    Состав полей комментариев задаётся проекцией :func:`app.common.fields_filter`.
 
     :param user_id: Идентификатор пользователя
     :param fmt: Формат выдачи в виде "расширения" имени файла. При отсутствии — выдача JSON-стрима в теле ответа. \
-        Возможные значения: *json*, *csv*, *xml*
+        Возможные значения: *json*, *csv*, *xml*, *json.gz*, *csv.gz*, *xml.gz*
     :return: Список всех комментариев к пользователю в JSON-стриме либо в стриме скачивания файла заданного формата
     """
     after, before, errors = date_filter()
     if errors:
         return resp(404, {'errors': errors})
 
+    max_depth, per_parent_limit, errors = tree_limits()
+    if errors:
+        return resp(400, {'errors': errors})
+
+    fields, errors = fields_filter()
+    if errors:
+        return resp(400, {'errors': errors})
+
     if not fmt:
-        return Response(stream_with_context(to_json_stream(descendant_comments(db_conn(), user_id, after, before))),
-                        mimetype='application/json; charset="utf-8"')
+        records = descendant_comments(db_conn(), user_id, after, before, max_depth, per_parent_limit, fields)
+        return stream_response(to_json_stream(records), 'application/json; charset="utf-8"')
+    if max_depth or per_parent_limit:
+        return resp(400, {'error': 'Ограничения дерева не поддерживаются для выгрузки в файл', 'fmt': fmt})
     try:
-        formatter = AttachmentManager(fmt.lower())
-    except NotImplemented:
+        AttachmentManager(fmt.lower(), fields)
+    except ValueError:
         return resp(400, {'error': 'Указан не поддерживаемый формат файла', 'fmt': fmt})
 
-    return Response(stream_with_context(formatter.iterate(descendant_comments(db_conn(), user_id, after, before))),
-                    mimetype=formatter.content_type,
-                    headers={"Content-Disposition": "attachment; filename=user%d_descendants.%s" % (
-                        user_id, fmt.lower())})
+    return export_response(ENTITY_TYPE.user, user_id, fmt.lower(), after, before,
+                           lambda: descendant_comments(db_conn(), user_id, after, before, fields=fields),
+                           "user%d_descendants.%s" % (user_id, fmt.lower()), fields)
 
 
 @users.route('/users/<int:user_id>/comments', methods=['GET'], defaults={'fmt': None})
@@ -181,23 +272,114 @@ def comments(user_id: int, fmt: str):
 
     Поддерживается фильтрация по дате создания комментария :func:`app.common.date_filter`.
 
+    Состав полей комментариев задаётся проекцией :func:`app.common.fields_filter`.
+
     :param user_id: Идентификатор пользователя
     :param fmt: Формат выдачи в виде "расширения" имени файла. При отсутствии — выдача JSON-стрима в теле ответа. \
-        Возможные значения: *json*, *csv*, *xml*
+        Возможные значения: *json*, *csv*, *xml*, *json.gz*, *csv.gz*, *xml.gz*
     :return: Список всех комментариев пользователя в JSON-стриме либо в стриме скачивания файла заданного формата
     """
     after, before, errors = date_filter()
     if errors:
         return resp(404, {'errors': errors})
 
+    fields, errors = fields_filter()
+    if errors:
+        return resp(400, {'errors': errors})
+
+    if not fmt:
+        return stream_response(to_json_stream(user_comments(db_conn(), user_id, after, before, fields=fields)),
+                               'application/json; charset="utf-8"')
+    try:
+        formatter = AttachmentManager(fmt.lower(), fields)
+    except ValueError:
+        return resp(400, {'error': 'Указан не поддерживаемый формат файла', 'fmt': fmt})
+
+    records = user_comments(db_conn(), user_id, after, before, fields=fields)
+    return stream_response(formatter.iterate(records), formatter.content_type,
+                           {"Content-Disposition": "attachment; filename=user%d_comments.%s" % (user_id, fmt.lower())},
+                           compress=not formatter.compressed)
+
+
+@users.route('/users/<int:user_id>/replies', methods=['GET'])
+@auto.doc(groups=['users'])
+def get_replies(user_id: int):
+    """
+    Входящие ответы пользователя: ответы на его комментарии, посты и комментарии на его странице, от новых к старым.
+
+    Параметры:
+        - cursor (str) — Курсор следующей страницы из поля *next* предыдущего ответа.
+
+    Размер страницы задаётся параметром ``per_page`` :func:`app.common.pagination`.
+
+    :param int user_id: Идентификатор пользователя
+    :return: Количество непрочитанных ответов, Список ответов и Курсор следующей страницы либо Сообщение об ошибке
+    """
+    _, per_page = pagination()
+    cursor = flask.request.args.get('cursor') or None
+    try:
+        result = replies(db_conn(), user_id, cursor, per_page)
+    except ValueError:
+        return resp(400, {'errors': [{'error': 'Не удалось распознать курсор', 'cursor': cursor}]})
+    if result is None:
+        return resp(404, {'errors': [{'error': 'Пользователь не найден', 'user_id': user_id}]})
+    unread, records, next_cursor = result
+    return resp(200, {'response': records, 'unread': unread, 'next': next_cursor})
+
+
+@users.route('/users/<int:user_id>/replies/read', methods=['POST'])
+@auto.doc(groups=['users'])
+def read_replies(user_id: int):
+    """
+    Отметить входящие ответы пользователя прочитанными.
+
+    Параметры:
+        - until (int) — Идентификатор ответа: отмечаются он и все более ранние ответы. По умолчанию — все ответы.
+
+    :param int user_id: Идентификатор пользователя
+    :return: Количество оставшихся непрочитанных ответов либо Возникшие ошибки
+    """
+    until = flask.request.args.get('until', None)
+    if until is not None:
+        try:
+            until = int(until)
+        except ValueError:
+            return resp(400, {'errors': [{'error': 'Ожидалось целое число', 'until': until}]})
+    if get_user(db_conn(), user_id) is None:
+        return resp(404, {'errors': [{'error': 'Пользователь не найден', 'user_id': user_id}]})
+    try:
+        unread = mark_replies_read(db_conn(), user_id, until)
+    except DatabaseException as e:
+        return resp(400, {"errors": str(e)})
+    return resp(200, {'unread': unread})
+
+
+@users.route('/users/<int:user_id>/edits', methods=['GET'], defaults={'fmt': None})
+@users.route('/users/<int:user_id>/edits.<string:fmt>', methods=['GET'])
+@auto.doc(groups=['users'])
+def edits(user_id: int, fmt: str):
+    """
+    Получение всех правок комментариев, сделанных указанным пользователем.
+
+    Поддерживается фильтрация по дате правки :func:`app.common.date_filter`.
+
+    :param user_id: Идентификатор пользователя
+    :param fmt: Формат выдачи в виде "расширения" имени файла. При отсутствии — выдача JSON-стрима в теле ответа. \
+        Возможные значения: *json*, *csv*, *xml*, *json.gz*, *csv.gz*, *xml.gz*
+    :return: Список правок пользователя в JSON-стриме либо в стриме скачивания файла заданного формата
+    """
+    after, before, errors = date_filter()
+    if errors:
+        return resp(404, {'errors': errors})
+
     if not fmt:
-        return Response(stream_with_context(to_json_stream(user_comments(db_conn(), user_id, after, before))),
-                        mimetype='application/json; charset="utf-8"')
+        return stream_response(to_json_stream(user_edits(db_conn(), user_id, after, before)),
+                               'application/json; charset="utf-8"')
     try:
         formatter = AttachmentManager(fmt.lower())
-    except NotImplemented:
+    except ValueError:
         return resp(400, {'error': 'Указан не поддерживаемый формат файла', 'fmt': fmt})
 
-    return Response(stream_with_context(formatter.iterate(user_comments(db_conn(), user_id, after, before))),
-                    mimetype=formatter.content_type,
-                    headers={"Content-Disposition": "attachment; filename=user%d_comments.%s" % (user_id, fmt.lower())})
+    return stream_response(formatter.iterate(user_edits(db_conn(), user_id, after, before)), formatter.content_type,
+                           {"Content-Disposition": "attachment; filename=user%d_edits.%s" % (user_id, fmt.lower())},
+                           compress=not formatter.compressed)
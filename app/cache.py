@@ -0,0 +1,220 @@
+"""Версии сущностей, условные запросы (ETag / If-None-Match) и кэш готовых ответов."""
+import functools
+import hashlib
+import uuid
+from typing import Optional, Iterable, Callable, Tuple
+
+from flask import request, Response, g
+
+from app.authors import USERS_KEY
+from app.common import db_conn, redis_conn, pagination, fields_filter, JSON_MIMETYPE
+from app.events import setting
+from app.types import ENTITY_TYPE
+
+EPOCH_KEY = 'version:epoch'
+"""Эпоха версий: меняется, если Redis потерял данные, и тем самым делает недействительными все выданные ETag."""
+
+_ENTITY_TABLES = {
+    ENTITY_TYPE.comment: ('comments', 'commentid'),
+    ENTITY_TYPE.post: ('posts', 'postid'),
+    ENTITY_TYPE.user: ('users', 'userid'),
+}
+
+
+def version_key(entity_id: int) -> str:
+    """Ключ версии сущности."""
+    return 'version:%d' % entity_id
+
+
+def entity_key(kind: ENTITY_TYPE, object_id: int) -> str:
+    """Ключ соответствия идентификатора объекта идентификатору его сущности."""
+    return 'entity:%s:%d' % (kind.name, object_id)
+
+
+def thread_key(entity_id: int) -> str:
+    """Ключ версии всей ветви комментариев под сущностью."""
+    return 'thread:%d' % entity_id
+
+
+def bump_versions(redis, entity_ids: Iterable[Optional[int]], users: bool = False,
+                  threads: Iterable[int] = ()) -> None:
+    """
+    Увеличение версий сущностей после изменения их самих либо их непосредственных потомков.
+
+    Вызывается после фиксации транзакции, иначе читатель может получить новую версию вместе со старыми данными.
+
+    :param redis: Redis-соединение
+    :param entity_ids: Идентификаторы изменившихся сущностей
+    :param bool users: Изменились данные пользователей
+    :param threads: Сущности, в ветвях которых что-то изменилось (родитель комментария и все его предки)
+    """
+    pipe = redis.pipeline(transaction=False)
+    for entity_id in {x for x in entity_ids if x is not None}:
+        pipe.incr(version_key(entity_id))
+    for entity_id in set(threads):
+        pipe.incr(thread_key(entity_id))
+    if users:
+        pipe.incr(USERS_KEY)
+    pipe.execute()
+
+
+def resolve_entity(redis, conn, kind: ENTITY_TYPE, object_id: int) -> Optional[int]:
+    """
+    Идентификатор сущности объекта.
+
+    Соответствие неизменно, поэтому запоминается в Redis на ``ENTITY_ID_CACHE_TTL`` секунд и повторные условные
+    запросы не обращаются к базе данных.
+
+    :param redis: Redis-соединение
+    :param conn: Psycopg2 соединение либо функция, возвращающая его
+    :param kind: Вид объекта
+    :param int object_id: Идентификатор объекта (комментария, поста, пользователя)
+    :return: Идентификатор сущности либо None, если объект не найден
+    :rtype: int
+    """
+    key = entity_key(kind, object_id)
+    cached = redis.get(key)
+    if cached is not None:
+        return int(cached)
+    if callable(conn):
+        conn = conn()
+    table, field = _ENTITY_TABLES[kind]
+    cur = conn.cursor()
+    cur.execute("SELECT entityid FROM " + table + " WHERE " + field + " = %s;", [object_id])
+    rec = cur.fetchone()
+    cur.close()
+    conn.commit()
+    if rec is None:
+        return None
+    redis.setex(key, int(setting('ENTITY_ID_CACHE_TTL', 86400)), rec[0])
+    return rec[0]
+
+
+def entity_token(redis, entity_id: int, users: bool = False, thread: bool = False) -> str:
+    """
+    Отпечаток текущей версии сущности.
+
+    :param redis: Redis-соединение
+    :param int entity_id: Идентификатор сущности
+    :param bool users: Учитывать версию данных пользователей (имена авторов)
+    :param bool thread: Версия всей ветви комментариев под сущностью вместо версии самой сущности
+    :return: Отпечаток версии
+    :rtype: str
+    """
+    key = thread and thread_key(entity_id) or version_key(entity_id)
+    epoch, version, users_version = redis.mget(EPOCH_KEY, key, USERS_KEY)
+    if epoch is None:
+        redis.setnx(EPOCH_KEY, uuid.uuid4().hex)
+        epoch = redis.get(EPOCH_KEY)
+    parts = [epoch, key.encode('utf-8'), version or b'0', users and (users_version or b'0') or b'']
+    return hashlib.sha1(b'|'.join(parts)).hexdigest()
+
+
+def entity_etag(redis, entity_id: int, users: bool = False, variant: str = '') -> str:
+    """
+    Сильный ETag представления сущности.
+
+    :param redis: Redis-соединение
+    :param int entity_id: Идентификатор сущности
+    :param bool users: Представление содержит данные пользователей (имена авторов)
+    :param str variant: Всё прочее, от чего зависит представление (путь и параметры запроса)
+    :return: Значение ETag без кавычек
+    :rtype: str
+    """
+    return _etag(entity_token(redis, entity_id, users), variant)
+
+
+def _etag(token: str, variant: str) -> str:
+    return hashlib.sha1((token + '|' + variant).encode('utf-8')).hexdigest()
+
+
+def _request_state(redis, kind: ENTITY_TYPE, object_id: int, users: bool,
+                   thread: bool = False) -> Optional[Tuple[int, str]]:
+    """Идентификатор сущности и отпечаток её версии, один раз за запрос."""
+    states = g.setdefault('entity_states', {})
+    key = (kind, object_id, users, thread)
+    if key not in states:
+        entity_id = resolve_entity(redis, db_conn, kind, object_id)
+        states[key] = entity_id is not None and (entity_id, entity_token(redis, entity_id, users, thread)) or None
+    return states[key]
+
+
+def conditional(kind: ENTITY_TYPE, users: bool = False, thread: bool = False) -> Callable:
+    """
+    Декоратор представления объекта с поддержкой ETag и условного запроса If-None-Match.
+
+    Версия читается до выполнения запросов к данным: если сущность изменится во время формирования ответа, то
+    клиент просто получит ответ заново при следующем запросе. Совпадение ETag даёт ответ 304 без обращения к таблицам
+    комментариев.
+
+    :param kind: Вид объекта; идентификатор берётся из параметра представления ``<вид>_id``
+    :param bool users: Представление содержит данные пользователей (имена авторов)
+    :param bool thread: Представление зависит от всей ветви комментариев под сущностью, а не только от неё самой
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            redis = redis_conn()
+            state = _request_state(redis, kind, kwargs[kind.name + '_id'], users, thread)
+            if state is None:
+                return view(*args, **kwargs)
+            etag = _etag(state[1], request.full_path)
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+            response = view(*args, **kwargs)
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def cached_page(kind: ENTITY_TYPE, users: bool = False, thread: bool = False,
+                params: Iterable[str] = ()) -> Callable:
+    """
+    Декоратор страницы списка с кэшированием готового тела ответа в Redis.
+
+    Ключ включает сущность, отпечаток её версии, параметры пагинации, проекцию полей и значения параметров ``params``,
+    поэтому любая запись, меняющая версию (см. :func:`bump_versions`), делает закэшированные страницы недоступными, а
+    сами они истекают через ``RESPONSE_CACHE_TTL`` секунд. Попадание в кэш не выполняет ни SQL-запросов, ни
+    сериализации.
+
+    :param kind: Вид объекта; идентификатор берётся из параметра представления ``<вид>_id``
+    :param bool users: Страница содержит данные пользователей (имена авторов)
+    :param bool thread: Страница зависит от всей ветви комментариев под сущностью (см. :func:`entity_token`)
+    :param params: Прочие параметры запроса, от которых зависит страница
+    """
+    names = list(params)
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            ttl = int(setting('RESPONSE_CACHE_TTL', 300))
+            if ttl <= 0:
+                return view(*args, **kwargs)
+            redis = redis_conn()
+            state = _request_state(redis, kind, kwargs[kind.name + '_id'], users, thread)
+            if state is None:
+                return view(*args, **kwargs)
+            offset, per_page = pagination()
+            fields = fields_filter()[0]
+            key = 'response:%d:%s:%d:%d:%s' % (state[0], state[1], offset, per_page, ','.join(fields or []))
+            if names:
+                key += ':' + '&'.join(request.args.get(x, '') for x in names)
+            body = redis.get(key)
+            if body is not None:
+                return Response(status=200, mimetype=JSON_MIMETYPE, response=body, headers={'X-Cache': 'HIT'})
+            response = view(*args, **kwargs)
+            if response.status_code == 200 and not response.is_streamed:
+                redis.setex(key, ttl, response.get_data())
+                response.headers['X-Cache'] = 'MISS'
+            return response
+
+        return wrapper
+
+    return decorator
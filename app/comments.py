@@ -5,17 +5,54 @@ import psycopg2
 from dateutil.tz import tzlocal
 from psycopg2.extras import RealDictCursor
 
-from app.common import DatabaseException, entity_first_level_comments, entity_descendants, redis_publish, redis_conn
+from app.cache import bump_versions
+from app.common import DatabaseException, entity_first_level_comments, entity_descendants, entity_thread, redis_conn, \
+    entity_ancestors, comment_columns, fill_authors, sql_date_filter, entity_stats
+from app.events import event_message, publish_event, setting
 from app.types import Comment
 
 
-def get_comments(conn, offset: int = 0, limit: int = 100) -> Tuple[int, List[Dict[str, Any]]]:
+THREAD_MAX_DEPTH = 1000  # type: int
+"""Предел глубины подъёма по дереву при поиске предков изменившегося комментария."""
+
+
+def thread_ancestors(conn, parent_id: int) -> List[int]:
+    """
+    Родительская сущность комментария и все её предки: изменение комментария меняет ветви каждой из них.
+
+    :param conn: Psycopg2 соединение
+    :param int parent_id: Идентификатор родительской сущности комментария
+    :return: Список идентификаторов сущностей, начиная с родительской
+    :rtype: list
+    """
+    return entity_ancestors(conn, parent_id, THREAD_MAX_DEPTH)
+
+
+def subtree_ancestors(ancestors: List[int]) -> List[int]:
+    """
+    Сущности, в каналы поддеревьев которых уходят события об изменении комментария.
+
+    Количество каналов ограничено параметром ``EVENTS_SUBTREE_DEPTH``.
+
+    :param list ancestors: Родительская сущность комментария и её предки, см. :func:`thread_ancestors`
+    :return: Список идентификаторов сущностей
+    :rtype: list
+    """
+    limit = int(setting('EVENTS_SUBTREE_DEPTH', 100))
+    if limit <= 0:
+        return []
+    return ancestors[:limit]
+
+
+def get_comments(conn, offset: int = 0, limit: int = 100, fields: Optional[List[str]] = None) -> \
+        Tuple[int, List[Dict[str, Any]]]:
     """
     Получение всех *Комментариев* (:class:`app.comments.Comment`).
 
     :param conn: Psycopg2 соединение
     :param int offset: Начало отсчета, по умолчанию 0
     :param int limit: Количество результатов, по умолчанию максимум = 100
+    :param list fields: Проекция полей (см. :func:`app.common.fields_filter`), по умолчанию все поля
     :return: Общее количество и Список комментариев
     :rtype: tuple
     """
@@ -24,20 +61,18 @@ def get_comments(conn, offset: int = 0, limit: int = 100) -> Tuple[int, List[Dic
     # В лоб считать неудалённые записи нельзя - будет FullScan, потому немного хитрим:
     # Берем количество записей из таблицы статистики и вычитаем число удалённых записей.
     # Обе операции делаются по индексам и потому максимально быстрые.
-    cur.execute("SELECT (SELECT n_live_tup FROM pg_stat_all_tables WHERE relname = 'comments') "
+    # Статистика ведётся по каждой секции отдельно, у самой секционированной таблицы она пустая.
+    cur.execute("SELECT (SELECT COALESCE(SUM(n_live_tup), 0) :: BIGINT FROM pg_stat_all_tables "
+                "        WHERE relid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = 'comments' :: REGCLASS)) "
                 "- "
                 "(SELECT COUNT(deleted) FROM comments WHERE deleted = %s) AS count;", [True])
     total = cur.fetchone()['count']
 
-    cur.execute("SELECT C.entityid, C.commentid, C.userid, C.datetime, C.parentid, C.text, C.deleted, U.name "
+    cur.execute("SELECT " + comment_columns(fields) + " "
                 "FROM comments AS C "
-                "LEFT JOIN users AS U ON U.userid = C.userid "
                 "WHERE C.deleted = %s "
                 "LIMIT %s OFFSET %s;", [False, limit, offset])
-    comments = []
-    for rec in cur.fetchall():
-        rec['author'] = {'userid': rec.pop('userid'), 'name': rec.pop('name')}
-        comments.append(rec)
+    comments = fill_authors(conn, cur.fetchall())
     cur.close()
     return total, comments
 
@@ -53,17 +88,105 @@ def get_comment(conn, comment_id: int) -> Optional[Dict[str, Any]]:
     """
     cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     cur.execute("SET timezone = 'Europe/Moscow';")
-    cur.execute("SELECT C.entityid, C.commentid, C.userid, C.datetime, C.parentid, C.text, C.deleted, U.name "
-                "FROM comments AS C "
-                "LEFT JOIN users AS U ON U.userid = C.userid "
-                "WHERE C.commentid = %s;",
-                [comment_id])
+    cur.execute("SELECT " + comment_columns(None) + " FROM comments AS C WHERE C.commentid = %s;", [comment_id])
     rec = cur.fetchone()
+    cur.close()
     if not rec:
         return None
-    rec['author'] = {'userid': rec.pop('userid'), 'name': rec.pop('name')}
+    return fill_authors(conn, [rec])[0]
+
+
+def get_comments_by_ids(conn, comment_ids: List[int]) -> List[Optional[Dict[str, Any]]]:
+    """
+    Получение нескольких *Комментариев* (:class:`app.comments.Comment`) одним запросом.
+
+    :param conn: Psycopg2 соединение
+    :param list comment_ids: Идентификаторы комментариев
+    :return: Комментарии в порядке запрошенных идентификаторов, None на месте не найденных
+    :rtype: list
+    """
+    if not comment_ids:
+        return []
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute("SET timezone = 'Europe/Moscow';")
+    cur.execute("SELECT " + comment_columns(None) + " FROM comments AS C WHERE C.commentid = ANY(%s);",
+                [list(set(comment_ids))])
+    found = {rec['commentid']: rec for rec in fill_authors(conn, cur.fetchall())}
     cur.close()
-    return rec
+    return [found.get(x) for x in comment_ids]
+
+
+SEARCH_CONFIG = 'russian'  # type: str
+"""Конфигурация полнотекстового поиска; должна совпадать с конфигурацией триггера ``comments_tsv()``."""
+
+
+def parse_search_cursor(cursor: str) -> Tuple[float, int]:
+    """
+    Разбор курсора страницы результатов поиска вида ``<ранг>:<идентификатор комментария>``.
+
+    :param str cursor: Курсор из поля *next* предыдущей страницы
+    :return: Ранг и Идентификатор последнего комментария предыдущей страницы
+    :rtype: tuple
+    :raises ValueError: Курсор не распознан
+    """
+    rank, comment_id = cursor.split(':')
+    return float(rank), int(comment_id)
+
+
+def search(conn, query: str, entity_id: Optional[int] = None, user_id: Optional[int] = None,
+           after: Optional[datetime.datetime] = None, before: Optional[datetime.datetime] = None,
+           cursor: Optional[str] = None, limit: int = 10) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Полнотекстовый поиск по тексту неудалённых комментариев.
+
+    Запрос разбирается :func:`websearch_to_tsquery` (слова, ``"фразы"``, ``or``, ``-исключения``) и сопоставляется
+    столбцу ``text_tsv``, который поддерживает триггер. Комментарии пользователя ищутся по GIN-индексу
+    ``comments_text_tsv_index``, в пределах сущности — среди её потомков ``comments_tree()``. Результаты упорядочены по
+    убыванию ранга :func:`ts_rank`, а при равенстве — по убыванию идентификатора; страницы выбираются по ключу (ранг,
+    идентификатор) последней записи, а не через OFFSET.
+
+    :param conn: Psycopg2 соединение
+    :param str query: Поисковый запрос
+    :param int entity_id: Искать среди потомков сущности, None — без ограничения
+    :param int user_id: Искать среди комментариев пользователя, None — без ограничения
+    :param datetime after: Фильтр по дате *после* указанной
+    :param datetime before: Фильтр по дате *до* указанной
+    :param str cursor: Курсор следующей страницы из предыдущего ответа, None — первая страница
+    :param int limit: Количество результатов на странице
+    :return: Список комментариев с рангом *rank* и Курсор следующей страницы либо None для последней
+    :rtype: tuple
+    :raises ValueError: Курсор не распознан
+    """
+    source, values = "comments", []
+    if entity_id is not None:
+        source, values = "comments_tree(%s)", [entity_id]
+    filters = ["C.deleted = FALSE", "C.text_tsv @@ Q.query"]
+    values.extend([SEARCH_CONFIG, query])
+    if user_id is not None:
+        filters.append("C.userid = %s")
+        values.append(user_id)
+    dtf, dtf_values = sql_date_filter(after, before, 'C')
+    if dtf:
+        filters.append(dtf)
+        values.extend(dtf_values)
+    if cursor is not None:
+        filters.append("(ts_rank(C.text_tsv, Q.query), C.commentid) < (%s :: REAL, %s)")
+        values.extend(parse_search_cursor(cursor))
+
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute("SET timezone = 'Europe/Moscow';")
+    cur.execute("SELECT " + comment_columns(None, extra=['ts_rank(C.text_tsv, Q.query) AS rank']) + " "
+                "FROM " + source + " AS C, websearch_to_tsquery(%s :: REGCONFIG, %s) AS Q(query) "
+                "WHERE " + " AND ".join(filters) + " "
+                "ORDER BY rank DESC, C.commentid DESC "
+                "LIMIT %s;", values + [limit + 1])
+    records = cur.fetchall()
+    cur.close()
+    next_cursor = None
+    if len(records) > limit:
+        records = records[:limit]
+        next_cursor = '%r:%d' % (records[-1]['rank'], records[-1]['commentid'])
+    return fill_authors(conn, records), next_cursor
 
 
 def new_comment(conn, data, redis=None) -> Tuple[int, int]:
@@ -74,6 +197,9 @@ def new_comment(conn, data, redis=None) -> Tuple[int, int]:
         - datetime (datetime.datetime) — Дата создания комментария, по умолчанию — текущий момент времени
         - deleted (bool) — Флаг удалённого комментария, по умолчанию — False
 
+    Тем же запросом автору родительской сущности (комментария, поста либо самому пользователю, если комментарий
+    оставлен на его странице) записывается строка входящих ответов ``replies_inbox`` — кроме ответов самому себе.
+
     :param conn: Psycopg2 соединение
     :param dict data: Данные о комментарии
     :param redis: Опциональное Redis-соединение, если вызывается вне приложения
@@ -85,9 +211,23 @@ def new_comment(conn, data, redis=None) -> Tuple[int, int]:
     try:
         cur = conn.cursor()
         cur.execute("SET timezone = 'Europe/Moscow';")
-        cur.execute("INSERT INTO comments (userid, datetime, parentid, text, deleted) "
-                    "VALUES (%s, %s, %s, %s, %s) "
-                    "RETURNING commentid, entityid",
+        # noinspection SqlResolve
+        cur.execute("WITH N AS ("
+                    "  INSERT INTO comments (userid, datetime, parentid, text, deleted) "
+                    "  VALUES (%s, %s, %s, %s, %s) "
+                    "  RETURNING commentid, entityid, userid, datetime, parentid, deleted"
+                    "), O AS ("
+                    "  SELECT N.*, COALESCE((SELECT userid FROM comments WHERE entityid = N.parentid LIMIT 1), "
+                    "                       (SELECT userid FROM posts WHERE entityid = N.parentid), "
+                    "                       (SELECT userid FROM users WHERE entityid = N.parentid)) AS owner "
+                    "  FROM N"
+                    "), I AS ("
+                    "  INSERT INTO replies_inbox (userid, commentid, datetime, parentid) "
+                    "  SELECT U.userid, O.commentid, O.datetime, O.parentid "
+                    "  FROM O JOIN users AS U ON U.userid = O.owner "
+                    "  WHERE O.owner <> O.userid AND NOT O.deleted"
+                    ") "
+                    "SELECT commentid, entityid FROM N;",
                     [data['userid'], data['datetime'], data['parentid'], data['text'], data['deleted']])
         (comment_id, entity_id) = cur.fetchone()
         conn.commit()
@@ -95,14 +235,14 @@ def new_comment(conn, data, redis=None) -> Tuple[int, int]:
     except psycopg2.DatabaseError as e:
         raise DatabaseException(e)
 
+    redis = redis or redis_conn()
+    ancestors = thread_ancestors(conn, data['parentid'])
+    bump_versions(redis, [data['parentid']], threads=ancestors)
+
     # Поддержка Server-Sent Events
-    channel = 'first_level_changed:%d' % data['parentid']
-    message = {
-        'action': 'new_comment',
-        'now': datetime.datetime.now(tz=tzlocal()).isoformat(),
-        'record': {'comment_id': comment_id, 'entity_id': entity_id},
-    }
-    redis_publish(redis or redis_conn(), channel, message)
+    message = event_message('new_comment', comment_id, entity_id,
+                            record={'comment_id': comment_id, 'entity_id': entity_id})
+    publish_event(redis, data['parentid'], message, subtree_ancestors(ancestors))
 
     return comment_id, entity_id
 
@@ -111,7 +251,9 @@ def remove_comment(conn, comment_id: int, redis=None) -> Optional[int]:
     """
     Удаление *Комментария* (:class:`app.comments.Comment`).
 
-    Комментарию устанавливается флаг удалённого.
+    Комментарию устанавливается флаг удалённого. Проверка того, что удаляется лист, а не ветвь, установка флага и
+    удаление комментария из входящих ответов делаются одним запросом, который блокирует строку комментария и
+    возвращает его предыдущее состояние.
 
     :param conn: Psycopg2 соединение
     :param int comment_id: Идентификатор комментария
@@ -119,45 +261,67 @@ def remove_comment(conn, comment_id: int, redis=None) -> Optional[int]:
     :return: Количество удалённых записей либо None если удаление не удалось (имеются родители)
     :rtype: int
     """
-    # Проверяем что удаляем лист, а не ветвь
-    comment = get_comment(conn, comment_id)
-    if comment is None or comment['deleted']:
-        return 0
-
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(entityid) FROM comments WHERE parentid = %s AND deleted = %s;",
-                [comment['entityid'], False])
-    cnt = cur.fetchone()[0]
-    cur.close()
-    if cnt != 0:
-        return None
-
-    comment['userid'] = comment['author']['userid']
-    data = {name: comment[name] for name in Comment.data_fields}
-    data['deleted'] = True
     try:
-        cnt = update_comment(conn, comment_id, data=data)
+        cur = conn.cursor()
+        # noinspection SqlResolve
+        cur.execute("SET timezone = 'Europe/Moscow'; "
+                    "WITH O AS ("
+                    "  SELECT entityid, commentid, userid, datetime, parentid, text, deleted "
+                    "  FROM comments WHERE commentid = %s AND deleted = FALSE FOR UPDATE"
+                    "), K AS ("
+                    "  SELECT EXISTS(SELECT 1 FROM comments, O "
+                    "                WHERE comments.parentid = O.entityid AND comments.deleted = FALSE) AS branch"
+                    "), D AS ("
+                    "  UPDATE comments SET deleted = TRUE FROM O, K "
+                    "  WHERE comments.commentid = O.commentid AND NOT K.branch "
+                    "  RETURNING comments.commentid"
+                    "), X AS ("
+                    "  DELETE FROM replies_inbox WHERE commentid IN (SELECT commentid FROM D)"
+                    ") "
+                    "SELECT O.entityid, O.commentid, O.userid, O.datetime, O.parentid, O.text, O.deleted, "
+                    "(SELECT name FROM users WHERE users.userid = O.userid), K.branch, (SELECT COUNT(*) FROM D) "
+                    "FROM O, K;",
+                    [comment_id])
+        rec = cur.fetchone()
+        conn.commit()
+        cur.close()
     except psycopg2.DatabaseError as e:
         raise DatabaseException(e)
+    if rec is None:
+        return 0
+    if rec[8]:
+        return None
+
+    # noinspection PyArgumentList
+    comment = Comment(*rec[:7]).dict
+    redis = redis or redis_conn()
+    ancestors = thread_ancestors(conn, comment['parentid'])
+    bump_versions(redis, [comment['entityid'], comment['parentid']], threads=ancestors)
 
     # Поддержка Server-Sent Events
-    if cnt == 1:
-        channel = 'first_level_changed:%d' % comment['parentid']
-        message = {
-            'action': 'delete_comment',
-            'now': datetime.datetime.now(tz=tzlocal()).isoformat(),
-            'old_record': comment
-        }
-        redis_publish(redis or redis_conn(), channel, message)
+    comment['author'] = {'userid': comment['userid'], 'name': rec[7]}
+    message = event_message('delete_comment', comment_id, comment['entityid'], old_record=comment)
+    publish_event(redis, comment['parentid'], message, subtree_ancestors(ancestors))
+
+    return rec[9]
+
 
-    return cnt
+INBOX_FIELDS = ['userid', 'datetime', 'parentid', 'deleted']  # type: List[str]
+"""Поля комментария, от которых зависит его строка во входящих ответах (см. :func:`update_comment`)."""
 
 
 def update_comment(conn, comment_id: int, data: Dict[str, Any], redis=None) -> int:
     """
     Обновление информации о *Комментарии* (:class:`app.comments.Comment`).
 
-    Если какие-то из полей данных не заполнены, то будут использованы текущие значения из БД.
+    Обновляются только переданные поля данных и только если их значения отличаются от текущих — запрос на обновление
+    без реальных изменений ничего не записывает (в том числе и в историю правок). Обновление делается одним запросом,
+    который блокирует строку комментария и возвращает как предыдущее, так и новое её состояние.
+
+    Если меняются поля из :data:`INBOX_FIELDS`, тем же запросом приводится в соответствие строка входящих ответов
+    ``replies_inbox``: при смене автора или родителя она переходит к новому владельцу родительской сущности (либо
+    удаляется, если это ответ самому себе), при смене даты — переносит дату, а при установке флага удалённого —
+    удаляется.
 
     :param conn: Psycopg2 соединение
     :param int comment_id: Идентификатор комментария
@@ -166,43 +330,76 @@ def update_comment(conn, comment_id: int, data: Dict[str, Any], redis=None) -> i
     :return: Количество обновлённых записей
     :rtype: int
     """
-    comment = get_comment(conn, comment_id)
-    if comment is None or comment['deleted']:
-        return 0
-    comment['userid'] = comment['author']['userid']
-    # Формируем полный словарь данных, для отсутствующих значений используем данные из базы
-    data = {x: data.get(x, comment[x]) for x in Comment.data_fields}
-    if data == comment:
+    fields = [x for x in Comment.data_fields if x in data]
+    if not fields:
         return 0
+    values = [data[x] for x in fields]
     try:
         cur = conn.cursor()
-        cur.execute("SET timezone = 'Europe/Moscow';")
-        # TODO: Обновлять только реально изменившиеся поля
-        cur.execute("UPDATE comments SET userid = %s, datetime = %s, parentid= %s, text = %s, deleted = %s "
-                    "WHERE commentid = %s",
-                    [data['userid'], data['datetime'], data['parentid'], data['text'], data['deleted'],
-                     comment_id])
-        cnt = cur.rowcount
+        # noinspection SqlResolve
+        query = "UPDATE comments AS C SET " + ', '.join(x + " = %s" for x in fields) + " " \
+                "FROM (SELECT entityid, commentid, userid, datetime, parentid, text, deleted " \
+                "      FROM comments WHERE commentid = %s AND deleted = FALSE FOR UPDATE) AS O " \
+                "WHERE C.commentid = O.commentid " \
+                "AND (" + ', '.join('C.' + x for x in fields) + ") IS DISTINCT FROM (" + \
+                ', '.join(['%s'] * len(fields)) + ") " \
+                "RETURNING O.entityid, O.commentid, O.userid, O.datetime, O.parentid, O.text, O.deleted, " \
+                "(SELECT name FROM users WHERE users.userid = O.userid), " \
+                "C.userid AS new_userid, C.datetime AS new_datetime, C.parentid AS new_parentid, " \
+                "C.text AS new_text, C.deleted AS new_deleted"
+        if set(fields) & set(INBOX_FIELDS):
+            # noinspection SqlResolve
+            query = "WITH U AS (" + query + "), R AS (" \
+                    "  SELECT W.userid AS owner, U.commentid, U.new_datetime AS datetime, U.new_parentid AS parentid " \
+                    "  FROM U JOIN users AS W ON W.userid = COALESCE(" \
+                    "    (SELECT userid FROM comments WHERE entityid = U.new_parentid LIMIT 1), " \
+                    "    (SELECT userid FROM posts WHERE entityid = U.new_parentid), " \
+                    "    (SELECT userid FROM users WHERE entityid = U.new_parentid)) " \
+                    "  WHERE W.userid <> U.new_userid AND NOT U.new_deleted" \
+                    "), X AS (" \
+                    "  DELETE FROM replies_inbox AS I USING U WHERE I.commentid = U.commentid " \
+                    "  AND NOT EXISTS(SELECT 1 FROM R WHERE R.owner = I.userid)" \
+                    "), Y AS (" \
+                    "  UPDATE replies_inbox AS I SET datetime = R.datetime, parentid = R.parentid FROM R " \
+                    "  WHERE I.commentid = R.commentid AND I.userid = R.owner " \
+                    "  AND (I.datetime, I.parentid) IS DISTINCT FROM (R.datetime, R.parentid)" \
+                    "), Z AS (" \
+                    "  INSERT INTO replies_inbox (userid, commentid, datetime, parentid) " \
+                    "  SELECT R.owner, R.commentid, R.datetime, R.parentid FROM R " \
+                    "  WHERE NOT EXISTS(SELECT 1 FROM replies_inbox AS I " \
+                    "                   WHERE I.commentid = R.commentid AND I.userid = R.owner)" \
+                    ") " \
+                    "SELECT * FROM U"
+        cur.execute("SET timezone = 'Europe/Moscow'; " + query + ";", values + [comment_id] + values)
+        rec = cur.fetchone()
         conn.commit()
         cur.close()
     except psycopg2.DatabaseError as e:
         raise DatabaseException(e)
+    if rec is None:
+        return 0
+
+    # noinspection PyArgumentList
+    old = Comment(*rec[:7]).dict
+    record = dict(zip(Comment.data_fields, rec[8:]))
+    redis = redis or redis_conn()
+    ancestors = thread_ancestors(conn, old['parentid'])
+    threads = ancestors
+    if record['parentid'] != old['parentid']:
+        # Комментарий перенесён вместе со своей ветвью — меняются обе ветви
+        threads = ancestors + thread_ancestors(conn, record['parentid'])
+    bump_versions(redis, [old['entityid'], old['parentid'], record['parentid']], threads=threads)
 
     # Поддержка Server-Sent Events
-    if cnt == 1:
-        channel = 'first_level_changed:%d' % comment['parentid']
-        message = {
-            'action': 'update_comment',
-            'now': datetime.datetime.now(tz=tzlocal()).isoformat(),
-            'record': data,
-            'old_record': comment
-        }
-        redis_publish(redis or redis_conn(), channel, message)
+    old['author'] = {'userid': old['userid'], 'name': rec[7]}
+    message = event_message('update_comment', comment_id, old['entityid'], record=record, old_record=old)
+    publish_event(redis, old['parentid'], message, subtree_ancestors(ancestors))
 
-    return cnt
+    return 1
 
 
-def first_level_comments(conn, comment_id: int, offset: int = 0, limit: int = 100) -> Tuple[int, List[Dict[str, Any]]]:
+def first_level_comments(conn, comment_id: int, offset: int = 0, limit: int = 100,
+                         fields: Optional[List[str]] = None) -> Tuple[int, List[Dict[str, Any]]]:
     """
     Показать комментарии первого уровня вложенности к указанному комментарию в порядке возрастания даты создания
     комментария.
@@ -213,17 +410,40 @@ def first_level_comments(conn, comment_id: int, offset: int = 0, limit: int = 10
     :param int comment_id: Идентификатор родительского комментария
     :param int offset: Начало отсчета, по умолчанию 0
     :param int limit: Количество результатов, по умолчанию максимум = 100
+    :param list fields: Проекция полей (см. :func:`app.common.fields_filter`), по умолчанию все поля
     :return: Общее количество и Список комментариев первого уровня вложенности
     :rtype: tuple
     """
     comment = get_comment(conn, comment_id)
     if comment is None:
         return 0, []
-    return entity_first_level_comments(conn, comment['entityid'], offset, limit)
+    return entity_first_level_comments(conn, comment['entityid'], offset, limit, fields)
+
+
+def thread(conn, comment_id: int, offset: int = 0, limit: int = 100, replies: int = 3) -> \
+        Tuple[int, List[Dict[str, Any]]]:
+    """
+    Страница обсуждения: комментарии первого уровня к указанному комментарию вместе с первыми ответами на каждый из них.
+
+    Поддерживается пагинация :func:`app.common.pagination`.
+
+    :param conn: Psycopg2 соединение
+    :param int comment_id: Идентификатор родительского комментария
+    :param int offset: Начало отсчета, по умолчанию 0
+    :param int limit: Количество результатов, по умолчанию максимум = 100
+    :param int replies: Количество ответов на каждый комментарий, по умолчанию 3
+    :return: Общее количество и Список комментариев первого уровня с ответами (см. :func:`app.common.entity_thread`)
+    :rtype: tuple
+    """
+    comment = get_comment(conn, comment_id)
+    if comment is None:
+        return 0, []
+    return entity_thread(conn, comment['entityid'], offset, limit, replies)
 
 
 def descendants(conn, comment_id: int, after: Optional[datetime.datetime] = None,
-                before: Optional[datetime.datetime] = None) -> Iterator:
+                before: Optional[datetime.datetime] = None, max_depth: Optional[int] = None,
+                per_parent_limit: Optional[int] = None, fields: Optional[List[str]] = None) -> Iterator:
     """
     Все дочерние комментарии для указанного родительского.
 
@@ -231,10 +451,97 @@ def descendants(conn, comment_id: int, after: Optional[datetime.datetime] = None
     :param int comment_id: Идентификатор родительского комментария
     :param datetime after: Опциональная фильтрация по дате *после* указанной
     :param datetime before: Опциональная фильтрация по дате *до* указанной
+    :param int max_depth: Максимальная глубина вложенности, по умолчанию не ограничена
+    :param int per_parent_limit: Максимальное количество ответов на каждый комментарий, по умолчанию не ограничено
+    :param list fields: Проекция полей (см. :func:`app.common.fields_filter`), по умолчанию все поля
     :return: Итератор всех дочерних комментариев
     :rtype: iterator
     """
     comment = get_comment(conn, comment_id)
     if comment is None:
         raise StopIteration
-    return entity_descendants(conn, comment['entityid'], after, before)
+    return entity_descendants(conn, comment['entityid'], after, before, max_depth=max_depth,
+                              per_parent_limit=per_parent_limit, fields=fields)
+
+
+def stats(conn, comment_id: int, after: Optional[datetime.datetime] = None, before: Optional[datetime.datetime] = None,
+          interval: str = 'day') -> Optional[Dict[str, Any]]:
+    """
+    Статистика всех комментариев ветви указанного комментария (см. :func:`app.common.entity_stats`).
+
+    :param conn: Psycopg2 соединение
+    :param int comment_id: Идентификатор родительского комментария
+    :param datetime after: Опциональная фильтрация по дате *после* указанной
+    :param datetime before: Опциональная фильтрация по дате *до* указанной
+    :param str interval: Интервал группировки активности, по умолчанию *day*
+    :return: Статистика ветви либо None, если комментарий не найден
+    :rtype: dict
+    """
+    comment = get_comment(conn, comment_id)
+    if comment is None:
+        return None
+    return entity_stats(conn, comment['entityid'], after, before, interval)
+
+
+def _history_record(rec: Dict[str, Any]) -> Dict[str, Any]:
+    rec['author'] = {'userid': rec.pop('userid'), 'name': rec.pop('name')}
+    rec['changed_by'] = {'userid': rec.pop('ch_userid'), 'name': rec.pop('ch_name')}
+    rec['changed_at'] = rec.pop('ch_datetime')
+    rec['version_id'] = rec.pop('id')
+    return rec
+
+
+_HISTORY_QUERY = "SELECT H.entityid, H.commentid, H.userid, H.datetime, H.parentid, H.text, H.deleted, " \
+                 "H.ch_datetime, H.ch_userid, H.id, U.name, E.name AS ch_name " \
+                 "FROM comment_history(%s) AS H " \
+                 "LEFT JOIN users AS U ON U.userid = H.userid " \
+                 "LEFT JOIN users AS E ON E.userid = H.ch_userid"
+
+
+def history(conn, comment_id: int, offset: int = 0, limit: int = 100) -> Tuple[int, List[Dict[str, Any]]]:
+    """
+    История правок *Комментария* (:class:`app.comments.Comment`): текущее состояние и все предыдущие версии, начиная
+    с последней.
+
+    Поддерживается пагинация :func:`app.common.pagination`.
+
+    :param conn: Psycopg2 соединение
+    :param int comment_id: Идентификатор комментария
+    :param int offset: Начало отсчета, по умолчанию 0
+    :param int limit: Количество результатов, по умолчанию максимум = 100
+    :return: Общее количество версий и Список версий комментария
+    :rtype: tuple
+    """
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    # Версии считаются по индексу comments_history_commentid_ch_datetime_index без обращения к самой таблице
+    cur.execute("SELECT (SELECT COUNT(*) FROM comments WHERE commentid = %s) "
+                "+ (SELECT COUNT(*) FROM comments_history WHERE commentid = %s) AS count;", [comment_id, comment_id])
+    total = cur.fetchone()['count']
+    if not total:
+        cur.close()
+        return 0, []
+    cur.execute("SET timezone = 'Europe/Moscow';")
+    cur.execute(_HISTORY_QUERY + " LIMIT %s OFFSET %s;", [comment_id, limit, offset])
+    versions = [_history_record(rec) for rec in cur.fetchall()]
+    cur.close()
+    return total, versions
+
+
+def history_stream(conn, comment_id: int, batch_size: int = 50) -> Iterator:
+    """
+    Вся история правок *Комментария* (:class:`app.comments.Comment`), см. :func:`history`.
+
+    :param conn: Psycopg2 соединение
+    :param int comment_id: Идентификатор комментария
+    :param batch_size: Размер курсора, по умолчанию 50
+    :return: Итератор версий комментария
+    :rtype: iterator
+    """
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.itersize = batch_size
+    cur.execute("SET timezone = 'Europe/Moscow';")
+    cur.execute(_HISTORY_QUERY + ";", [comment_id])
+    for rec in cur:
+        yield _history_record(rec)
+    cur.close()
+    conn.commit()
@@ -1,9 +1,12 @@
 import collections
 import csv
 import datetime
+import functools
 import json
+import time
+import zlib
 from io import StringIO
-from typing import Dict, Any, Tuple, List, Iterator, Optional
+from typing import Dict, Any, Tuple, List, Iterator, Optional, Callable, Iterable
 
 import dateutil.parser
 import flask
@@ -13,6 +16,8 @@ import xmltodict
 from flask import current_app as app, request
 from psycopg2.extras import RealDictCursor
 
+from app.authors import authors, USERS_KEY
+
 
 # region Exceptions
 class AnyCommentException(Exception):
@@ -41,8 +46,16 @@ def db_conn():
     return psycopg2.connect(app.config['DB_URI'])
 
 
+_redis_pools = {}
+"""Пулы соединений Redis процесса по адресу сервера."""
+
+
 def redis_conn():
-    return redis.StrictRedis.from_url(app.config['REDIS_URI'], charset='utf-8')
+    uri = app.config['REDIS_URI']
+    pool = _redis_pools.get(uri)
+    if pool is None:
+        pool = _redis_pools.setdefault(uri, redis.ConnectionPool.from_url(uri, charset='utf-8'))
+    return redis.StrictRedis(connection_pool=pool)
 
 
 def redis_publish(conn, channel, message):
@@ -90,8 +103,11 @@ def to_json_stream(it: Iterator) -> Iterator:
     yield "]\n"
 
 
+JSON_MIMETYPE = "application/json; charset=utf-8"
+
+
 def resp(code, data: Dict[str, Any]):
-    return flask.Response(status=code, mimetype="application/json; charset=utf-8", response=to_json(data))
+    return flask.Response(status=code, mimetype=JSON_MIMETYPE, response=to_json(data))
 
 
 def affected_num_to_code(cnt: int, code: int = 404) -> int:
@@ -111,36 +127,172 @@ def attach_streamed_xml(it: Iterator) -> Iterator:
     yield '</response>\n'
 
 
-def attach_streamed_csv(it: Iterator) -> Iterator:
+def attach_streamed_csv(it: Iterator, columns: Optional[List[str]] = None) -> Iterator:
     first = True
     header = []
+    if columns is not None:
+        # Состав столбцов известен заранее (проекция полей) — заголовок выдаётся даже для пустой выгрузки
+        output = StringIO()
+        header = list(columns)
+        csv.writer(output, delimiter=';').writerow(header)
+        yield output.getvalue().encode('windows-1251')
+        first = False
     for rec in it:
-        rec['deleted'] = rec['deleted'] is True and 1 or 0
+        if 'deleted' in rec:
+            rec['deleted'] = rec['deleted'] is True and 1 or 0
         rec = flatten(rec)
         output = StringIO()
         w = csv.writer(output, delimiter=';')
         if first:
             [header.append(n) for n in rec]
             w.writerow(header)
-        w.writerow([str(rec[n]) for n in header])
+        w.writerow([str(rec.get(n, '')) for n in header])
         yield output.getvalue().encode('windows-1251')
         first = False
 
 
+def compression_level() -> int:
+    """Уровень сжатия потоков из параметра ``STREAM_COMPRESSION_LEVEL`` (1–9)."""
+    return flask.has_app_context() and app.config.get('STREAM_COMPRESSION_LEVEL', 6) or 6
+
+
+def compress_stream(it: Iterator, encoding: str = 'gzip', level: int = 6) -> Iterator:
+    """
+    Инкрементальное сжатие потока.
+
+    После каждого фрагмента выполняется ``Z_SYNC_FLUSH``: клиент может распаковать всё уже полученное, не дожидаясь
+    конца потока, поэтому время до первого байта не растёт, а повторяющиеся от записи к записи имена полей и значения
+    сжимаются общим словарём всего потока.
+
+    :param it: Поток фрагментов (строки кодируются в UTF-8)
+    :param str encoding: Способ сжатия: *gzip* либо *deflate* (zlib-формат, как того требует HTTP)
+    :param int level: Уровень сжатия
+    :return: Поток сжатых фрагментов
+    :rtype: iterator
+    """
+    wbits = encoding == 'gzip' and 16 + zlib.MAX_WBITS or zlib.MAX_WBITS
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    for chunk in it:
+        data = compressor.compress(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+        data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _gzipped(streamer: Callable[..., Iterator]) -> Callable[..., Iterator]:
+    def iterate(it: Iterator, **kwargs) -> Iterator:
+        return compress_stream(streamer(it, **kwargs), 'gzip', compression_level())
+
+    return iterate
+
+
+def negotiate_encoding() -> Optional[str]:
+    """
+    Выбор способа сжатия потокового ответа по заголовку ``Accept-Encoding`` запроса.
+
+    :return: *gzip*, *deflate* либо None, если клиент не принимает сжатие или оно отключено (``STREAM_COMPRESSION``)
+    :rtype: str
+    """
+    if not app.config.get('STREAM_COMPRESSION', True):
+        return None
+    return request.accept_encodings.best_match(['gzip', 'deflate'])
+
+
+FLUSH = b''
+"""Пустой фрагмент в потоке — метка «отдать клиенту всё накопленное немедленно»."""
+
+
+def buffered(it: Iterator, size: int = 16384, latency: float = 0.5) -> Iterator:
+    """
+    Объединение мелких фрагментов потока в крупные.
+
+    Стримеры отдают по фрагменту на запись, и без объединения сервер делает по записи в сокет (и по кадру chunked
+    encoding) на каждый комментарий. Накопленное отдаётся, когда набрано ``size`` байт, когда с момента первого
+    неотданного фрагмента прошло больше ``latency`` секунд (проверяется при поступлении очередного фрагмента), по
+    метке :data:`FLUSH` и в конце потока.
+
+    :param it: Поток фрагментов (строки кодируются в UTF-8)
+    :param int size: Размер отдаваемого фрагмента в байтах, ``0`` отключает объединение
+    :param float latency: Максимальное время удержания данных в секундах
+    :return: Поток байтовых фрагментов
+    :rtype: iterator
+    """
+    chunks, length, started = [], 0, None
+    for chunk in it:
+        if not chunk:
+            if chunks:
+                yield b''.join(chunks)
+                chunks, length = [], 0
+            continue
+        data = chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+        if size <= 0:
+            yield data
+            continue
+        if not chunks:
+            started = time.monotonic()
+        chunks.append(data)
+        length += len(data)
+        if length >= size or time.monotonic() - started >= latency:
+            yield b''.join(chunks)
+            chunks, length = [], 0
+    if chunks:
+        yield b''.join(chunks)
+
+
+def stream_response(it: Iterator, mimetype: str, headers: Optional[Dict[str, str]] = None,
+                    compress: bool = True) -> flask.Response:
+    """
+    Потоковый ответ со сжатием, согласованным с клиентом по ``Accept-Encoding``.
+
+    Фрагменты потока предварительно объединяются :func:`buffered` до ``STREAM_CHUNK_SIZE`` байт с задержкой не более
+    ``STREAM_MAX_LATENCY`` секунд.
+
+    :param it: Поток фрагментов тела ответа
+    :param str mimetype: Тип содержимого
+    :param dict headers: Дополнительные заголовки ответа
+    :param bool compress: Сжимать ли поток (не нужно для уже сжатых форматов)
+    :return: Ответ
+    """
+    headers = dict(headers or {})
+    it = buffered(it, int(app.config.get('STREAM_CHUNK_SIZE', 16384)),
+                  float(app.config.get('STREAM_MAX_LATENCY', 0.5)))
+    encoding = compress and negotiate_encoding() or None
+    if encoding:
+        it = compress_stream(it, encoding, compression_level())
+        headers['Content-Encoding'] = encoding
+    if compress:
+        headers['Vary'] = 'Accept-Encoding'
+    return flask.Response(flask.stream_with_context(it), mimetype=mimetype, headers=headers)
+
+
 class AttachmentManager:
     """Стратегия выбора стримингового формата."""
     _extensions = {
         'json': {'streamer': to_json_stream, 'mime': 'application/json', 'charset': 'utf-8'},
         'xml': {'streamer': attach_streamed_xml, 'mime': 'application/xml', 'charset': 'utf-8'},
-        'csv': {'streamer': attach_streamed_csv, 'mime': 'text/csv', 'charset': 'windows-1251'},
+        'csv': {'streamer': attach_streamed_csv, 'mime': 'text/csv', 'charset': 'windows-1251', 'columns': True},
+        'json.gz': {'streamer': _gzipped(to_json_stream), 'mime': 'application/gzip', 'charset': None},
+        'xml.gz': {'streamer': _gzipped(attach_streamed_xml), 'mime': 'application/gzip', 'charset': None},
+        'csv.gz': {'streamer': _gzipped(attach_streamed_csv), 'mime': 'application/gzip', 'charset': None,
+                   'columns': True},
     }
 
-    def __init__(self, fmt):
+    def __init__(self, fmt, fields: Optional[List[str]] = None):
+        """
+        :param str fmt: Формат выгрузки
+        :param list fields: Проекция полей комментария (см. :func:`fields_filter`) — задаёт столбцы CSV
+        :raises ValueError: Формат не поддерживается
+        """
         if fmt not in self.__class__._extensions:
-            raise NotImplemented('Extension "%s" not implemented!' % fmt)
+            raise ValueError('Extension "%s" not implemented!' % fmt)
         formatter = self.__class__._extensions[fmt]
         self.iterate = formatter['streamer']
-        self.content_type = '%s; charset=%s' % (formatter['mime'], formatter['charset'])
+        if fields is not None and formatter.get('columns'):
+            self.iterate = functools.partial(formatter['streamer'], columns=comment_csv_columns(fields))
+        self.content_type = formatter['charset'] and '%s; charset=%s' % (formatter['mime'], formatter['charset']) or \
+            formatter['mime']
+        self.compressed = fmt.endswith('.gz')
 
     def iterate(self, it: Iterator) -> Iterator:
         pass
@@ -204,6 +356,217 @@ def date_filter() -> Tuple[Optional[datetime.datetime], Optional[datetime.dateti
     return after, before, errors
 
 
+def tree_limits() -> Tuple[Optional[int], Optional[int], List[Dict[str, Any]]]:
+    """
+    Определение ограничений выборки дерева комментариев из Query String запроса.
+
+    Параметры:
+        - max_depth (int) — Максимальная глубина вложенности комментариев, начиная с 1, может быть пропущен.
+        - per_parent_limit (int) — Максимальное количество ответов (первых по дате создания) на каждый комментарий и
+          на саму сущность, может быть пропущен.
+    :return: Глубина, Количество ответов, а также возникшие ошибки
+    :rtype: tuple
+    """
+    args = request.args.to_dict()
+    limits = []
+    errors = []
+    for name in ['max_depth', 'per_parent_limit']:
+        value = args.get(name, None)
+        if value is None or value == '':
+            limits.append(None)
+            continue
+        try:
+            value = int(value)
+            if value < 1:
+                raise ValueError
+        except ValueError:
+            errors.append({'error': 'Ожидалось целое положительное число', name: value})
+            value = None
+        limits.append(value)
+    return limits[0], limits[1], errors
+
+
+ACTIVITY_INTERVALS = ['hour', 'day', 'week', 'month']
+"""Допустимые интервалы группировки активности в статистике ветви (см. :func:`entity_stats`)."""
+
+
+def activity_interval() -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Определение интервала группировки активности в статистике ветви из Query String запроса.
+
+    Параметры:
+        - interval (str) — Один из :data:`ACTIVITY_INTERVALS`, по умолчанию *day*.
+    :return: Интервал, а также возникшие ошибки
+    :rtype: tuple
+    """
+    value = request.args.get('interval', 'day')
+    if value not in ACTIVITY_INTERVALS:
+        return 'day', [{'error': 'Неизвестный интервал', 'interval': value, 'available': ACTIVITY_INTERVALS}]
+    return value, []
+
+
+def replies_limit() -> Tuple[int, List[Dict[str, Any]]]:
+    """
+    Определение количества ответов, выдаваемых на каждый комментарий страницы обсуждения, из Query String запроса.
+
+    Параметры:
+        - replies (int) — Количество первых по дате ответов на каждый комментарий, по умолчанию 3. Максимальное
+          значение 100, 0 — только количество ответов.
+    :return: Количество ответов, а также возникшие ошибки
+    :rtype: tuple
+    """
+    value = request.args.get('replies', '3')
+    try:
+        value = int(value)
+        if value < 0:
+            raise ValueError
+    except ValueError:
+        return 3, [{'error': 'Ожидалось целое неотрицательное число', 'replies': value}]
+    return min(value, 100), []
+
+
+def ids_filter(name: str = 'ids') -> Tuple[Optional[List[int]], List[Dict[str, Any]]]:
+    """
+    Определение списка запрашиваемых идентификаторов из Query String запроса.
+
+    Параметры:
+        - ids (str) — Идентификаторы через запятую, не более ``BATCH_MAX_IDS`` (по умолчанию 500). Порядок и повторы
+          сохраняются.
+    :param str name: Имя параметра, по умолчанию *ids*
+    :return: Список идентификаторов либо None, если параметр не задан, а также возникшие ошибки
+    :rtype: tuple
+    """
+    value = request.args.get(name, None)
+    if value is None:
+        return None, []
+    try:
+        ids = [int(x) for x in value.split(',') if x.strip()]
+    except ValueError:
+        return None, [{'error': 'Ожидался список целых чисел через запятую', name: value}]
+    max_ids = int(app.config.get('BATCH_MAX_IDS', 500))
+    if len(ids) > max_ids:
+        return None, [{'error': 'Запрошено слишком много идентификаторов', 'max': max_ids}]
+    return ids, []
+
+
+COMMENT_FIELDS = ['entityid', 'commentid', 'datetime', 'parentid', 'text', 'deleted', 'author']
+"""Поля записи комментария в порядке выдачи; *author* — идентификатор и имя автора из таблицы пользователей."""
+
+
+def fields_filter() -> Tuple[Optional[List[str]], List[Dict[str, Any]]]:
+    """
+    Определение проекции полей комментария из Query String запроса.
+
+    Параметры:
+        - fields (str) — Поля комментария через запятую из :data:`COMMENT_FIELDS`, может быть пропущен. Порядок
+          полей в выдаче всегда один и тот же, повторы игнорируются.
+    :return: Список полей либо None, если выдаются все поля, а также возникшие ошибки
+    :rtype: tuple
+    """
+    value = request.args.get('fields', None)
+    if value is None or not value.strip():
+        return None, []
+    names = {x.strip() for x in value.split(',') if x.strip()}
+    unknown = sorted(names - set(COMMENT_FIELDS))
+    if unknown:
+        return None, [{'error': 'Неизвестные поля', 'fields': unknown, 'available': COMMENT_FIELDS}]
+    return [x for x in COMMENT_FIELDS if x in names], []
+
+
+def comment_columns(fields: Optional[List[str]], alias: str = 'C', extra: List[str] = ()) -> str:
+    """
+    Перечень столбцов комментария для SELECT для заданной проекции полей.
+
+    Для поля *author* выбирается только идентификатор автора, имя подставляет :func:`fill_authors`.
+
+    :param list fields: Проекция полей (см. :func:`fields_filter`), None — все поля
+    :param str alias: Алиас таблицы комментариев
+    :param list extra: Дополнительные столбцы, выбираемые при любой проекции
+    :return: Перечень столбцов
+    :rtype: str
+    """
+    fields = fields or COMMENT_FIELDS
+    columns = [alias + '.' + x for x in fields if x != 'author'] + list(extra)
+    if 'author' in fields:
+        columns.append(alias + '.userid')
+    return ', '.join(columns)
+
+
+def users_version() -> Optional[bytes]:
+    """
+    Текущая версия пользователей (:data:`app.authors.USERS_KEY`), в пределах запроса читается из Redis один раз.
+
+    None вне приложения, а также если Redis недоступен — тогда имена авторов читаются из базы данных.
+    """
+    if not flask.has_app_context():
+        return None
+    in_request = flask.has_request_context()
+    if in_request and 'users_version' in flask.g:
+        return flask.g.users_version
+    try:
+        version = redis_conn().get(USERS_KEY) or b'0'
+    except redis.RedisError:
+        version = None
+    if in_request:
+        flask.g.users_version = version
+    return version
+
+
+def author_names(conn, user_ids: Iterable[int]) -> Dict[int, Optional[str]]:
+    """
+    Имена авторов из кэша имён процесса (:data:`app.authors.authors`), недостающие — одним запросом.
+
+    :param conn: Psycopg2 соединение
+    :param user_ids: Идентификаторы пользователей
+    :return: Словарь идентификатор → имя
+    :rtype: dict
+    """
+    return authors.names(conn, user_ids, users_version())
+
+
+def fill_authors(conn, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Сборка поля *author* записей комментариев из столбца *userid* и имени из :func:`author_names`.
+
+    :param conn: Psycopg2 соединение
+    :param list records: Записи комментариев (изменяются на месте)
+    :return: Те же записи
+    :rtype: list
+    """
+    user_ids = {rec['userid'] for rec in records if 'userid' in rec}
+    if not user_ids:
+        return records
+    names = author_names(conn, user_ids)
+    for rec in records:
+        if 'userid' in rec:
+            user_id = rec.pop('userid')
+            rec['author'] = {'userid': user_id, 'name': names.get(user_id)}
+    return records
+
+
+def warm_authors() -> None:
+    """Заполнение кэша имён процесса до первого запроса; размер кэша — ``AUTHOR_CACHE_SIZE``."""
+    authors.size = int(app.config.get('AUTHOR_CACHE_SIZE', 10000))
+    if authors.size <= 0:
+        return
+    version = users_version()
+    if version is None:
+        return
+    conn = db_conn()
+    try:
+        authors.warm(conn, version)
+    finally:
+        conn.close()
+
+
+def comment_csv_columns(fields: Optional[List[str]]) -> List[str]:
+    """Столбцы CSV-выгрузки комментариев для заданной проекции полей."""
+    columns = []
+    for name in fields or COMMENT_FIELDS:
+        columns.extend(name == 'author' and ['author_userid', 'author_name'] or [name])
+    return columns
+
+
 def sql_date_filter(after: Optional[datetime.datetime], before: Optional[datetime.datetime], table: str,
                     field: str = 'datetime') -> Tuple[str, List[datetime.datetime]]:
     """
@@ -227,8 +590,8 @@ def sql_date_filter(after: Optional[datetime.datetime], before: Optional[datetim
     return ' AND '.join(filters), filter_values
 
 
-def entity_first_level_comments(conn, entityid: int, offset: int = 0, limit: int = 100) -> \
-        Tuple[int, List[Dict[str, Any]]]:
+def entity_first_level_comments(conn, entityid: int, offset: int = 0, limit: int = 100,
+                                fields: Optional[List[str]] = None) -> Tuple[int, List[Dict[str, Any]]]:
     """
     Показать комментарии первого уровня вложенности к указанной сущности в порядке возрастания даты создания
     комментария.
@@ -239,6 +602,7 @@ def entity_first_level_comments(conn, entityid: int, offset: int = 0, limit: int
     :param int entityid: Идентификатор родительской сущности
     :param int offset: Начало отсчета, по умолчанию 0
     :param int limit: Количество результатов, по умолчанию максимум = 100
+    :param list fields: Проекция полей комментария (см. :func:`fields_filter`), по умолчанию все поля
     :return: Общее количество и Список комментариев первого уровня вложенности
     :rtype: tuple
     """
@@ -246,30 +610,104 @@ def entity_first_level_comments(conn, entityid: int, offset: int = 0, limit: int
     cur.execute("SELECT COUNT(entityid) FROM comments WHERE parentid = %s AND deleted = %s;", [entityid, False])
     total = cur.fetchone()['count']
     cur.execute("SET timezone = 'Europe/Moscow';")
-    cur.execute("SELECT C.entityid, C.commentid, C.userid, C.datetime, C.parentid, C.text, C.deleted, U.name "
+    cur.execute("SELECT " + comment_columns(fields) + " "
                 "FROM comments AS C "
-                "LEFT JOIN users AS U ON U.userid = C.userid "
-                "WHERE parentid = %s AND deleted = %s "
+                "WHERE C.parentid = %s AND C.deleted = %s "
                 "ORDER BY C.datetime ASC "
                 "LIMIT %s OFFSET %s;", [entityid, False, limit, offset])
+    comments = fill_authors(conn, cur.fetchall())
+    cur.close()
+    return total, comments
+
+
+def entity_thread(conn, entity_id: int, offset: int = 0, limit: int = 100, replies: int = 3) -> \
+        Tuple[int, List[Dict[str, Any]]]:
+    """
+    Страница комментариев первого уровня к указанной сущности вместе с первыми ответами на каждый из них.
+
+    Всё выбирается одним запросом: страница первого уровня, для каждого её комментария — ``LATERAL``-выборка первых
+    по дате ответов с ``LIMIT`` и подсчёт всех ответов по частичному индексу живых комментариев. Клиенту не нужно
+    отдельно запрашивать первый уровень каждого комментария страницы.
+
+    Поддерживается пагинация :func:`app.common.pagination`.
+
+    :param conn: Psycopg2 соединение
+    :param int entity_id: Идентификатор родительской сущности
+    :param int offset: Начало отсчета, по умолчанию 0
+    :param int limit: Количество результатов, по умолчанию максимум = 100
+    :param int replies: Количество ответов на каждый комментарий, по умолчанию 3
+    :return: Общее количество и Список комментариев первого уровня с полями *replies* (первые ответы) и
+        *replies_total* (количество всех ответов)
+    :rtype: tuple
+    """
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute("SET timezone = 'Europe/Moscow';")
+    # noinspection SqlResolve
+    cur.execute("WITH page AS ("
+                "  SELECT C.entityid, C.commentid, C.userid, C.datetime, C.parentid, C.text, C.deleted "
+                "  FROM comments AS C "
+                "  WHERE C.parentid = %s AND C.deleted = FALSE "
+                "  ORDER BY C.datetime ASC "
+                "  LIMIT %s OFFSET %s) "
+                "SELECT T.total, P.entityid, P.commentid, P.userid, P.datetime, P.parentid, P.text, P.deleted, "
+                "  RC.replies_total, R.entityid AS r_entityid, R.commentid AS r_commentid, "
+                "  R.userid AS r_userid, R.datetime AS r_datetime, R.parentid AS r_parentid, R.text AS r_text, "
+                "  R.deleted AS r_deleted "
+                "FROM (SELECT COUNT(entityid) AS total FROM comments WHERE parentid = %s AND deleted = FALSE) AS T "
+                "  LEFT JOIN page AS P ON TRUE "
+                "  LEFT JOIN LATERAL (SELECT COUNT(X.entityid) AS replies_total "
+                "                     FROM comments AS X "
+                "                     WHERE X.parentid = P.entityid AND X.deleted = FALSE) AS RC ON TRUE "
+                "  LEFT JOIN LATERAL (SELECT X.entityid, X.commentid, X.userid, X.datetime, X.parentid, X.text, "
+                "                       X.deleted "
+                "                     FROM comments AS X "
+                "                     WHERE X.parentid = P.entityid AND X.deleted = FALSE "
+                "                     ORDER BY X.datetime ASC "
+                "                     LIMIT %s) AS R ON TRUE "
+                "ORDER BY P.datetime ASC, P.entityid, R.datetime ASC;", [entity_id, limit, offset, entity_id, replies])
+    total = 0
     comments = []
     for rec in cur.fetchall():
-        rec['author'] = {'userid': rec.pop('userid'), 'name': rec.pop('name')}
-        comments.append(rec)
+        total = rec.pop('total')
+        if rec['entityid'] is None:
+            continue
+        reply = {k[2:]: rec.pop(k) for k in list(rec) if k.startswith('r_')}
+        if not comments or comments[-1]['entityid'] != rec['entityid']:
+            rec['author'] = {'userid': rec.pop('userid')}
+            rec['replies'] = []
+            comments.append(rec)
+        if reply['entityid'] is not None:
+            reply['author'] = {'userid': reply.pop('userid')}
+            comments[-1]['replies'].append(reply)
     cur.close()
+    records = comments + [reply for rec in comments for reply in rec['replies']]
+    names = author_names(conn, {rec['author']['userid'] for rec in records})
+    for rec in records:
+        rec['author']['name'] = names.get(rec['author']['userid'])
+    conn.commit()
     return total, comments
 
 
 def entity_descendants(conn, entity_id: int, after: Optional[datetime.datetime] = None,
-                       before: Optional[datetime.datetime] = None, batch_size: int = 50) -> Iterator:
+                       before: Optional[datetime.datetime] = None, batch_size: int = 50,
+                       max_depth: Optional[int] = None, per_parent_limit: Optional[int] = None,
+                       fields: Optional[List[str]] = None) -> Iterator:
     """
     Все дочерние комментарии для указанной сущности.
 
+    При заданных ``max_depth`` или ``per_parent_limit`` дерево выбирается функцией ``comments_tree_limited()``: рекурсия
+    останавливается на заданной глубине, а на каждый комментарий берутся только первые по дате ответы. Каждая запись
+    тогда дополнительно содержит поля *depth* (уровень вложенности, начиная с 1) и *hidden_replies* (количество
+    ответов на комментарий, не попавших в выдачу).
+
     :param conn: Psycopg2 соединение
     :param entity_id: Идентификатор родительской сущности
     :param datetime after: Опциональная фильтрация по дате *после* указанной
     :param datetime before: Опциональная фильтрация по дате *до* указанной
     :param batch_size: Размер курсора, по умолчанию 50
+    :param int max_depth: Максимальная глубина вложенности, по умолчанию не ограничена
+    :param int per_parent_limit: Максимальное количество ответов на каждый комментарий, по умолчанию не ограничено
+    :param list fields: Проекция полей комментария (см. :func:`fields_filter`), по умолчанию все поля
     :return: Итератор всех дочерних комментариев
     :rtype: iterator
     """
@@ -278,18 +716,101 @@ def entity_descendants(conn, entity_id: int, after: Optional[datetime.datetime]
     cur.execute("SET timezone = 'Europe/Moscow';")
     dtf_clause, dtf_values = sql_date_filter(after, before, 'C')
 
-    # noinspection SqlResolve
-    query = "SELECT C.entityid, C.commentid, C.userid, C.datetime, C.parentid, C.text, C.deleted, U.name " \
-            "FROM comments_tree(%s) AS C " \
-            "LEFT JOIN users AS U ON U.userid = C.userid WHERE C.deleted = FALSE"
+    if max_depth is None and per_parent_limit is None:
+        # noinspection SqlResolve
+        query = "SELECT " + comment_columns(fields) + " FROM comments_tree(%s) AS C WHERE C.deleted = FALSE"
+        values = [entity_id]
+    else:
+        # noinspection SqlResolve
+        query = "SELECT " + comment_columns(fields, extra=['C.depth', 'C.hidden_replies']) + " " \
+                "FROM comments_tree_limited(%s, %s, %s) AS C WHERE C.deleted = FALSE"
+        values = [entity_id, max_depth, per_parent_limit]
     if dtf_clause:
         query += ' AND ' + dtf_clause
     query += ';'
 
     # noinspection PyTypeChecker
-    cur.execute(query, [entity_id] + dtf_values)
-    for rec in cur:
-        rec['author'] = {'userid': rec.pop('userid'), 'name': rec.pop('name')}
-        yield rec
+    cur.execute(query, values + dtf_values)
+    # Имена авторов подставляются пачками: на пачку не больше одного запроса к таблице пользователей
+    while True:
+        batch = cur.fetchmany(batch_size)
+        if not batch:
+            break
+        for rec in fill_authors(conn, batch):
+            yield rec
+    cur.close()
+    conn.commit()
+
+
+def entity_stats(conn, entity_id: int, after: Optional[datetime.datetime] = None,
+                 before: Optional[datetime.datetime] = None, interval: str = 'day') -> Dict[str, Any]:
+    """
+    Статистика ветви комментариев указанной сущности.
+
+    Всё считается одним проходом по дереву: рекурсивная выборка несёт только идентификатор, автора, дату и уровень
+    вложенности, а итоги по всей ветви и по интервалам времени получаются одной агрегацией с ``GROUPING SETS``.
+    Удалённые комментарии и их потомки не учитываются, как и в :func:`entity_descendants`.
+
+    Поля результата:
+        - total (int) — Количество комментариев
+        - first_level (int) — Количество комментариев первого уровня вложенности
+        - max_depth (int) — Максимальная глубина вложенности, 0 для пустой ветви
+        - participants (int) — Количество различных авторов
+        - first_comment, last_comment (datetime) — Даты первого и последнего комментария либо None
+        - activity (list) — По интервалам с комментариями в порядке возрастания: начало интервала *period*,
+          количество комментариев *comments* и авторов *participants*
+
+    :param conn: Psycopg2 соединение
+    :param int entity_id: Идентификатор родительской сущности
+    :param datetime after: Опциональная фильтрация по дате *после* указанной
+    :param datetime before: Опциональная фильтрация по дате *до* указанной
+    :param str interval: Интервал группировки активности, один из :data:`ACTIVITY_INTERVALS`
+    :return: Статистика ветви
+    :rtype: dict
+    """
+    dtf_clause, dtf_values = sql_date_filter(after, before, 'T')
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute("SET timezone = 'Europe/Moscow';")
+    # noinspection SqlResolve
+    cur.execute("WITH RECURSIVE t AS ("
+                "  SELECT C.entityid, C.userid, C.datetime, 1 AS depth "
+                "  FROM comments AS C "
+                "  WHERE C.parentid = %s AND C.deleted = FALSE "
+                "  UNION ALL "
+                "  SELECT C.entityid, C.userid, C.datetime, t.depth + 1 "
+                "  FROM comments AS C "
+                "    JOIN t ON C.parentid = t.entityid "
+                "  WHERE C.deleted = FALSE) "
+                "SELECT GROUPING(date_trunc(%s, T.datetime)) = 1 AS summary, date_trunc(%s, T.datetime) AS period, "
+                "  COUNT(T.entityid) AS total, COUNT(T.entityid) FILTER (WHERE T.depth = 1) AS first_level, "
+                "  COALESCE(MAX(T.depth), 0) AS max_depth, COUNT(DISTINCT T.userid) AS participants, "
+                "  MIN(T.datetime) AS first_comment, MAX(T.datetime) AS last_comment "
+                "FROM t AS T " + (dtf_clause and "WHERE " + dtf_clause + " " or "") +
+                "GROUP BY GROUPING SETS ((), (date_trunc(%s, T.datetime))) "
+                "ORDER BY summary DESC, period;", [entity_id, interval, interval] + dtf_values + [interval])
+    rows = cur.fetchall()
     cur.close()
     conn.commit()
+    stats = {k: v for k, v in rows[0].items() if k not in ['summary', 'period']}
+    stats['activity'] = [{'period': rec['period'], 'comments': rec['total'], 'participants': rec['participants']}
+                         for rec in rows[1:]]
+    return stats
+
+
+def entity_ancestors(conn, entity_id: int, limit: int = 100) -> List[int]:
+    """
+    Указанная сущность и все её предки вверх по дереву комментариев, вплоть до корневой сущности (поста или
+    пользователя).
+
+    :param conn: Psycopg2 соединение
+    :param int entity_id: Идентификатор сущности
+    :param int limit: Максимальное количество возвращаемых сущностей, по умолчанию 100
+    :return: Список идентификаторов сущностей, начиная с указанной
+    :rtype: list
+    """
+    cur = conn.cursor()
+    # noinspection SqlResolve
+    cur.execute("SELECT * FROM comment_ancestors(%s, %s);", [entity_id, limit])
+    ancestors = [rec[0] for rec in cur.fetchall()]
+    cur.close()
+    return ancestors
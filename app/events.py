@@ -0,0 +1,366 @@
+"""События об изменениях комментариев для подписчиков (Redis PubSub → Server-Sent Events)."""
+import atexit
+import collections
+import datetime
+import json
+import threading
+import weakref
+from typing import Dict, Any, Optional, List, Iterator, Tuple, Iterable
+
+from dateutil.tz import tzlocal
+from flask import current_app as app, has_app_context
+
+from app.common import redis_publish, FLUSH
+
+PAYLOAD_FULL = 'full'
+PAYLOAD_IDS = 'ids'
+
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_RESYNC = 'resync'
+OVERFLOW_DISCONNECT = 'disconnect'
+
+
+def setting(name: str, default: Any) -> Any:
+    """
+    Значение настройки приложения, либо значение по умолчанию если вызывается вне контекста приложения.
+
+    :param str name: Название параметра конфигурации
+    :param default: Значение по умолчанию
+    :return: Значение параметра
+    """
+    if has_app_context():
+        return app.config.get(name, default)
+    return default
+
+
+def first_level_channel(entity_id: int) -> str:
+    """Название канала изменений первого уровня комментариев сущности."""
+    return 'first_level_changed:%d' % entity_id
+
+
+def subtree_channel(entity_id: int) -> str:
+    """Название канала изменений во всём поддереве комментариев сущности."""
+    return 'subtree_changed:%d' % entity_id
+
+
+def event_message(action: str, comment_id: int, entity_id: int, record: Optional[Dict[str, Any]] = None,
+                  old_record: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Формирование сообщения о событии с учётом режима полезной нагрузки ``EVENTS_PAYLOAD``.
+
+    В режиме *ids* вместо полных записей передаются только идентификаторы комментария — клиент сам запрашивает
+    актуальные данные при необходимости.
+
+    :param str action: Вид события: *new_comment*, *update_comment*, *delete_comment*
+    :param int comment_id: Идентификатор комментария
+    :param int entity_id: Идентификатор сущности комментария
+    :param dict record: Новое состояние записи
+    :param dict old_record: Предыдущее состояние записи
+    :return: Сообщение для публикации
+    :rtype: dict
+    """
+    message = {
+        'action': action,
+        'now': datetime.datetime.now(tz=tzlocal()).isoformat(),
+    }
+    if setting('EVENTS_PAYLOAD', PAYLOAD_FULL) == PAYLOAD_IDS:
+        message['record'] = {'comment_id': comment_id, 'entity_id': entity_id}
+        return message
+    if record is not None:
+        message['record'] = record
+    if old_record is not None:
+        message['old_record'] = old_record
+    return message
+
+
+class _Batch:
+    def __init__(self, redis):
+        self.redis = redis
+        self.messages = []  # type: List[Dict[str, Any]]
+        self.timer = None  # type: Optional[threading.Timer]
+
+
+class EventCoalescer:
+    """
+    Объединение событий одного канала, возникших в пределах окна, в одно пакетное сообщение.
+
+    Окно открывается первым событием в канале и закрывается по истечении ``window`` секунд либо по накоплению
+    ``max_events`` событий — тогда в канал уходит одно сообщение с действием *batch*. Одиночное событие публикуется
+    как есть.
+    """
+
+    def __init__(self, window: float, max_events: int):
+        self.window = window
+        self.max_events = max_events
+        self._lock = threading.Lock()
+        self._pending = {}  # type: Dict[str, _Batch]
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0 and self.max_events > 1
+
+    def publish(self, redis, channel: str, message: Dict[str, Any]) -> None:
+        if not self.enabled:
+            redis_publish(redis, channel, message)
+            return
+        with self._lock:
+            batch = self._pending.get(channel)
+            if batch is None:
+                batch = self._pending[channel] = _Batch(redis)
+                batch.timer = threading.Timer(self.window, self.flush, [channel, batch])
+                batch.timer.daemon = True
+                batch.timer.start()
+            batch.messages.append(message)
+            full = len(batch.messages) >= self.max_events
+        if full:
+            self.flush(channel, batch)
+
+    def publish_many(self, redis, messages: List[Tuple[str, Dict[str, Any]]]) -> None:
+        """
+        Публикация сообщений в несколько каналов.
+
+        Без объединения событий все сообщения уходят в Redis одним конвейером (pipeline) за один сетевой обмен.
+
+        :param redis: Redis-соединение
+        :param list messages: Пары (канал, сообщение)
+        """
+        if self.enabled:
+            for channel, message in messages:
+                self.publish(redis, channel, message)
+            return
+        pipe = redis.pipeline(transaction=False)
+        for channel, message in messages:
+            redis_publish(pipe, channel, message)
+        pipe.execute()
+
+    def flush(self, channel: str, batch: Optional[_Batch] = None) -> None:
+        """
+        Публикация накопленных событий канала.
+
+        :param str channel: Название канала
+        :param batch: Конкретный пакет; если окно канала уже сменилось, то повторной публикации не будет
+        """
+        with self._lock:
+            current = self._pending.get(channel)
+            if current is None or (batch is not None and current is not batch):
+                return
+            del self._pending[channel]
+        if current.timer is not None:
+            current.timer.cancel()
+        if len(current.messages) == 1:
+            redis_publish(current.redis, channel, current.messages[0])
+            return
+        redis_publish(current.redis, channel, {
+            'action': 'batch',
+            'now': datetime.datetime.now(tz=tzlocal()).isoformat(),
+            'events': current.messages,
+        })
+
+    def flush_all(self) -> None:
+        with self._lock:
+            channels = list(self._pending)
+        for channel in channels:
+            self.flush(channel)
+
+
+_coalescer = None  # type: Optional[EventCoalescer]
+_coalescer_lock = threading.Lock()
+
+
+def coalescer() -> EventCoalescer:
+    """Общий для процесса объединитель событий, настраиваемый ``EVENTS_COALESCE_WINDOW`` и ``EVENTS_COALESCE_MAX``."""
+    global _coalescer
+    with _coalescer_lock:
+        if _coalescer is None:
+            _coalescer = EventCoalescer(float(setting('EVENTS_COALESCE_WINDOW', 0)),
+                                        int(setting('EVENTS_COALESCE_MAX', 100)))
+            atexit.register(_coalescer.flush_all)
+    return _coalescer
+
+
+def publish_event(redis, parent_id: int, message: Dict[str, Any], ancestors: Iterable[int] = ()) -> None:
+    """
+    Публикация события об изменении в первом уровне комментариев родительской сущности.
+
+    Событие также уходит в каналы поддеревьев родительской сущности и всех её предков — в них в сообщение добавляется
+    поле *parent_id*, указывающее где именно в поддереве произошло изменение.
+
+    :param redis: Redis-соединение
+    :param int parent_id: Идентификатор родительской сущности
+    :param dict message: Сообщение, см. :func:`event_message`
+    :param ancestors: Идентификаторы родительской сущности и её предков, см. :func:`app.common.entity_ancestors`
+    """
+    messages = [(first_level_channel(parent_id), message)]
+    subtree_message = dict(message, parent_id=parent_id)
+    messages.extend((subtree_channel(entity_id), subtree_message) for entity_id in ancestors)
+    coalescer().publish_many(redis, messages)
+
+
+class SubscriberQueue:
+    """
+    Ограниченная очередь сообщений одного подписчика потока событий.
+
+    Сообщения из Redis вычитываются отдельным потоком сразу, а отдаются клиенту с его скоростью. При переполнении
+    очереди действует политика ``policy``:
+        - *drop_oldest* — отбрасывается самое старое сообщение;
+        - *resync* — очередь схлопывается в одно событие *resync*, получив которое клиент должен перечитать данные;
+        - *disconnect* — подписчик отключается.
+    """
+
+    def __init__(self, maxsize: int, policy: str = OVERFLOW_DROP_OLDEST):
+        if policy not in (OVERFLOW_DROP_OLDEST, OVERFLOW_RESYNC, OVERFLOW_DISCONNECT):
+            raise ValueError('Unknown overflow policy "%s"' % policy)
+        self.maxsize = max(maxsize, 1)
+        self.policy = policy
+        self.closed = False
+        self.dropped = 0
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+        _registry.add(self)
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, message: str) -> bool:
+        """
+        Помещение сообщения в очередь.
+
+        :param str message: Сообщение
+        :return: False, если подписчик отключён и читать сообщения для него больше не нужно
+        :rtype: bool
+        """
+        with self._cond:
+            if self.closed:
+                return False
+            if len(self._items) >= self.maxsize:
+                if self.policy == OVERFLOW_DROP_OLDEST:
+                    self._items.popleft()
+                    self._drop(1)
+                elif self.policy == OVERFLOW_RESYNC:
+                    self._drop(len(self._items) + 1)
+                    self._items.clear()
+                    self._items.append(resync_message())
+                    stats.incr('resyncs')
+                    self._cond.notify()
+                    return True
+                else:
+                    self._drop(len(self._items) + 1)
+                    self._items.clear()
+                    self.closed = True
+                    stats.incr('disconnects')
+                    self._cond.notify()
+                    return False
+            self._items.append(message)
+            self._cond.notify()
+        return True
+
+    def get(self, timeout: Optional[float] = None) -> Optional[str]:
+        """
+        Получение очередного сообщения.
+
+        :param float timeout: Максимальное время ожидания в секундах
+        :return: Сообщение либо None, если за время ожидания сообщений не было или очередь закрыта
+        """
+        with self._cond:
+            if not self._items and not self.closed:
+                self._cond.wait(timeout)
+            if self._items:
+                return self._items.popleft()
+            return None
+
+    def close(self) -> None:
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def _drop(self, num: int) -> None:
+        self.dropped += num
+        stats.incr('dropped', num)
+
+
+class StreamStats:
+    """Метрики потоков событий в рамках процесса."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+
+    def incr(self, name: str, num: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += num
+
+    def dict(self) -> Dict[str, Any]:
+        """Счётчики и текущая глубина очередей подписчиков."""
+        depths = [len(q) for q in list(_registry) if not q.closed]
+        with self._lock:
+            counters = dict(self._counters)
+        return {
+            'subscribers': len(depths),
+            'queue_depth_total': sum(depths),
+            'queue_depth_max': max(depths) if depths else 0,
+            'delivered': counters.get('delivered', 0),
+            'dropped': counters.get('dropped', 0),
+            'resyncs': counters.get('resyncs', 0),
+            'disconnects': counters.get('disconnects', 0),
+        }
+
+
+_registry = weakref.WeakSet()
+stats = StreamStats()
+
+
+def resync_message() -> str:
+    return json.dumps({'action': 'resync', 'now': datetime.datetime.now(tz=tzlocal()).isoformat()})
+
+
+def _pump(pub_sub, queue: SubscriberQueue) -> None:
+    try:
+        for message in pub_sub.listen():
+            if type(message['data']) == bytes:
+                msg = message['data'].decode('utf-8')
+            else:
+                msg = str(message['data'])
+            if not queue.put(msg):
+                break
+    except Exception:
+        # Соединение закрыто со стороны отписавшегося клиента
+        pass
+    finally:
+        queue.close()
+
+
+def event_stream(redis, channel: str) -> Iterator[str]:
+    """
+    Поток событий канала в формате Server-Sent Events через ограниченную очередь подписчика.
+
+    Размер очереди, политика переполнения и интервал keep-alive задаются параметрами ``STREAMS_QUEUE_SIZE``,
+    ``STREAMS_OVERFLOW`` и ``STREAMS_KEEPALIVE``.
+
+    :param redis: Redis-соединение
+    :param str channel: Название канала
+    :return: Итератор сообщений SSE с метками :data:`app.common.FLUSH` там, где очередь опустела
+    :rtype: iterator
+    """
+    queue = SubscriberQueue(int(setting('STREAMS_QUEUE_SIZE', 100)), setting('STREAMS_OVERFLOW', OVERFLOW_DROP_OLDEST))
+    keepalive = float(setting('STREAMS_KEEPALIVE', 15))
+    pub_sub = redis.pubsub()
+    pub_sub.subscribe(channel)
+    reader = threading.Thread(target=_pump, args=(pub_sub, queue), daemon=True)
+    reader.start()
+    try:
+        while True:
+            msg = queue.get(timeout=keepalive)
+            if msg is None:
+                if queue.closed:
+                    break
+                yield ': keepalive\n\n'
+                yield FLUSH
+                continue
+            stats.incr('delivered')
+            yield 'data: %s\n\n' % msg
+            if not len(queue):
+                # Пачка событий отдаётся одной записью в сокет, как только очередь опустела
+                yield FLUSH
+    finally:
+        queue.close()
+        pub_sub.close()
@@ -0,0 +1,160 @@
+"""Кэш файлов выгрузки комментариев на диске."""
+import datetime
+import glob
+import hashlib
+import os
+import uuid
+from typing import Optional, Iterator, Callable, List
+
+from flask import Response, send_file
+
+from app.cache import resolve_entity, entity_token
+from app.common import db_conn, redis_conn, AttachmentManager, stream_response
+from app.events import setting
+from app.types import ENTITY_TYPE
+
+
+def cache_dir() -> Optional[str]:
+    """Каталог кэша выгрузок из параметра ``EXPORT_CACHE_DIR``, либо None если кэш отключён."""
+    path = setting('EXPORT_CACHE_DIR', None)
+    if not path:
+        return None
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def export_prefix(entity_id: int, fmt: str, after: Optional[datetime.datetime],
+                  before: Optional[datetime.datetime], fields: Optional[List[str]] = None) -> str:
+    """
+    Общая часть имени файлов выгрузки сущности в заданном формате, диапазоне дат и проекции полей — без учёта
+    версии ветви.
+
+    :param int entity_id: Идентификатор сущности
+    :param str fmt: Формат выгрузки
+    :param datetime after: Фильтр по дате *после* указанной
+    :param datetime before: Фильтр по дате *до* указанной
+    :param list fields: Проекция полей комментария, None — все поля
+    :return: Префикс имени файла
+    :rtype: str
+    """
+    variant = '%s|%s' % (after and after.isoformat() or '', before and before.isoformat() or '')
+    if fields is not None:
+        variant += '|' + ','.join(fields)
+    return 'descendants_%d_%s_%s_' % (entity_id, fmt, hashlib.sha1(variant.encode('utf-8')).hexdigest()[:12])
+
+
+def export_path(redis, directory: str, entity_id: int, fmt: str, after: Optional[datetime.datetime],
+                before: Optional[datetime.datetime], fields: Optional[List[str]] = None) -> str:
+    """
+    Путь к файлу выгрузки для текущей версии ветви сущности.
+
+    Версия читается до выборки: изменение во время выгрузки оставит файл под уже устаревшей версией.
+
+    :param redis: Redis-соединение
+    :param str directory: Каталог кэша выгрузок
+    :param int entity_id: Идентификатор сущности
+    :param str fmt: Формат выгрузки
+    :param datetime after: Фильтр по дате *после* указанной
+    :param datetime before: Фильтр по дате *до* указанной
+    :param list fields: Проекция полей комментария, None — все поля
+    :return: Путь к файлу
+    :rtype: str
+    """
+    token = entity_token(redis, entity_id, users=True, thread=True)
+    return os.path.join(directory, export_prefix(entity_id, fmt, after, before, fields) + token + '.' + fmt)
+
+
+def tee_to_file(it: Iterator, path: str) -> Iterator:
+    """
+    Передача потока дальше с одновременной записью в файл.
+
+    Запись идёт во временный файл, который переименовывается в ``path`` только после полной выдачи потока; прерванная
+    выдача (например, клиент отключился) файл не оставляет. Прежние версии этой же выгрузки после этого удаляются.
+
+    :param it: Поток фрагментов (строки кодируются в UTF-8, как и при отдаче ответа)
+    :param str path: Путь к файлу выгрузки
+    :return: Тот же поток
+    :rtype: iterator
+    """
+    tmp_path = '%s.%s.part' % (path, uuid.uuid4().hex)
+    f = open(tmp_path, 'wb')
+    try:
+        for chunk in it:
+            f.write(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+            yield chunk
+        f.close()
+        os.replace(tmp_path, path)
+    finally:
+        if not f.closed:
+            f.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    prefix = path[:path.rindex('_') + 1]
+    for old_path in glob.glob(glob.escape(prefix) + '*'):
+        if old_path != path and not old_path.endswith('.part'):
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+
+def send_export(path: str, mimetype: str, filename: str) -> Response:
+    """
+    Отдача готового файла выгрузки.
+
+    При заданном ``EXPORT_ACCEL_REDIRECT`` (внутренний location nginx, указывающий на каталог кэша) файл отдаёт
+    nginx по заголовку ``X-Accel-Redirect``. Иначе файл отдаётся :func:`flask.send_file` с ``Content-Length`` и
+    поддержкой запросов диапазонов (``Range``), а при ``USE_X_SENDFILE`` — заголовком ``X-Sendfile``.
+
+    :param str path: Путь к файлу
+    :param str mimetype: Тип содержимого
+    :param str filename: Имя файла для сохранения
+    :return: Ответ
+    """
+    accel = setting('EXPORT_ACCEL_REDIRECT', None)
+    if accel:
+        return Response(status=200, mimetype=mimetype, headers={
+            'X-Accel-Redirect': accel.rstrip('/') + '/' + os.path.basename(path),
+            'Content-Disposition': 'attachment; filename=%s' % filename,
+        })
+    return send_file(path, mimetype=mimetype, as_attachment=True, attachment_filename=filename, conditional=True)
+
+
+def export_response(kind: ENTITY_TYPE, object_id: int, fmt: str, after: Optional[datetime.datetime],
+                    before: Optional[datetime.datetime], source: Callable[[], Iterator], filename: str,
+                    fields: Optional[List[str]] = None) -> Response:
+    """
+    Ответ со всеми комментариями ветви сущности в виде файла выгрузки.
+
+    Файл ищется в кэше по сущности, формату, диапазону дат, проекции полей и версии ветви (её увеличивает любое
+    изменение комментария в ветви, а также изменение пользователей — см. :func:`app.cache.bump_versions`). Если файла
+    нет, выгрузка формируется потоком, как обычно, и одновременно сохраняется в кэш для следующих запросов.
+
+    :param kind: Вид объекта
+    :param int object_id: Идентификатор объекта
+    :param str fmt: Формат выгрузки: *json*, *csv*, *xml* либо их сжатые варианты *json.gz*, *csv.gz*, *xml.gz*
+    :param datetime after: Фильтр по дате *после* указанной
+    :param datetime before: Фильтр по дате *до* указанной
+    :param source: Функция, возвращающая итератор комментариев
+    :param str filename: Имя файла для сохранения
+    :param list fields: Проекция полей комментария (задаёт и столбцы CSV), None — все поля
+    :return: Ответ
+    """
+    formatter = AttachmentManager(fmt, fields)
+    headers = {"Content-Disposition": "attachment; filename=%s" % filename}
+    directory = cache_dir()
+    if directory is None:
+        return stream_response(formatter.iterate(source()), formatter.content_type, headers,
+                               compress=not formatter.compressed)
+
+    redis = redis_conn()
+    entity_id = resolve_entity(redis, db_conn, kind, object_id)
+    if entity_id is None:
+        return stream_response(formatter.iterate(source()), formatter.content_type, headers,
+                               compress=not formatter.compressed)
+
+    path = export_path(redis, directory, entity_id, fmt, after, before, fields)
+    if os.path.exists(path):
+        return send_export(path, formatter.content_type, filename)
+    return stream_response(tee_to_file(formatter.iterate(source()), path), formatter.content_type, headers,
+                           compress=not formatter.compressed)
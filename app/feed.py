@@ -0,0 +1,159 @@
+"""Лента комментариев нескольких пользователей и постов."""
+import datetime
+import heapq
+import itertools
+from typing import List, Dict, Any, Optional, Tuple, Iterator
+
+import psycopg2
+from dateutil.tz import tzutc
+from psycopg2.extras import RealDictCursor
+
+from app.common import comment_columns, fill_authors, sql_date_filter
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=tzutc())  # type: datetime.datetime
+"""Начало отсчёта времени в курсоре ленты."""
+
+_SOURCES = {
+    # Комментарии пользователя — по индексу comments_userid_datetime_index
+    'users': "SELECT U.ord, C.* "
+             "FROM unnest(%s :: INTEGER[]) WITH ORDINALITY AS U(source, ord) "
+             "  CROSS JOIN LATERAL (SELECT {columns} "
+             "                      FROM comments AS F "
+             "                      WHERE F.userid = U.source AND F.deleted = FALSE{filters} "
+             "                      ORDER BY F.datetime DESC, F.commentid DESC "
+             "                      LIMIT %s) AS C "
+             "ORDER BY U.ord, C.datetime DESC, C.commentid DESC;",
+    # Комментарии к посту — по частичному индексу comments_parentid_live_index
+    'posts': "SELECT U.ord, C.* "
+             "FROM unnest(%s :: INTEGER[]) WITH ORDINALITY AS U(source, ord) "
+             "  JOIN posts AS P ON P.postid = U.source "
+             "  CROSS JOIN LATERAL (SELECT {columns} "
+             "                      FROM comments AS F "
+             "                      WHERE F.parentid = P.entityid AND F.deleted = FALSE{filters} "
+             "                      ORDER BY F.datetime DESC, F.commentid DESC "
+             "                      LIMIT %s) AS C "
+             "ORDER BY U.ord, C.datetime DESC, C.commentid DESC;",
+}
+
+
+def feed_cursor(rec: Dict[str, Any]) -> str:
+    """
+    Курсор ленты после указанного комментария: время создания в микросекундах от начала эпохи и идентификатор.
+
+    :param dict rec: Запись комментария
+    :return: Курсор вида ``<микросекунды>:<идентификатор комментария>``
+    :rtype: str
+    """
+    return '%d:%d' % ((rec['datetime'] - EPOCH) // datetime.timedelta(microseconds=1), rec['commentid'])
+
+
+def parse_feed_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    """
+    Разбор курсора ленты, см. :func:`feed_cursor`.
+
+    :param str cursor: Курсор из поля *next* предыдущей страницы
+    :return: Время создания и Идентификатор последнего комментария предыдущей страницы
+    :rtype: tuple
+    :raises ValueError: Курсор не распознан
+    """
+    micros, comment_id = cursor.split(':')
+    return EPOCH + datetime.timedelta(microseconds=int(micros)), int(comment_id)
+
+
+def _key(rec: Dict[str, Any]) -> Tuple[datetime.datetime, int]:
+    return rec['datetime'], rec['commentid']
+
+
+def source_comments(conn, kind: str, source_ids: List[int], after: Optional[datetime.datetime] = None,
+                    before: Optional[datetime.datetime] = None, cursor: Optional[str] = None,
+                    limit: int = 10) -> List[List[Dict[str, Any]]]:
+    """
+    Последние неудалённые комментарии каждого источника ленты одного вида.
+
+    Все источники выбираются одним запросом: для каждого — отдельная ``LATERAL``-выборка по индексу с ``LIMIT``, поэтому
+    читается не больше ``limit`` строк на источник, сколько бы комментариев у него ни было.
+
+    :param conn: Psycopg2 соединение
+    :param str kind: Вид источников: *users* — комментарии пользователей, *posts* — комментарии к постам
+    :param list source_ids: Идентификаторы пользователей либо постов
+    :param datetime after: Фильтр по дате *после* указанной
+    :param datetime before: Фильтр по дате *до* указанной
+    :param str cursor: Курсор ленты (см. :func:`feed_cursor`): только комментарии старше указанного
+    :param int limit: Количество комментариев на источник
+    :return: Для каждого найденного источника — Список его комментариев от новых к старым
+    :rtype: list
+    :raises ValueError: Курсор не распознан
+    """
+    filters, values = [], []
+    dtf, dtf_values = sql_date_filter(after, before, 'F')
+    if dtf:
+        filters.append(dtf)
+        values.extend(dtf_values)
+    if cursor is not None:
+        since, comment_id = parse_feed_cursor(cursor)
+        # Первое условие — граница диапазона индекса, второе отсекает уже выданные комментарии с тем же временем
+        filters.append("F.datetime <= %s AND (F.datetime, F.commentid) < (%s, %s)")
+        values.extend([since, since, comment_id])
+    query = _SOURCES[kind].format(columns=comment_columns(None, alias='F'),
+                                  filters=''.join(' AND ' + x for x in filters))
+
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute("SET timezone = 'Europe/Moscow';")
+    cur.execute(query, [source_ids] + values + [limit])
+    rows = cur.fetchall()
+    cur.close()
+    conn.commit()
+    return [[{k: v for k, v in rec.items() if k != 'ord'} for rec in group]
+            for _, group in itertools.groupby(rows, key=lambda rec: rec['ord'])]
+
+
+def merge(sources: List[List[Dict[str, Any]]]) -> Iterator[Dict[str, Any]]:
+    """
+    Слияние (k-way merge) упорядоченных от новых к старым списков комментариев в один поток того же порядка.
+
+    Комментарий, попавший в несколько источников (например, пользователя и поста), выдаётся один раз.
+
+    :param list sources: Списки комментариев источников
+    :return: Итератор комментариев
+    :rtype: iterator
+    """
+    last = None
+    for rec in heapq.merge(*sources, key=_key, reverse=True):
+        if last is not None and _key(rec) == last:
+            continue
+        last = _key(rec)
+        yield rec
+
+
+def feed(conn, user_ids: Optional[List[int]] = None, post_ids: Optional[List[int]] = None,
+         after: Optional[datetime.datetime] = None, before: Optional[datetime.datetime] = None,
+         cursor: Optional[str] = None, limit: int = 10) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Страница ленты: комментарии указанных пользователей и комментарии к указанным постам от новых к старым.
+
+    Каждый источник отдаёт не больше ``limit + 1`` последних комментариев (:func:`source_comments`), а страница
+    собирается их слиянием (:func:`merge`), поэтому стоимость не зависит от общего количества комментариев
+    источников. Страницы выбираются по ключу (время создания, идентификатор) последней записи, а не через OFFSET.
+    К постам относятся комментарии первого уровня вложенности.
+
+    :param conn: Psycopg2 соединение
+    :param list user_ids: Идентификаторы пользователей
+    :param list post_ids: Идентификаторы постов
+    :param datetime after: Фильтр по дате *после* указанной
+    :param datetime before: Фильтр по дате *до* указанной
+    :param str cursor: Курсор следующей страницы из предыдущего ответа, None — первая страница
+    :param int limit: Количество результатов на странице
+    :return: Список комментариев и Курсор следующей страницы либо None для последней
+    :rtype: tuple
+    :raises ValueError: Курсор не распознан
+    """
+    sources = []
+    for kind, ids in [('users', user_ids), ('posts', post_ids)]:
+        if ids:
+            sources.extend(source_comments(conn, kind, list(set(ids)), after, before, cursor, limit + 1))
+    records = list(itertools.islice(merge(sources), limit + 1))
+    next_cursor = None
+    if len(records) > limit:
+        records = records[:limit]
+        next_cursor = feed_cursor(records[-1])
+    return fill_authors(conn, records), next_cursor
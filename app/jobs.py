@@ -0,0 +1,200 @@
+"""Асинхронные задачи выгрузки комментариев (очередь в Redis, обработчик — worker.py)."""
+import datetime
+import os
+import uuid
+from typing import Optional, Dict, Any, Iterator, List
+
+import dateutil.parser
+from dateutil.tz import tzlocal
+
+from app.cache import resolve_entity
+from app.comments import descendants
+from app.common import AttachmentManager, db_conn
+from app.events import setting
+from app.exports import cache_dir, export_path, tee_to_file
+from app.posts import descendant_comments as post_descendants
+from app.types import ENTITY_TYPE
+from app.users import descendant_comments as user_descendants
+
+QUEUE_KEY = 'export_jobs:queue'
+"""Очередь идентификаторов задач выгрузки."""
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+_SOURCES = {
+    ENTITY_TYPE.post: post_descendants,
+    ENTITY_TYPE.user: user_descendants,
+    ENTITY_TYPE.comment: descendants,
+}
+
+
+def job_key(job_id: str) -> str:
+    """Ключ записи о задаче."""
+    return 'export_job:%s' % job_id
+
+
+def _now() -> str:
+    return datetime.datetime.now(tz=tzlocal()).isoformat()
+
+
+def _save(redis, key: str, **fields) -> None:
+    fields['updated'] = _now()
+    pipe = redis.pipeline(transaction=False)
+    pipe.hmset(job_key(key), {k: '' if v is None else v for k, v in fields.items()})
+    pipe.expire(job_key(key), int(setting('EXPORT_JOB_TTL', 86400)))
+    pipe.execute()
+
+
+def submit_job(redis, conn, kind: ENTITY_TYPE, object_id: int, fmt: str, after: Optional[datetime.datetime] = None,
+               before: Optional[datetime.datetime] = None, fields: Optional[List[str]] = None) -> \
+        Optional[Dict[str, Any]]:
+    """
+    Постановка задачи выгрузки всех комментариев ветви сущности в очередь.
+
+    Если выгрузка текущей версии ветви уже есть в кэше (см. :mod:`app.exports`), то задача сразу завершена.
+
+    :param redis: Redis-соединение
+    :param conn: Psycopg2 соединение
+    :param kind: Вид объекта
+    :param int object_id: Идентификатор объекта
+    :param str fmt: Формат выгрузки (проверяется вызывающей стороной): *json*, *csv*, *xml* либо *json.gz* и т.п.
+    :param datetime after: Фильтр по дате *после* указанной
+    :param datetime before: Фильтр по дате *до* указанной
+    :param list fields: Проекция полей комментария (см. :func:`app.common.fields_filter`), None — все поля
+    :return: Запись о задаче либо None, если объект не найден
+    :rtype: dict
+    """
+    entity_id = resolve_entity(redis, conn, kind, object_id)
+    if entity_id is None:
+        return None
+    job_id = uuid.uuid4().hex
+    job = {
+        'job_id': job_id,
+        'kind': kind.name,
+        'object_id': object_id,
+        'entity_id': entity_id,
+        'fmt': fmt,
+        'filename': '%s%d_descendants.%s' % (kind.name, object_id, fmt),
+        'after': after and after.isoformat(),
+        'before': before and before.isoformat(),
+        'fields': fields and ','.join(fields),
+        'status': STATUS_QUEUED,
+        'progress': 0,
+        'created': _now(),
+    }
+    path = export_path(redis, cache_dir(), entity_id, fmt, after, before, fields)
+    if os.path.exists(path):
+        job.update(status=STATUS_DONE, path=path)
+        _save(redis, job_id, **job)
+    else:
+        _save(redis, job_id, **job)
+        redis.lpush(QUEUE_KEY, job_id)
+    return get_job(redis, job_id)
+
+
+def get_job(redis, job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Запись о задаче выгрузки.
+
+    Поля:
+        - job_id (str) — Идентификатор задачи
+        - kind (str), object_id (int), entity_id (int) — Выгружаемый объект
+        - fmt (str) — Формат выгрузки
+        - filename (str) — Имя файла для сохранения
+        - after, before (str) — Фильтр по дате либо None
+        - fields (list) — Проекция полей комментария либо None
+        - status (str) — Состояние: *queued*, *running*, *done*, *failed*
+        - progress (int) — Количество уже выгруженных комментариев
+        - path (str) — Путь к файлу выгрузки для состояния *done*
+        - error (str) — Описание ошибки для состояния *failed*
+        - created, updated (str) — Время постановки и последнего изменения задачи
+
+    :param redis: Redis-соединение
+    :param str job_id: Идентификатор задачи
+    :return: Запись о задаче либо None, если задача не найдена или устарела
+    :rtype: dict
+    """
+    raw = redis.hgetall(job_key(job_id))
+    if not raw:
+        return None
+    job = {k.decode('utf-8'): v.decode('utf-8') or None for k, v in raw.items()}
+    for field in ['object_id', 'entity_id', 'progress']:
+        if job.get(field) is not None:
+            job[field] = int(job[field])
+    if job.get('fields') is not None:
+        job['fields'] = job['fields'].split(',')
+    return job
+
+
+def _counting(redis, job_id: str, it: Iterator) -> Iterator:
+    every = int(setting('EXPORT_JOB_PROGRESS_EVERY', 1000))
+    num = 0
+    for rec in it:
+        yield rec
+        num += 1
+        if num % every == 0:
+            _save(redis, job_id, progress=num)
+    _save(redis, job_id, progress=num)
+
+
+def run_job(redis, conn, job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Выполнение задачи выгрузки.
+
+    Выгрузка пишется в кэш выгрузок теми же потоковыми форматами :class:`app.common.AttachmentManager`, что и при
+    синхронном запросе, поэтому её результат достаётся и обычным запросам выгрузки.
+
+    :param redis: Redis-соединение
+    :param conn: Psycopg2 соединение
+    :param str job_id: Идентификатор задачи
+    :return: Запись о задаче после выполнения либо None, если задача не найдена или устарела
+    :rtype: dict
+    """
+    job = get_job(redis, job_id)
+    if job is None:
+        return None
+    _save(redis, job_id, status=STATUS_RUNNING)
+    try:
+        after = job['after'] and dateutil.parser.parse(job['after'])
+        before = job['before'] and dateutil.parser.parse(job['before'])
+        path = export_path(redis, cache_dir(), job['entity_id'], job['fmt'], after, before, job['fields'])
+        if not os.path.exists(path):
+            source = _SOURCES[ENTITY_TYPE[job['kind']]](conn, job['object_id'], after, before, fields=job['fields'])
+            formatter = AttachmentManager(job['fmt'], job['fields'])
+            for _ in tee_to_file(formatter.iterate(_counting(redis, job_id, source)), path):
+                pass
+        _save(redis, job_id, status=STATUS_DONE, path=path)
+    except Exception as e:
+        conn.rollback()
+        _save(redis, job_id, status=STATUS_FAILED, error=str(e))
+    return get_job(redis, job_id)
+
+
+def work(redis, timeout: int = 5, once: bool = False) -> int:
+    """
+    Цикл обработчика очереди задач выгрузки.
+
+    Задачи забираются из очереди по одной, поэтому несколько запущенных обработчиков делят очередь между собой.
+
+    :param redis: Redis-соединение
+    :param int timeout: Время ожидания очередной задачи в секундах
+    :param bool once: Вернуться, как только очередь опустеет
+    :return: Количество обработанных задач
+    :rtype: int
+    """
+    conn = db_conn()
+    num = 0
+    try:
+        while True:
+            item = redis.brpop(QUEUE_KEY, timeout=timeout)
+            if item is None:
+                if once:
+                    return num
+                continue
+            run_job(redis, conn, item[1].decode('utf-8'))
+            num += 1
+    finally:
+        conn.close()
@@ -0,0 +1,128 @@
+"""Обслуживание: секции комментариев и истории правок, сжатие истории правок, очистка кэша выгрузок."""
+import datetime
+import os
+import time
+from typing import List, Optional
+
+import psycopg2
+from dateutil.relativedelta import relativedelta
+from dateutil.tz import tzlocal
+
+from app.common import DatabaseException
+
+
+PARTITIONED_TABLES = [('comments', 'datetime'), ('comments_history', 'ch_datetime')]
+"""Секционированные по месяцам таблицы и их ключи секционирования."""
+
+
+def add_partitions(conn, months_ahead: int = 2) -> List[str]:
+    """
+    Создание месячных секций комментариев и истории правок на текущий и несколько следующих месяцев.
+
+    Секции создаются заранее, чтобы новые строки не попадали в секции по умолчанию.
+
+    :param conn: Psycopg2 соединение
+    :param int months_ahead: Количество месяцев вперёд, по умолчанию 2
+    :return: Названия секций
+    :rtype: list
+    """
+    today = datetime.date.today().replace(day=1)
+    names = []
+    try:
+        cur = conn.cursor()
+        for table, key in PARTITIONED_TABLES:
+            for i in range(months_ahead + 1):
+                cur.execute("SELECT add_month_partition(%s, %s, %s);", [table, key, today + relativedelta(months=i)])
+                names.append(cur.fetchone()[0])
+        conn.commit()
+        cur.close()
+    except psycopg2.DatabaseError as e:
+        conn.rollback()
+        raise DatabaseException(e)
+    return names
+
+
+def history_retention(conn, keep_months: int) -> List[str]:
+    """
+    Удаление секций истории правок старше указанного количества месяцев.
+
+    :param conn: Psycopg2 соединение
+    :param int keep_months: Сколько полных месяцев истории хранить помимо текущего
+    :return: Названия удалённых секций
+    :rtype: list
+    """
+    older_than = datetime.datetime.now(tz=tzlocal()).replace(day=1, hour=0, minute=0, second=0, microsecond=0) - \
+        relativedelta(months=keep_months)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM drop_month_partitions('comments_history', %s);", [older_than])
+        names = [rec[0] for rec in cur.fetchall()]
+        conn.commit()
+        cur.close()
+    except psycopg2.DatabaseError as e:
+        conn.rollback()
+        raise DatabaseException(e)
+    return names
+
+
+def history_compact(conn, older_than_days: int) -> int:
+    """
+    Схлопывание идущих подряд версий комментариев с одинаковым текстом.
+
+    :param conn: Psycopg2 соединение
+    :param int older_than_days: Затрагиваются только правки старше указанного количества дней
+    :return: Количество удалённых версий
+    :rtype: int
+    """
+    older_than = datetime.datetime.now(tz=tzlocal()) - datetime.timedelta(days=older_than_days)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT comments_history_compact(%s);", [older_than])
+        cnt = cur.fetchone()[0]
+        conn.commit()
+        cur.close()
+    except psycopg2.DatabaseError as e:
+        conn.rollback()
+        raise DatabaseException(e)
+    return cnt
+
+
+def export_cache_sweep(directory: Optional[str], max_age: int, max_size: int) -> List[str]:
+    """
+    Очистка каталога кэша выгрузок (см. :mod:`app.exports`).
+
+    Удаляются файлы старше ``max_age`` секунд (в том числе брошенные временные ``.part``), затем, пока общий размер
+    оставшихся превышает ``max_size`` байт, — самые давние из них. Отдаваемый в этот момент файл остаётся доступен
+    уже открывшему его процессу.
+
+    :param str directory: Каталог кэша выгрузок, None — кэш отключён
+    :param int max_age: Максимальный возраст файла в секундах, ``0`` — не ограничен
+    :param int max_size: Максимальный общий размер файлов в байтах, ``0`` — не ограничен
+    :return: Имена удалённых файлов
+    :rtype: list
+    """
+    if not directory or not os.path.isdir(directory):
+        return []
+    files = []
+    for entry in os.scandir(directory):
+        if entry.is_file():
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    files.sort()
+    removed = []
+    total = sum(size for _, size, _ in files)
+    now = time.time()
+    for mtime, size, path in files:
+        expired = max_age > 0 and now - mtime > max_age
+        if not expired and (max_size <= 0 or total <= max_size):
+            continue
+        if path.endswith('.part') and not expired:
+            # Выгрузка ещё пишется
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed.append(os.path.basename(path))
+    return removed
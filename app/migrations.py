@@ -0,0 +1,233 @@
+"""Версионированные миграции схемы базы данных."""
+import os
+import re
+from typing import NamedTuple, List, Set, Optional
+
+import psycopg2
+
+from app.common import DatabaseException
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+"""Каталог файлов миграций вида ``NNNN_название.sql``."""
+
+NO_TRANSACTION = '-- migrate: no-transaction'
+"""Заголовок миграции, выполняемой вне транзакции (например, с ``CREATE INDEX CONCURRENTLY``)."""
+
+BATCH_SIZE = 10000
+"""Размер диапазона ключа в одной порции выражения, выполняемого порциями (см. :func:`_execute_batched`)."""
+
+_file_re = re.compile(r'^(\d+)_(\w+)\.sql$')
+_concurrent_index_re = re.compile(r'^CREATE\s+(UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)\s+'
+                                  r'ON\s+(\w+)\s+(.*)$', re.IGNORECASE | re.DOTALL)
+_batched_re = re.compile(r'^UPDATE\s+(\w+)\s.*\bWHERE\s+(\w+)\s*>=\s*%\(lo\)s\s+AND\s+\2\s*<\s*%\(hi\)s',
+                         re.IGNORECASE | re.DOTALL)
+
+
+class Migration(NamedTuple('Migration', [('version', int), ('name', str), ('path', str)])):
+    """
+    Миграция.
+
+    Аттрибуты:
+        - version (int) — Номер версии схемы
+        - name (str) — Название миграции
+        - path (str) — Путь к SQL-файлу миграции
+    """
+
+    @property
+    def sql(self) -> str:
+        """Текст миграции."""
+        with open(self.path, encoding='utf-8') as f:
+            return f.read()
+
+    @property
+    def transactional(self) -> bool:
+        """Выполняется ли миграция в транзакции."""
+        return not self.sql.lstrip().startswith(NO_TRANSACTION)
+
+
+def available(path: str = MIGRATIONS_DIR) -> List[Migration]:
+    """
+    Все миграции из каталога в порядке версий.
+
+    :param str path: Каталог миграций
+    :return: Список миграций
+    :rtype: list
+    """
+    migrations = []
+    for file_name in os.listdir(path):
+        match = _file_re.match(file_name)
+        if match:
+            # noinspection PyArgumentList
+            migrations.append(Migration(int(match.group(1)), match.group(2), os.path.join(path, file_name)))
+    return sorted(migrations)
+
+
+def applied(conn) -> Set[int]:
+    """
+    Версии уже применённых миграций.
+
+    :param conn: Psycopg2 соединение
+    :return: Множество версий
+    :rtype: set
+    """
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS schema_migrations ("
+                "  version INTEGER NOT NULL CONSTRAINT schema_migrations_pkey PRIMARY KEY,"
+                "  name TEXT NOT NULL,"
+                "  applied_at TIMESTAMP WITH TIME ZONE DEFAULT now() NOT NULL);")
+    cur.execute("SELECT version FROM schema_migrations;")
+    versions = {rec[0] for rec in cur.fetchall()}
+    conn.commit()
+    cur.close()
+    return versions
+
+
+def split_statements(sql: str) -> List[str]:
+    """
+    Разбиение текста миграции на отдельные выражения.
+
+    Строки-комментарии отбрасываются, выражения разделяются точкой с запятой в конце строки. Тела функций
+    (``$$ … $$``) не поддерживаются — такие миграции должны выполняться в транзакции целиком.
+
+    :param str sql: Текст миграции
+    :return: Список выражений
+    :rtype: list
+    """
+    lines = [line for line in sql.splitlines() if not line.strip().startswith('--')]
+    statements = re.split(r';\s*(?:\n|$)', '\n'.join(lines))
+    return [s.strip() for s in statements if s.strip()]
+
+
+def _partition_index_name(index: str, table: str, partition: str) -> str:
+    if index.startswith(table + '_'):
+        name = partition + index[len(table):]
+    else:
+        name = partition + '_' + index
+    return name[:63]
+
+
+def _create_index_concurrently(conn, statement: str) -> None:
+    """
+    Конкурентное создание индекса, в том числе на секционированной таблице.
+
+    PostgreSQL не умеет создавать индекс секционированной таблицы конкурентно, поэтому для неё создаётся
+    невалидный индекс ``ON ONLY`` самой таблицы, затем конкурентно — индексы каждой секции, которые присоединяются к
+    нему. После присоединения индексов всех секций индекс таблицы становится валидным.
+    """
+    match = _concurrent_index_re.match(statement)
+    unique, index, table, definition = match.group(1) or '', match.group(2), match.group(3), match.group(4)
+    cur = conn.cursor()
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = %s :: REGCLASS;", [table])
+    if cur.fetchone()[0] != 'p':
+        cur.execute(statement)
+        cur.close()
+        return
+    cur.execute("CREATE " + unique + "INDEX IF NOT EXISTS " + index + " ON ONLY " + table + " " + definition)
+    cur.execute("SELECT C.relname FROM pg_inherits AS I JOIN pg_class AS C ON C.oid = I.inhrelid "
+                "WHERE I.inhparent = %s :: REGCLASS ORDER BY C.relname;", [table])
+    for partition in [rec[0] for rec in cur.fetchall()]:
+        name = _partition_index_name(index, table, partition)
+        cur.execute("SELECT I.indisvalid FROM pg_class AS C JOIN pg_index AS I ON I.indexrelid = C.oid "
+                    "WHERE C.relname = %s;", [name])
+        rec = cur.fetchone()
+        if rec is not None and not rec[0]:
+            # Остался от прерванной попытки
+            cur.execute("DROP INDEX CONCURRENTLY " + name)
+            rec = None
+        if rec is None:
+            cur.execute("CREATE " + unique + "INDEX CONCURRENTLY " + name + " ON " + partition + " " + definition)
+        cur.execute("SELECT 1 FROM pg_inherits WHERE inhrelid = %s :: REGCLASS AND inhparent = %s :: REGCLASS;",
+                    [name, index])
+        if cur.fetchone() is None:
+            cur.execute("ALTER INDEX " + index + " ATTACH PARTITION " + name)
+    cur.close()
+
+
+def _execute_batched(conn, statement: str, batch_size: int = BATCH_SIZE) -> int:
+    """
+    Выполнение ``UPDATE`` порциями по диапазонам ключа.
+
+    Выражение вида ``UPDATE таблица … WHERE ключ >= %(lo)s AND ключ < %(hi)s …`` выполняется для последовательных
+    диапазонов ключа от минимального до максимального значения в таблице. Вне транзакции каждая порция фиксируется
+    отдельно, поэтому строки блокируются ненадолго, а место старых версий строк успевает переиспользоваться.
+
+    :param conn: Psycopg2 соединение
+    :param str statement: Выражение
+    :param int batch_size: Размер диапазона ключа в одной порции
+    :return: Количество изменённых строк
+    :rtype: int
+    """
+    match = _batched_re.match(statement)
+    table, key = match.group(1), match.group(2)
+    cur = conn.cursor()
+    cur.execute("SELECT MIN(" + key + "), MAX(" + key + ") FROM " + table + ";")
+    low, high = cur.fetchone()
+    cnt = 0
+    if low is not None:
+        for lo in range(low, high + 1, batch_size):
+            cur.execute(statement, {'lo': lo, 'hi': lo + batch_size})
+            cnt += cur.rowcount
+    cur.close()
+    return cnt
+
+
+def apply(conn, migration: Migration) -> None:
+    """
+    Применение миграции.
+
+    Миграции с заголовком :data:`NO_TRANSACTION` выполняются вне транзакции по одному выражению, выражения
+    ``CREATE INDEX CONCURRENTLY`` на секционированных таблицах раскладываются по секциям, а ``UPDATE`` с диапазоном
+    ключа ``%(lo)s``–``%(hi)s`` выполняется порциями (см. :func:`_execute_batched`). Остальные миграции выполняются в
+    одной транзакции целиком.
+
+    :param conn: Psycopg2 соединение
+    :param migration: Миграция
+    """
+    try:
+        if migration.transactional:
+            cur = conn.cursor()
+            cur.execute(migration.sql)
+            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s);",
+                        [migration.version, migration.name])
+            conn.commit()
+            cur.close()
+            return
+
+        conn.autocommit = True
+        try:
+            for statement in split_statements(migration.sql):
+                if _concurrent_index_re.match(statement):
+                    _create_index_concurrently(conn, statement)
+                elif _batched_re.match(statement):
+                    _execute_batched(conn, statement)
+                else:
+                    cur = conn.cursor()
+                    cur.execute(statement)
+                    cur.close()
+            cur = conn.cursor()
+            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s);",
+                        [migration.version, migration.name])
+            cur.close()
+        finally:
+            conn.autocommit = False
+    except psycopg2.DatabaseError as e:
+        if not conn.autocommit:
+            conn.rollback()
+        raise DatabaseException(e)
+
+
+def migrate(conn, target: Optional[int] = None, path: str = MIGRATIONS_DIR) -> List[Migration]:
+    """
+    Применение всех ещё не применённых миграций по порядку.
+
+    :param conn: Psycopg2 соединение
+    :param int target: Версия, до которой (включительно) применять миграции, по умолчанию — все
+    :param str path: Каталог миграций
+    :return: Применённые миграции
+    :rtype: list
+    """
+    done = applied(conn)
+    pending = [m for m in available(path) if m.version not in done and (target is None or m.version <= target)]
+    for migration in pending:
+        apply(conn, migration)
+    return pending
@@ -3,7 +3,9 @@ from typing import List, Dict, Any, Optional, Tuple, Iterator
 
 import psycopg2
 
-from app.common import DatabaseException, entity_first_level_comments, entity_descendants
+from app.cache import bump_versions
+from app.common import DatabaseException, entity_first_level_comments, entity_descendants, entity_thread, \
+    redis_conn, entity_stats
 from app.types import Post
 
 
@@ -46,6 +48,25 @@ def get_post(conn, post_id: int) -> Optional[Dict[str, Any]]:
     return posts[0].dict
 
 
+def get_posts_by_ids(conn, post_ids: List[int]) -> List[Optional[Dict[str, Any]]]:
+    """
+    Получение нескольких *Постов* (:class:`app.posts.Post`) одним запросом.
+
+    :param conn: Psycopg2 соединение
+    :param list post_ids: Идентификаторы постов
+    :return: Посты в порядке запрошенных идентификаторов, None на месте не найденных
+    :rtype: list
+    """
+    if not post_ids:
+        return []
+    cur = conn.cursor()
+    cur.execute("SELECT entityid, postid, userid, title, text FROM posts WHERE postid = ANY(%s);",
+                [list(set(post_ids))])
+    found = {rec.postid: rec.dict for rec in [Post(*rec) for rec in cur.fetchall()]}
+    cur.close()
+    return [found.get(x) for x in post_ids]
+
+
 def new_post(conn, data) -> Dict[str, Any]:
     """
     Сохранение нового *Поста* (:class:`app.posts.Post`).
@@ -68,34 +89,38 @@ def new_post(conn, data) -> Dict[str, Any]:
     return Post(entity_id, post_id, data['userid'], data['title'], data['text']).dict
 
 
-def remove_post(conn, post_id: int) -> int:
+def remove_post(conn, post_id: int, redis=None) -> int:
     """
     Удаление *Поста* (:class:`app.posts.Post`).
 
     :param conn: Psycopg2 соединение
     :param int post_id: Идентификатор поста
+    :param redis: Опциональное Redis-соединение, если вызывается вне приложения
     :return: Количество удалённых записей
     :rtype: int
     """
     # TODO: Проверять комментарии к посту
     try:
         cur = conn.cursor()
-        cur.execute("DELETE FROM posts WHERE postid = %s;", [post_id])
-        cnt = cur.rowcount
+        cur.execute("DELETE FROM posts WHERE postid = %s RETURNING entityid;", [post_id])
+        entity_ids = [rec[0] for rec in cur.fetchall()]
         conn.commit()
         cur.close()
     except psycopg2.DatabaseError as e:
         raise DatabaseException(e)
-    return cnt
+    if entity_ids:
+        bump_versions(redis or redis_conn(), entity_ids)
+    return len(entity_ids)
 
 
-def update_post(conn, post_id: int, data: Dict[str, Any]) -> int:
+def update_post(conn, post_id: int, data: Dict[str, Any], redis=None) -> int:
     """
     Обновление информации о *Посте* (:class:`app.posts.Post`).
 
     :param conn: Psycopg2 соединение
     :param int post_id: Идентификатор поста
     :param dict data: Данные о посте
+    :param redis: Опциональное Redis-соединение, если вызывается вне приложения
     :return: Количество обновлённых записей
     :rtype: int
     """
@@ -113,10 +138,13 @@ def update_post(conn, post_id: int, data: Dict[str, Any]) -> int:
         cur.close()
     except psycopg2.DatabaseError as e:
         raise DatabaseException(e)
+    if cnt:
+        bump_versions(redis or redis_conn(), [post['entityid']])
     return cnt
 
 
-def first_level_comments(conn, post_id: int, offset: int = 0, limit: int = 100) -> Tuple[int, List[Dict[str, Any]]]:
+def first_level_comments(conn, post_id: int, offset: int = 0, limit: int = 100,
+                         fields: Optional[List[str]] = None) -> Tuple[int, List[Dict[str, Any]]]:
     """
     Показать комментарии первого уровня вложенности к указанному посту в порядке возрастания даты создания
     комментария.
@@ -127,17 +155,39 @@ def first_level_comments(conn, post_id: int, offset: int = 0, limit: int = 100)
     :param int post_id: Идентификатор поста
     :param int offset: Начало отсчета, по умолчанию 0
     :param int limit: Количество результатов, по умолчанию максимум = 100
+    :param list fields: Проекция полей (см. :func:`app.common.fields_filter`), по умолчанию все поля
     :return: Общее количество и Список комментариев первого уровня вложенности
     :rtype: tuple
     """
     post = get_post(conn, post_id)
     if post is None:
         return 0, []
-    return entity_first_level_comments(conn, post['entityid'], offset, limit)
+    return entity_first_level_comments(conn, post['entityid'], offset, limit, fields)
+
+
+def thread(conn, post_id: int, offset: int = 0, limit: int = 100, replies: int = 3) -> Tuple[int, List[Dict[str, Any]]]:
+    """
+    Страница обсуждения: комментарии первого уровня к указанному посту вместе с первыми ответами на каждый из них.
+
+    Поддерживается пагинация :func:`app.common.pagination`.
+
+    :param conn: Psycopg2 соединение
+    :param int post_id: Идентификатор поста
+    :param int offset: Начало отсчета, по умолчанию 0
+    :param int limit: Количество результатов, по умолчанию максимум = 100
+    :param int replies: Количество ответов на каждый комментарий, по умолчанию 3
+    :return: Общее количество и Список комментариев первого уровня с ответами (см. :func:`app.common.entity_thread`)
+    :rtype: tuple
+    """
+    post = get_post(conn, post_id)
+    if post is None:
+        return 0, []
+    return entity_thread(conn, post['entityid'], offset, limit, replies)
 
 
 def descendant_comments(conn, post_id: int, after: Optional[datetime.datetime] = None,
-                        before: Optional[datetime.datetime] = None) -> Iterator:
+                        before: Optional[datetime.datetime] = None, max_depth: Optional[int] = None,
+                        per_parent_limit: Optional[int] = None, fields: Optional[List[str]] = None) -> Iterator:
     """
     Все комментарии для указанного поста.
 
@@ -145,10 +195,33 @@ def descendant_comments(conn, post_id: int, after: Optional[datetime.datetime] =
     :param post_id: Идентификатор поста
     :param datetime after: Опциональная фильтрация по дате *после* указанной
     :param datetime before: Опциональная фильтрация по дате *до* указанной
+    :param int max_depth: Максимальная глубина вложенности, по умолчанию не ограничена
+    :param int per_parent_limit: Максимальное количество ответов на каждый комментарий, по умолчанию не ограничено
+    :param list fields: Проекция полей (см. :func:`app.common.fields_filter`), по умолчанию все поля
     :return: Итератор всех комментариев к посту
     :rtype: iterator
     """
     post = get_post(conn, post_id)
     if post is None:
         raise StopIteration
-    return entity_descendants(conn, post['entityid'], after, before)
+    return entity_descendants(conn, post['entityid'], after, before, max_depth=max_depth,
+                              per_parent_limit=per_parent_limit, fields=fields)
+
+
+def stats(conn, post_id: int, after: Optional[datetime.datetime] = None, before: Optional[datetime.datetime] = None,
+          interval: str = 'day') -> Optional[Dict[str, Any]]:
+    """
+    Статистика всех комментариев к указанному посту (см. :func:`app.common.entity_stats`).
+
+    :param conn: Psycopg2 соединение
+    :param int post_id: Идентификатор поста
+    :param datetime after: Опциональная фильтрация по дате *после* указанной
+    :param datetime before: Опциональная фильтрация по дате *до* указанной
+    :param str interval: Интервал группировки активности, по умолчанию *day*
+    :return: Статистика ветви либо None, если пост не найден
+    :rtype: dict
+    """
+    post = get_post(conn, post_id)
+    if post is None:
+        return None
+    return entity_stats(conn, post['entityid'], after, before, interval)
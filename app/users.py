@@ -4,7 +4,11 @@ from typing import List, Dict, Any, Optional, Tuple, Iterator
 import psycopg2
 from psycopg2.extras import RealDictCursor
 
-from app.common import DatabaseException, entity_first_level_comments, entity_descendants, sql_date_filter
+from app.authors import authors
+from app.cache import bump_versions
+from app.common import DatabaseException, entity_first_level_comments, entity_descendants, entity_thread, \
+    sql_date_filter, redis_conn, comment_columns, entity_stats, fill_authors
+from app.feed import feed_cursor, parse_feed_cursor
 from app.types import User
 
 
@@ -46,6 +50,24 @@ def get_user(conn, user_id: int) -> Optional[Dict[str, Any]]:
     return users[0].dict
 
 
+def get_users_by_ids(conn, user_ids: List[int]) -> List[Optional[Dict[str, Any]]]:
+    """
+    Получение нескольких *Пользователей* (:class:`app.users.User`) одним запросом.
+
+    :param conn: Psycopg2 соединение
+    :param list user_ids: Идентификаторы пользователей
+    :return: Пользователи в порядке запрошенных идентификаторов, None на месте не найденных
+    :rtype: list
+    """
+    if not user_ids:
+        return []
+    cur = conn.cursor()
+    cur.execute("SELECT entityid, userid, name FROM users WHERE userid = ANY(%s);", [list(set(user_ids))])
+    found = {rec.userid: rec.dict for rec in [User(*rec) for rec in cur.fetchall()]}
+    cur.close()
+    return [found.get(x) for x in user_ids]
+
+
 def new_user(conn, data) -> Dict[str, Any]:
     """
     Сохранение нового *Пользователя* (:class:`app.users.User`).
@@ -67,49 +89,58 @@ def new_user(conn, data) -> Dict[str, Any]:
     return User(entity_id, user_id, data['name']).dict
 
 
-def remove_user(conn, user_id: int) -> int:
+def remove_user(conn, user_id: int, redis=None) -> int:
     """
     Удаление *Пользователя* (:class:`app.users.User`).
 
     :param conn: Psycopg2 соединение
     :param int user_id: Идентификатор пользователя
+    :param redis: Опциональное Redis-соединение, если вызывается вне приложения
     :return: Количество удалённых записей
     :rtype: int
     """
     # TODO: Проверять контент юзера
     try:
         cur = conn.cursor()
-        cur.execute("DELETE FROM users WHERE userid = %s;", [user_id])
-        cnt = cur.rowcount
+        cur.execute("DELETE FROM users WHERE userid = %s RETURNING entityid;", [user_id])
+        entity_ids = [rec[0] for rec in cur.fetchall()]
         conn.commit()
         cur.close()
     except psycopg2.DatabaseError as e:
         raise DatabaseException(e)
-    return cnt
+    if entity_ids:
+        authors.invalidate(user_id)
+        bump_versions(redis or redis_conn(), entity_ids, users=True)
+    return len(entity_ids)
 
 
-def update_user(conn, user_id: int, data: Dict[str, Any]) -> int:
+def update_user(conn, user_id: int, data: Dict[str, Any], redis=None) -> int:
     """
     Обновление информации о *Пользователе* (:class:`app.users.User`).
 
     :param conn: Psycopg2 соединение
     :param int user_id: Идентификатор пользователя
     :param dict data: Данные о пользователе
+    :param redis: Опциональное Redis-соединение, если вызывается вне приложения
     :return: Количество обновлённых записей
     :rtype: int
     """
     try:
         cur = conn.cursor()
-        cur.execute("UPDATE users SET name = %s WHERE userid = %s", [data['name'], user_id])
-        cnt = cur.rowcount
+        cur.execute("UPDATE users SET name = %s WHERE userid = %s RETURNING entityid", [data['name'], user_id])
+        entity_ids = [rec[0] for rec in cur.fetchall()]
         conn.commit()
         cur.close()
     except psycopg2.DatabaseError as e:
         raise DatabaseException(e)
-    return cnt
+    if entity_ids:
+        authors.invalidate(user_id)
+        bump_versions(redis or redis_conn(), entity_ids, users=True)
+    return len(entity_ids)
 
 
-def first_level_comments(conn, user_id: int, offset: int = 0, limit: int = 100) -> Tuple[int, List[Dict[str, Any]]]:
+def first_level_comments(conn, user_id: int, offset: int = 0, limit: int = 100,
+                         fields: Optional[List[str]] = None) -> Tuple[int, List[Dict[str, Any]]]:
     """
     Показать комментарии первого уровня вложенности к указанному пользователю в порядке возрастания даты создания
     комментария.
@@ -120,17 +151,41 @@ def first_level_comments(conn, user_id: int, offset: int = 0, limit: int = 100)
     :param int user_id: Идентификатор пользователя
     :param int offset: Начало отсчета, по умолчанию 0
     :param int limit: Количество результатов, по умолчанию максимум = 100
+    :param list fields: Проекция полей (см. :func:`app.common.fields_filter`), по умолчанию все поля
     :return: Общее количество и Список комментариев первого уровня вложенности
     :rtype: tuple
     """
     user = get_user(conn, user_id)
     if user is None:
         return 0, []
-    return entity_first_level_comments(conn, user['entityid'], offset, limit)
+    return entity_first_level_comments(conn, user['entityid'], offset, limit, fields)
+
+
+def thread(conn, user_id: int, offset: int = 0, limit: int = 100, replies: int = 3) -> \
+        Tuple[int, List[Dict[str, Any]]]:
+    """
+    Страница обсуждения: комментарии первого уровня к указанному пользователю вместе с первыми ответами на каждый
+    из них.
+
+    Поддерживается пагинация :func:`app.common.pagination`.
+
+    :param conn: Psycopg2 соединение
+    :param int user_id: Идентификатор пользователя
+    :param int offset: Начало отсчета, по умолчанию 0
+    :param int limit: Количество результатов, по умолчанию максимум = 100
+    :param int replies: Количество ответов на каждый комментарий, по умолчанию 3
+    :return: Общее количество и Список комментариев первого уровня с ответами (см. :func:`app.common.entity_thread`)
+    :rtype: tuple
+    """
+    user = get_user(conn, user_id)
+    if user is None:
+        return 0, []
+    return entity_thread(conn, user['entityid'], offset, limit, replies)
 
 
 def descendant_comments(conn, user_id: int, after: Optional[datetime.datetime] = None,
-                        before: Optional[datetime.datetime] = None) -> Iterator:
+                        before: Optional[datetime.datetime] = None, max_depth: Optional[int] = None,
+                        per_parent_limit: Optional[int] = None, fields: Optional[List[str]] = None) -> Iterator:
     """
     Все комментарии для указанного пользователя.
 
@@ -138,17 +193,41 @@ def descendant_comments(conn, user_id: int, after: Optional[datetime.datetime] =
     :param user_id: Идентификатор пользователя
     :param datetime after: Опциональная фильтрация по дате *после* указанной
     :param datetime before: Опциональная фильтрация по дате *до* указанной
+    :param int max_depth: Максимальная глубина вложенности, по умолчанию не ограничена
+    :param int per_parent_limit: Максимальное количество ответов на каждый комментарий, по умолчанию не ограничено
+    :param list fields: Проекция полей (см. :func:`app.common.fields_filter`), по умолчанию все поля
     :return: Итератор всех комментариев к пользователю
     :rtype: iterator
     """
     user = get_user(conn, user_id)
     if user is None:
         raise StopIteration
-    return entity_descendants(conn, user['entityid'], after, before)
+    return entity_descendants(conn, user['entityid'], after, before, max_depth=max_depth,
+                              per_parent_limit=per_parent_limit, fields=fields)
+
+
+def stats(conn, user_id: int, after: Optional[datetime.datetime] = None, before: Optional[datetime.datetime] = None,
+          interval: str = 'day') -> Optional[Dict[str, Any]]:
+    """
+    Статистика всех комментариев к указанному пользователю (см. :func:`app.common.entity_stats`).
+
+    :param conn: Psycopg2 соединение
+    :param int user_id: Идентификатор пользователя
+    :param datetime after: Опциональная фильтрация по дате *после* указанной
+    :param datetime before: Опциональная фильтрация по дате *до* указанной
+    :param str interval: Интервал группировки активности, по умолчанию *day*
+    :return: Статистика ветви либо None, если пользователь не найден
+    :rtype: dict
+    """
+    user = get_user(conn, user_id)
+    if user is None:
+        return None
+    return entity_stats(conn, user['entityid'], after, before, interval)
 
 
 def comments(conn, user_id: int, after: Optional[datetime.datetime] = None,
-             before: Optional[datetime.datetime] = None, batch_size: int = 50) -> Iterator:
+             before: Optional[datetime.datetime] = None, batch_size: int = 50,
+             fields: Optional[List[str]] = None) -> Iterator:
     user = get_user(conn, user_id)
     if user is None:
         raise StopIteration
@@ -158,7 +237,8 @@ def comments(conn, user_id: int, after: Optional[datetime.datetime] = None,
     cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     cur.itersize = batch_size
     cur.execute("SET timezone = 'Europe/Moscow';")
-    query = "SELECT C.entityid, C.commentid, C.datetime, C.parentid, C.text, C.deleted " \
+    # Автор у всех комментариев один и уже известен — таблица пользователей не нужна
+    query = "SELECT " + comment_columns(fields) + " " \
             "FROM comments AS C " \
             "WHERE C.userid = %s "
     if dtf_clause:
@@ -167,7 +247,128 @@ def comments(conn, user_id: int, after: Optional[datetime.datetime] = None,
     # noinspection PyTypeChecker
     cur.execute(query, [user_id] + dtf_values)
     for rec in cur:
-        rec['author'] = {'userid': user['userid'], 'name': user['name']}
+        if 'userid' in rec:
+            rec['author'] = {'userid': rec.pop('userid'), 'name': user['name']}
         yield rec
     cur.close()
     conn.commit()
+
+
+def edits(conn, user_id: int, after: Optional[datetime.datetime] = None,
+          before: Optional[datetime.datetime] = None, batch_size: int = 50) -> Iterator:
+    """
+    Все правки комментариев, сделанные указанным пользователем, в хронологическом порядке.
+
+    Каждая запись — предыдущая версия комментария и время, когда она была заменена. Фильтр по дате применяется ко
+    времени правки.
+
+    :param conn: Psycopg2 соединение
+    :param user_id: Идентификатор пользователя
+    :param datetime after: Опциональная фильтрация по дате *после* указанной
+    :param datetime before: Опциональная фильтрация по дате *до* указанной
+    :param batch_size: Размер курсора, по умолчанию 50
+    :return: Итератор правок
+    :rtype: iterator
+    """
+    user = get_user(conn, user_id)
+    if user is None:
+        raise StopIteration
+
+    dtf_clause, dtf_values = sql_date_filter(after, before, 'H', 'ch_datetime')
+
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.itersize = batch_size
+    cur.execute("SET timezone = 'Europe/Moscow';")
+    # noinspection SqlResolve
+    query = "SELECT H.id AS version_id, H.entityid, H.commentid, H.userid, U.name, H.datetime, H.parentid, H.text, " \
+            "H.ch_datetime AS changed_at " \
+            "FROM comments_history AS H " \
+            "LEFT JOIN users AS U ON U.userid = H.userid " \
+            "WHERE H.ch_userid = %s "
+    if dtf_clause:
+        query += ' AND ' + dtf_clause
+    query += " ORDER BY H.ch_datetime ASC;"
+    # noinspection PyTypeChecker
+    cur.execute(query, [user_id] + dtf_values)
+    for rec in cur:
+        rec['author'] = {'userid': rec.pop('userid'), 'name': rec.pop('name')}
+        rec['changed_by'] = {'userid': user['userid'], 'name': user['name']}
+        yield rec
+    cur.close()
+    conn.commit()
+
+
+def replies(conn, user_id: int, cursor: Optional[str] = None, limit: int = 10) -> \
+        Optional[Tuple[int, List[Dict[str, Any]], Optional[str]]]:
+    """
+    Входящие ответы пользователя: ответы на его комментарии, посты и комментарии на его странице, от новых к старым.
+
+    Строки входящих записывает :func:`app.comments.new_comment`, а поддерживают :func:`app.comments.update_comment`
+    и :func:`app.comments.remove_comment`, поэтому страница — чтение по первичному ключу ``replies_inbox``
+    (пользователь, время) и самих комментариев по их первичному ключу, а количество непрочитанных — по частичному
+    индексу. Страницы выбираются по ключу (время создания, идентификатор) последней записи, курсор —
+    как у ленты (:func:`app.feed.feed_cursor`).
+
+    :param conn: Psycopg2 соединение
+    :param int user_id: Идентификатор пользователя
+    :param str cursor: Курсор следующей страницы из предыдущего ответа, None — первая страница
+    :param int limit: Количество результатов на странице
+    :return: Количество непрочитанных, Список ответов с признаком прочтения *read* и Курсор следующей страницы либо
+        None для последней; None, если пользователь не найден
+    :rtype: tuple
+    :raises ValueError: Курсор не распознан
+    """
+    if get_user(conn, user_id) is None:
+        return None
+    filters, values = '', []
+    if cursor is not None:
+        since, comment_id = parse_feed_cursor(cursor)
+        filters = " AND I.datetime <= %s AND (I.datetime, I.commentid) < (%s, %s)"
+        values = [since, since, comment_id]
+
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute("SET timezone = 'Europe/Moscow';")
+    cur.execute("SELECT COUNT(*) AS unread FROM replies_inbox WHERE userid = %s AND read = FALSE;", [user_id])
+    unread = cur.fetchone()['unread']
+    # noinspection SqlResolve
+    cur.execute("SELECT " + comment_columns(None, extra=['I.read']) + " "
+                "FROM replies_inbox AS I "
+                "  JOIN comments AS C ON C.commentid = I.commentid AND C.datetime = I.datetime "
+                "WHERE I.userid = %s AND NOT C.deleted" + filters + " "
+                "ORDER BY I.datetime DESC, I.commentid DESC "
+                "LIMIT %s;", [user_id] + values + [limit + 1])
+    records = cur.fetchall()
+    cur.close()
+    conn.commit()
+    next_cursor = None
+    if len(records) > limit:
+        records = records[:limit]
+        next_cursor = feed_cursor(records[-1])
+    return unread, fill_authors(conn, records), next_cursor
+
+
+def mark_replies_read(conn, user_id: int, until: Optional[int] = None) -> int:
+    """
+    Отметка входящих ответов пользователя прочитанными.
+
+    :param conn: Psycopg2 соединение
+    :param int user_id: Идентификатор пользователя
+    :param int until: Идентификатор ответа: отмечаются он и все более ранние ответы; None — все ответы
+    :return: Количество непрочитанных ответов после отметки
+    :rtype: int
+    """
+    try:
+        cur = conn.cursor()
+        query = "UPDATE replies_inbox SET read = TRUE WHERE userid = %s AND read = FALSE"
+        values = [user_id]
+        if until is not None:
+            query += " AND datetime <= (SELECT datetime FROM replies_inbox WHERE userid = %s AND commentid = %s)"
+            values += [user_id, until]
+        cur.execute(query + ";", values)
+        cur.execute("SELECT COUNT(*) FROM replies_inbox WHERE userid = %s AND read = FALSE;", [user_id])
+        unread = cur.fetchone()[0]
+        conn.commit()
+        cur.close()
+    except psycopg2.DatabaseError as e:
+        raise DatabaseException(e)
+    return unread
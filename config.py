@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -26,6 +27,31 @@ class Config(object):
     JSON_ENSURE_ASCII = False
     JSON_INDENT = 0
     XML2DICT_PRETTY = False
+    EVENTS_PAYLOAD = 'full'
+    EVENTS_COALESCE_WINDOW = 0.0
+    EVENTS_COALESCE_MAX = 100
+    EVENTS_SUBTREE_DEPTH = 100
+    STREAMS_QUEUE_SIZE = 100
+    STREAMS_OVERFLOW = 'drop_oldest'
+    STREAMS_KEEPALIVE = 15
+    PARTITIONS_AHEAD = 2
+    HISTORY_RETENTION_MONTHS = 24
+    HISTORY_COMPACT_AFTER_DAYS = 30
+    ENTITY_ID_CACHE_TTL = 86400
+    RESPONSE_CACHE_TTL = 300
+    EXPORT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'any-comment-exports')
+    EXPORT_CACHE_MAX_AGE = 86400
+    EXPORT_CACHE_MAX_SIZE = 1024 ** 3
+    EXPORT_ACCEL_REDIRECT = None
+    EXPORT_JOB_TTL = 86400
+    EXPORT_JOB_PROGRESS_EVERY = 1000
+    STREAM_COMPRESSION = True
+    STREAM_COMPRESSION_LEVEL = 6
+    STREAM_CHUNK_SIZE = 16384
+    STREAM_MAX_LATENCY = 0.5
+    BATCH_MAX_IDS = 500
+    FEED_MAX_SOURCES = 200
+    AUTHOR_CACHE_SIZE = 10000
 
 
 class ProductionConfig(Config):
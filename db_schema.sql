@@ -14,41 +14,111 @@ CREATE TABLE users
 )
   INHERITS (entities);
 
+-- Автор родительской сущности нового комментария (входящие ответы): WHERE entityid = ?
+CREATE UNIQUE INDEX users_entityid_index
+  ON users (entityid);
+
+CREATE FUNCTION add_month_partition(parent TEXT, key TEXT, month DATE)
+  RETURNS TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  from_dt TIMESTAMP WITH TIME ZONE := date_trunc('month', month);
+  to_dt   TIMESTAMP WITH TIME ZONE := date_trunc('month', month) + INTERVAL '1 month';
+  name    TEXT := parent || '_' || to_char(month, 'YYYY_MM');
+BEGIN
+  --
+  -- Создаёт месячную секцию таблицы, секционированной по времени, если её ещё нет. Строки за этот месяц, успевшие
+  -- попасть в секцию по умолчанию (<parent>_default), переносятся в новую секцию.
+  --
+  IF to_regclass(name) IS NOT NULL
+  THEN
+    RETURN name;
+  END IF;
+  EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING GENERATED, '
+                 'CHECK (%I >= %L AND %I < %L))', name, parent, key, from_dt, key, to_dt);
+  EXECUTE format('INSERT INTO %I SELECT * FROM %I WHERE %I >= %L AND %I < %L',
+                 name, parent || '_default', key, from_dt, key, to_dt);
+  EXECUTE format('DELETE FROM %I WHERE %I >= %L AND %I < %L', parent || '_default', key, from_dt, key, to_dt);
+  EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', parent, name, from_dt, to_dt);
+  RETURN name;
+END;
+$$;
+
+CREATE FUNCTION drop_month_partitions(parent TEXT, older_than TIMESTAMP WITH TIME ZONE)
+  RETURNS SETOF TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  name TEXT;
+BEGIN
+  --
+  -- Удаляет месячные секции таблицы, целиком лежащие до указанного момента. Удаление секции не зависит от числа
+  -- строк в ней.
+  --
+  FOR name IN
+  SELECT C.relname
+  FROM pg_inherits AS I
+    JOIN pg_class AS C ON C.oid = I.inhrelid
+  WHERE I.inhparent = parent :: REGCLASS
+        AND C.relname ~ ('^' || parent || '_\d{4}_\d{2}$')
+        AND to_date(substring(C.relname FROM '\d{4}_\d{2}$'), 'YYYY_MM') + INTERVAL '1 month' <= older_than
+  ORDER BY C.relname
+  LOOP
+    EXECUTE format('DROP TABLE %I', name);
+    RETURN NEXT name;
+  END LOOP;
+END;
+$$;
+
+-- Комментарии секционированы по месяцам даты создания: фильтры по дате затрагивают только нужные секции.
+-- Идентификатор сущности берётся из общей с entities последовательности — секционированная таблица не может
+-- наследоваться от entities.
 CREATE TABLE comments
 (
-  commentid SERIAL                                 NOT NULL
-    CONSTRAINT comments_pkey
-    PRIMARY KEY,
-  userid    INTEGER DEFAULT 0                      NOT NULL
+  entityid  INTEGER DEFAULT nextval('entities_entityid_seq' :: REGCLASS) NOT NULL,
+  commentid SERIAL                                                       NOT NULL,
+  userid    INTEGER DEFAULT 0                                            NOT NULL
     CONSTRAINT comments_users_userid_fk
     REFERENCES users,
-  datetime  TIMESTAMP WITH TIME ZONE DEFAULT now() NOT NULL,
-  parentid  INTEGER DEFAULT 0                      NOT NULL,
-  deleted   BOOLEAN DEFAULT FALSE                  NOT NULL,
-  text      TEXT DEFAULT '' :: TEXT                NOT NULL
+  datetime  TIMESTAMP WITH TIME ZONE DEFAULT now()                       NOT NULL,
+  parentid  INTEGER DEFAULT 0                                            NOT NULL,
+  deleted   BOOLEAN DEFAULT FALSE                                        NOT NULL,
+  text      TEXT DEFAULT '' :: TEXT                                      NOT NULL,
+  text_tsv  TSVECTOR,
+  CONSTRAINT comments_pkey
+  PRIMARY KEY (commentid, datetime)
 )
-  INHERITS (entities);
+  PARTITION BY RANGE (datetime);
+
+-- Сюда попадают комментарии, для месяца которых ещё не создана секция
+CREATE TABLE comments_default
+  PARTITION OF comments DEFAULT;
 
 CREATE INDEX comments_entityid_index
   ON comments (entityid);
 
-CREATE INDEX comments_commentid_deleted_index
-  ON comments (commentid, deleted);
+-- Комментарии первого уровня и рекурсия comments_tree(): WHERE parentid = ? AND NOT deleted ORDER BY datetime
+CREATE INDEX comments_parentid_live_index
+  ON comments (parentid, datetime) INCLUDE (entityid, commentid, userid)
+  WHERE NOT deleted;
 
-CREATE INDEX comments_userid_index
-  ON comments (userid);
+-- Комментарии пользователя: WHERE userid = ? ORDER BY datetime
+CREATE INDEX comments_userid_datetime_index
+  ON comments (userid, datetime);
 
 CREATE INDEX comments_datetime_index
   ON comments (datetime);
 
-CREATE INDEX comments_parentid_deleted_index
-  ON comments (parentid, deleted);
-
-CREATE INDEX comments_parentid_index
-  ON comments (parentid);
+-- Подсчёт удалённых комментариев
+CREATE INDEX comments_deleted_partial_index
+  ON comments (commentid)
+  WHERE deleted;
 
-CREATE INDEX comments_deleted_index
-  ON comments (deleted);
+-- Полнотекстовый поиск: WHERE text_tsv @@ websearch_to_tsquery('russian', ?) AND NOT deleted
+CREATE INDEX comments_text_tsv_index
+  ON comments USING GIN (text_tsv)
+  WHERE NOT deleted;
 
 CREATE FUNCTION comments_log()
   RETURNS TRIGGER
@@ -72,14 +142,40 @@ BEGIN
 END;
 $$;
 
+-- История пишется только при изменении данных комментария: смена флага deleted и обновления без реальных
+-- изменений предыдущую версию не копируют.
 CREATE TRIGGER comments_log
 BEFORE UPDATE
   ON comments
 FOR EACH ROW
+WHEN (OLD.userid IS DISTINCT FROM NEW.userid OR OLD.datetime IS DISTINCT FROM NEW.datetime OR
+      OLD.parentid IS DISTINCT FROM NEW.parentid OR OLD.text IS DISTINCT FROM NEW.text)
 EXECUTE PROCEDURE comments_log();
 
+CREATE FUNCTION comments_tsv()
+  RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  --
+  -- Поддерживает поисковый вектор текста комментария. Столбец не объявлен GENERATED: add_month_partition()
+  -- переносит строки через INSERT … SELECT *, что с вычисляемыми столбцами невозможно.
+  --
+  NEW.text_tsv := to_tsvector('russian', NEW.text);
+  RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER comments_tsv
+BEFORE INSERT OR UPDATE OF text
+  ON comments
+FOR EACH ROW
+EXECUTE PROCEDURE comments_tsv();
+
 COMMENT ON COLUMN comments.userid IS 'Автор комментария';
 
+COMMENT ON COLUMN comments.text_tsv IS 'Поисковый вектор текста комментария (русская конфигурация)';
+
 CREATE TABLE posts
 (
   postid SERIAL                  NOT NULL
@@ -91,11 +187,39 @@ CREATE TABLE posts
 )
   INHERITS (entities);
 
+CREATE UNIQUE INDEX posts_entityid_index
+  ON posts (entityid);
+
+-- Входящие ответы пользователей: строка на каждый ответ на пост, комментарий или страницу пользователя, записываемая
+-- вместе с самим ответом (см. new_comment()). Список ответов и число непрочитанных читаются по индексам этой таблицы.
+CREATE TABLE replies_inbox
+(
+  userid    INTEGER                         NOT NULL
+    CONSTRAINT replies_inbox_users_userid_fk
+    REFERENCES users
+    ON DELETE CASCADE,
+  commentid INTEGER                         NOT NULL,
+  datetime  TIMESTAMP WITH TIME ZONE        NOT NULL,
+  parentid  INTEGER                         NOT NULL,
+  read      BOOLEAN DEFAULT FALSE           NOT NULL,
+  CONSTRAINT replies_inbox_pkey
+  PRIMARY KEY (userid, datetime, commentid)
+);
+
+-- Удаление строки вместе с удаляемым комментарием
+CREATE INDEX replies_inbox_commentid_index
+  ON replies_inbox (commentid);
+
+-- Счётчик непрочитанных: WHERE userid = ? AND NOT read
+CREATE INDEX replies_inbox_unread_index
+  ON replies_inbox (userid)
+  WHERE NOT read;
+
+-- История правок секционирована по месяцам времени правки: старые секции удаляются целиком (см.
+-- drop_month_partitions), а запросы с фильтром по ch_datetime затрагивают только нужные секции.
 CREATE TABLE comments_history
 (
-  id          SERIAL                                 NOT NULL
-    CONSTRAINT comments_history_pkey
-    PRIMARY KEY,
+  id          SERIAL                                 NOT NULL,
   entityid    INTEGER DEFAULT 0                      NOT NULL,
   commentid   INTEGER DEFAULT 0                      NOT NULL,
   userid      INTEGER DEFAULT 0                      NOT NULL
@@ -105,15 +229,58 @@ CREATE TABLE comments_history
   parentid    INTEGER DEFAULT 0                      NOT NULL,
   ch_datetime TIMESTAMP WITH TIME ZONE DEFAULT now() NOT NULL,
   ch_userid   INTEGER                                NOT NULL,
-  text        TEXT DEFAULT '' :: TEXT                NOT NULL
-);
+  text        TEXT DEFAULT '' :: TEXT                NOT NULL,
+  CONSTRAINT comments_history_pkey
+  PRIMARY KEY (id, ch_datetime)
+)
+  PARTITION BY RANGE (ch_datetime);
+
+-- Сюда попадают правки, для месяца которых ещё не создана секция
+CREATE TABLE comments_history_default
+  PARTITION OF comments_history DEFAULT;
 
-CREATE INDEX comments_history_commentid_index
-  ON comments_history (commentid);
+CREATE INDEX comments_history_commentid_ch_datetime_index
+  ON comments_history (commentid, ch_datetime);
+
+CREATE INDEX comments_history_ch_userid_ch_datetime_index
+  ON comments_history (ch_userid, ch_datetime);
 
 CREATE INDEX comments_history_ch_datetime_index
   ON comments_history (ch_datetime);
 
+CREATE FUNCTION comments_history_compact(older_than TIMESTAMP WITH TIME ZONE)
+  RETURNS BIGINT
+LANGUAGE SQL
+AS $$
+-- Схлопывает идущие подряд версии комментария с одинаковым текстом (правились только автор, дата или родитель):
+-- из каждой такой серии остаётся последняя версия. Затрагиваются только правки, сделанные до указанного момента.
+WITH versions AS (
+  SELECT
+    id,
+    ch_datetime,
+    text = lead(text)
+    OVER (
+      PARTITION BY commentid
+      ORDER BY ch_datetime, id ) AS duplicate
+  FROM comments_history
+  WHERE commentid IN (SELECT commentid
+                      FROM comments_history
+                      WHERE ch_datetime < older_than)
+), removed AS (
+  DELETE FROM comments_history AS H
+  USING versions AS V
+  WHERE H.id = V.id AND H.ch_datetime = V.ch_datetime AND V.duplicate AND V.ch_datetime < older_than
+  RETURNING 1
+)
+SELECT COUNT(*)
+FROM removed
+$$;
+
+SELECT add_month_partition('comments', 'datetime', now() :: DATE);
+SELECT add_month_partition('comments', 'datetime', (now() + INTERVAL '1 month') :: DATE);
+SELECT add_month_partition('comments_history', 'ch_datetime', now() :: DATE);
+SELECT add_month_partition('comments_history', 'ch_datetime', (now() + INTERVAL '1 month') :: DATE);
+
 CREATE FUNCTION comments_tree(parent_id INTEGER)
   RETURNS SETOF COMMENTS
 LANGUAGE SQL
@@ -134,6 +301,73 @@ FROM t
 ORDER BY entityid
 $$;
 
+CREATE FUNCTION comments_tree_limited(parent_id INTEGER, max_depth INTEGER DEFAULT NULL,
+                                      per_parent_limit INTEGER DEFAULT NULL)
+  RETURNS TABLE(entityid INTEGER, commentid INTEGER, userid INTEGER, datetime TIMESTAMP WITH TIME ZONE,
+                parentid INTEGER, deleted BOOLEAN, text TEXT, depth INTEGER, hidden_replies BIGINT)
+LANGUAGE SQL
+STABLE
+AS $$
+-- Поддерево comments_tree(), ограниченное по глубине (max_depth уровней) и по числу ответов на каждый комментарий
+-- (первые per_parent_limit по дате создания). NULL снимает соответствующее ограничение. Рекурсия не спускается ниже
+-- max_depth, а ответы сверх лимита не читаются вовсе: каждый шаг — LATERAL-выборка с LIMIT по индексу
+-- comments_parentid_live_index. Для каждого комментария возвращается число скрытых ответов: не вошедших в лимит
+-- либо лежащих ниже max_depth.
+-- noinspection SqlResolve
+WITH RECURSIVE t AS (
+  SELECT C.*, 1 AS depth
+  FROM (SELECT *
+        FROM comments AS F
+        WHERE F.parentid = parent_id AND NOT F.deleted
+        ORDER BY F.datetime
+        LIMIT per_parent_limit) AS C
+  UNION ALL
+  SELECT C.*, t.depth + 1
+  FROM t
+    CROSS JOIN LATERAL (SELECT *
+                        FROM comments AS F
+                        WHERE F.parentid = t.entityid AND NOT F.deleted
+                        ORDER BY F.datetime
+                        LIMIT per_parent_limit) AS C
+  WHERE max_depth IS NULL OR t.depth < max_depth
+)
+SELECT t.entityid, t.commentid, t.userid, t.datetime, t.parentid, t.deleted, t.text, t.depth,
+  GREATEST((SELECT count(*)
+            FROM comments AS R
+            WHERE R.parentid = t.entityid AND NOT R.deleted) -
+           CASE WHEN max_depth IS NOT NULL AND t.depth >= max_depth THEN 0
+           ELSE coalesce(per_parent_limit, 2147483647) END, 0)
+FROM t
+ORDER BY t.entityid
+$$;
+
+CREATE FUNCTION comment_ancestors(entity_id INTEGER, max_count INTEGER DEFAULT 100)
+  RETURNS SETOF INTEGER
+LANGUAGE SQL
+AS $$
+-- Сама сущность и её предки вверх по дереву комментариев, вплоть до поста или пользователя.
+-- Каждый шаг — поиск по индексу comments_entityid_index.
+WITH RECURSIVE t(entityid, parentid, num) AS (
+  SELECT
+    entity_id,
+    (SELECT parentid
+     FROM comments
+     WHERE comments.entityid = entity_id),
+    1
+  UNION ALL
+  SELECT
+    t.parentid,
+    (SELECT parentid
+     FROM comments
+     WHERE comments.entityid = t.parentid),
+    t.num + 1
+  FROM t
+  WHERE t.parentid IS NOT NULL AND t.num < max_count
+)
+SELECT entityid
+FROM t
+$$;
+
 CREATE FUNCTION comment_history(comment_id INTEGER, OUT entityid INTEGER, OUT commentid INTEGER, OUT userid INTEGER,
                                                     OUT datetime TIMESTAMP WITH TIME ZONE, OUT parentid INTEGER,
                                                     OUT text TEXT, OUT deleted BOOLEAN,
@@ -141,6 +375,7 @@ CREATE FUNCTION comment_history(comment_id INTEGER, OUT entityid INTEGER, OUT co
                                                     OUT id INTEGER)
   RETURNS SETOF RECORD
 LANGUAGE SQL
+STABLE
 AS $$
 SELECT
   entityid,
@@ -172,3 +407,20 @@ UNION ALL
  ORDER BY ch_datetime DESC)
 $$;
 
+-- Применённые миграции схемы (см. каталог migrations/). Эта схема уже содержит все перечисленные ниже версии.
+CREATE TABLE schema_migrations
+(
+  version    INTEGER                                NOT NULL
+    CONSTRAINT schema_migrations_pkey
+    PRIMARY KEY,
+  name       TEXT                                   NOT NULL,
+  applied_at TIMESTAMP WITH TIME ZONE DEFAULT now() NOT NULL
+);
+
+INSERT INTO schema_migrations (version, name) VALUES
+  (1, 'hot_path_indexes'),
+  (2, 'comments_tree_limited'),
+  (3, 'comments_search'),
+  (4, 'comments_search_index'),
+  (5, 'replies_inbox'),
+  (6, 'entity_owner_indexes');
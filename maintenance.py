@@ -0,0 +1,42 @@
+import argparse
+
+from colorama import Fore, Style, init
+
+from any_comment import create_app
+from app.common import db_conn
+from app.maintenance import add_partitions, history_retention, history_compact, export_cache_sweep
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Обслуживание базы данных и кэша выгрузок any-comment')
+    parser.add_argument('--no-compact', action='store_true', help='Не сжимать историю правок')
+    parser.add_argument('--no-retention', action='store_true', help='Не удалять старые секции истории правок')
+    parser.add_argument('--no-sweep', action='store_true', help='Не очищать кэш выгрузок')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        conn = db_conn()
+
+        names = add_partitions(conn, app.config['PARTITIONS_AHEAD'])
+        print('Секции: ' + Fore.CYAN + ', '.join(names) + Style.RESET_ALL)
+
+        if not args.no_retention:
+            names = history_retention(conn, app.config['HISTORY_RETENTION_MONTHS'])
+            print('Удалены секции: ' + Fore.YELLOW + (', '.join(names) or '—') + Style.RESET_ALL)
+
+        if not args.no_compact:
+            cnt = history_compact(conn, app.config['HISTORY_COMPACT_AFTER_DAYS'])
+            print('Схлопнуто версий: ' + Fore.GREEN + str(cnt) + Style.RESET_ALL)
+
+        conn.close()
+
+        if not args.no_sweep:
+            names = export_cache_sweep(app.config['EXPORT_CACHE_DIR'], app.config['EXPORT_CACHE_MAX_AGE'],
+                                       app.config['EXPORT_CACHE_MAX_SIZE'])
+            print('Удалено выгрузок: ' + Fore.YELLOW + str(len(names)) + Style.RESET_ALL)
+
+
+if __name__ == '__main__':
+    init(autoreset=True)
+    main()
@@ -0,0 +1,35 @@
+import argparse
+
+from colorama import Fore, Style, init
+
+from any_comment import create_app
+from app.common import db_conn
+from app.migrations import available, applied, migrate
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Миграции схемы базы данных any-comment')
+    parser.add_argument('--list', action='store_true', help='Только показать состояние миграций')
+    parser.add_argument('--target', type=int, default=None, help='Применить миграции до указанной версии включительно')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        conn = db_conn()
+
+        if args.list:
+            done = applied(conn)
+            for migration in available():
+                mark = Fore.GREEN + 'применена' if migration.version in done else Fore.YELLOW + 'ожидает'
+                print('%04d %s: %s' % (migration.version, migration.name, mark) + Style.RESET_ALL)
+        else:
+            for migration in migrate(conn, args.target):
+                print('Применена миграция ' + Fore.CYAN + '%04d %s' % (migration.version, migration.name) +
+                      Style.RESET_ALL)
+
+        conn.close()
+
+
+if __name__ == '__main__':
+    init(autoreset=True)
+    main()
@@ -0,0 +1,26 @@
+-- migrate: no-transaction
+--
+-- Индексы под реальные горячие запросы вместо пересекающихся индексов по parentid/deleted.
+--
+-- Комментарии первого уровня и рекурсия comments_tree(): WHERE parentid = ? AND NOT deleted ORDER BY datetime.
+-- Частичный индекс содержит только живые комментарии, а включённые столбцы позволяют считать их без обращения к
+-- таблице.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS comments_parentid_live_index
+  ON comments (parentid, datetime) INCLUDE (entityid, commentid, userid)
+  WHERE NOT deleted;
+
+-- Комментарии пользователя: WHERE userid = ? ORDER BY datetime
+CREATE INDEX CONCURRENTLY IF NOT EXISTS comments_userid_datetime_index
+  ON comments (userid, datetime);
+
+-- Подсчёт удалённых комментариев в get_comments(): удалённых мало, индекс крошечный
+CREATE INDEX CONCURRENTLY IF NOT EXISTS comments_deleted_partial_index
+  ON comments (commentid)
+  WHERE deleted;
+
+-- Индексы секционированной таблицы нельзя удалить конкурентно, удаление меняет только каталог
+DROP INDEX IF EXISTS comments_parentid_index;
+DROP INDEX IF EXISTS comments_parentid_deleted_index;
+DROP INDEX IF EXISTS comments_deleted_index;
+DROP INDEX IF EXISTS comments_commentid_deleted_index;
+DROP INDEX IF EXISTS comments_userid_index;
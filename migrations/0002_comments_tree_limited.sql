@@ -0,0 +1,40 @@
+-- Ограниченная по глубине и ширине выборка поддерева комментариев для /descendants?max_depth=…&per_parent_limit=…
+CREATE FUNCTION comments_tree_limited(parent_id INTEGER, max_depth INTEGER DEFAULT NULL,
+                                      per_parent_limit INTEGER DEFAULT NULL)
+  RETURNS TABLE(entityid INTEGER, commentid INTEGER, userid INTEGER, datetime TIMESTAMP WITH TIME ZONE,
+                parentid INTEGER, deleted BOOLEAN, text TEXT, depth INTEGER, hidden_replies BIGINT)
+LANGUAGE SQL
+STABLE
+AS $$
+-- Поддерево comments_tree(), ограниченное по глубине (max_depth уровней) и по числу ответов на каждый комментарий
+-- (первые per_parent_limit по дате создания). NULL снимает соответствующее ограничение. Рекурсия не спускается ниже
+-- max_depth, а ответы сверх лимита не читаются вовсе: каждый шаг — LATERAL-выборка с LIMIT по индексу
+-- comments_parentid_live_index. Для каждого комментария возвращается число скрытых ответов: не вошедших в лимит
+-- либо лежащих ниже max_depth.
+-- noinspection SqlResolve
+WITH RECURSIVE t AS (
+  SELECT C.*, 1 AS depth
+  FROM (SELECT *
+        FROM comments AS F
+        WHERE F.parentid = parent_id AND NOT F.deleted
+        ORDER BY F.datetime
+        LIMIT per_parent_limit) AS C
+  UNION ALL
+  SELECT C.*, t.depth + 1
+  FROM t
+    CROSS JOIN LATERAL (SELECT *
+                        FROM comments AS F
+                        WHERE F.parentid = t.entityid AND NOT F.deleted
+                        ORDER BY F.datetime
+                        LIMIT per_parent_limit) AS C
+  WHERE max_depth IS NULL OR t.depth < max_depth
+)
+SELECT t.entityid, t.commentid, t.userid, t.datetime, t.parentid, t.deleted, t.text, t.depth,
+  GREATEST((SELECT count(*)
+            FROM comments AS R
+            WHERE R.parentid = t.entityid AND NOT R.deleted) -
+           CASE WHEN max_depth IS NOT NULL AND t.depth >= max_depth THEN 0
+           ELSE coalesce(per_parent_limit, 2147483647) END, 0)
+FROM t
+ORDER BY t.entityid
+$$;
@@ -0,0 +1,25 @@
+-- Полнотекстовый поиск по комментариям (/comments/search): столбец text_tsv с поисковым вектором текста.
+--
+-- Столбец поддерживается триггером, а не объявлен GENERATED: добавление вычисляемого столбца переписало бы всю
+-- таблицу под исключительной блокировкой, а add_month_partition() переносит строки через INSERT … SELECT *, что с
+-- вычисляемыми столбцами невозможно. Столбец без значения по умолчанию добавляется без перезаписи таблицы, а
+-- существующие строки заполняются порциями вне транзакции в 0004_comments_search_index.
+ALTER TABLE comments ADD COLUMN IF NOT EXISTS text_tsv TSVECTOR;
+
+CREATE FUNCTION comments_tsv()
+  RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  NEW.text_tsv := to_tsvector('russian', NEW.text);
+  RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER comments_tsv
+BEFORE INSERT OR UPDATE OF text
+  ON comments
+FOR EACH ROW
+EXECUTE PROCEDURE comments_tsv();
+
+COMMENT ON COLUMN comments.text_tsv IS 'Поисковый вектор текста комментария (русская конфигурация)';
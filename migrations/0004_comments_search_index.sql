@@ -0,0 +1,12 @@
+-- migrate: no-transaction
+--
+-- Заполнение text_tsv существующих комментариев порциями по диапазону commentid, каждая — в своей транзакции: строки
+-- не блокируются на всё время заполнения, а место старых версий строк переиспользуется между порциями. Триггер
+-- comments_log реагирует только на изменение данных комментария, поэтому заполнение истории не пишет.
+UPDATE comments SET text_tsv = to_tsvector('russian', text)
+  WHERE commentid >= %(lo)s AND commentid < %(hi)s AND text_tsv IS NULL;
+
+-- GIN-индекс поиска по тексту живых комментариев: WHERE text_tsv @@ websearch_to_tsquery('russian', ?) AND NOT deleted
+CREATE INDEX CONCURRENTLY IF NOT EXISTS comments_text_tsv_index
+  ON comments USING GIN (text_tsv)
+  WHERE NOT deleted;
@@ -0,0 +1,36 @@
+-- Входящие ответы пользователей (/users/{user_id}/replies): строка на каждый ответ на пост, комментарий или страницу
+-- пользователя, записываемая new_comment() вместе с самим ответом. Список ответов и число непрочитанных — чтение по
+-- индексу одной таблицы вместо обхода всех комментариев пользователя и их потомков.
+CREATE TABLE replies_inbox
+(
+  userid    INTEGER                         NOT NULL
+    CONSTRAINT replies_inbox_users_userid_fk
+    REFERENCES users
+    ON DELETE CASCADE,
+  commentid INTEGER                         NOT NULL,
+  datetime  TIMESTAMP WITH TIME ZONE        NOT NULL,
+  parentid  INTEGER                         NOT NULL,
+  read      BOOLEAN DEFAULT FALSE           NOT NULL,
+  CONSTRAINT replies_inbox_pkey
+  PRIMARY KEY (userid, datetime, commentid)
+);
+
+-- Удаление строки вместе с удаляемым комментарием
+CREATE INDEX replies_inbox_commentid_index
+  ON replies_inbox (commentid);
+
+-- Счётчик непрочитанных: WHERE userid = ? AND NOT read
+CREATE INDEX replies_inbox_unread_index
+  ON replies_inbox (userid)
+  WHERE NOT read;
+
+-- Уже существующие ответы попадают во входящие прочитанными
+INSERT INTO replies_inbox (userid, commentid, datetime, parentid, read)
+  SELECT O.userid, C.commentid, C.datetime, C.parentid, TRUE
+  FROM comments AS C
+    JOIN (SELECT entityid, userid FROM users
+          UNION ALL
+          SELECT P.entityid, P.userid FROM posts AS P JOIN users AS U ON U.userid = P.userid
+          UNION ALL
+          SELECT entityid, userid FROM comments) AS O ON O.entityid = C.parentid
+  WHERE NOT C.deleted AND O.userid <> C.userid;
@@ -0,0 +1,8 @@
+-- migrate: no-transaction
+--
+-- Поиск автора родительской сущности нового комментария для входящих ответов: WHERE entityid = ?
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS users_entityid_index
+  ON users (entityid);
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS posts_entityid_index
+  ON posts (entityid);
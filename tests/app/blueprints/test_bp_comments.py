@@ -208,3 +208,39 @@ def test_get_descendants_attach_xml(app, client):
         assert len(xml_resp['response']['record']) >= 1
         xml_rec = dict(random.choice(list(xml_resp['response']['record'])))
         check_record(parse_xml_comment(xml_rec))
+
+
+def test_get_history(app, client):
+    with app.app_context():
+        comment = random.choice(get_comments(db_conn())[1])
+        res = client.get(url_for('comments.get_history', comment_id=comment['commentid']))
+        assert res.status_code == 200
+        assert res.json['total'] >= 1
+        assert res.json['response'][0]['text'] == comment['text']
+        assert res.json['response'][0]['version_id'] is None
+        res = client.get(url_for('comments.get_history', comment_id=comment['commentid'], fmt='csv'))
+        assert res.status_code == 200
+        with StringIO(str(res.data, encoding='windows-1251')) as f:
+            records = list(csv.DictReader(f, delimiter=";"))
+        assert records[0]['commentid'] == str(comment['commentid'])
+        res = client.get(url_for('comments.get_history', comment_id=0))
+        assert res.status_code == 404
+
+
+def test_search_comments(app, client):
+    with app.app_context():
+        post = random.choice(get_posts(db_conn())[1])
+        userid = random.choice(get_users(db_conn())[1])['userid']
+        word = 'квазислово%d' % random.randrange(10 ** 9)
+        comment_id = new_comment(db_conn(), {'userid': userid, 'parentid': post['entityid'], 'text': word})[0]
+        res = client.get(url_for('comments.search_comments', q=word, post_id=post['postid']))
+        assert res.status_code == 200
+        assert [rec['commentid'] for rec in res.json['response']] == [comment_id]
+        assert res.json['next'] is None
+        res = client.get(url_for('comments.search_comments', q=word, user_id=userid, after='2000-01-01'))
+        assert [rec['commentid'] for rec in res.json['response']] == [comment_id]
+        assert client.get(url_for('comments.search_comments', q=word)).status_code == 400
+        assert client.get(url_for('comments.search_comments', post_id=post['postid'])).status_code == 400
+        assert client.get(url_for('comments.search_comments', q=word, user_id=userid,
+                                  cursor='x')).status_code == 400
+        assert client.get(url_for('comments.search_comments', q=word, post_id=0)).status_code == 404
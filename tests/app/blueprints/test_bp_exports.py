@@ -0,0 +1,41 @@
+import random
+
+from flask import url_for
+
+from app.common import db_conn, redis_conn
+from app.jobs import run_job, QUEUE_KEY
+from app.posts import get_posts
+
+
+def test_export_job(app, client):
+    with app.app_context():
+        post = random.choice(get_posts(db_conn())[1])
+        res = client.post(url_for('exports.post_export', kind='posts', object_id=post['postid'], fmt='xml'))
+        assert res.status_code == 202
+        job = res.json['response']
+        assert 'path' not in job
+        status_url = url_for('exports.export_status', job_id=job['job_id'])
+        download_url = url_for('exports.export_download', job_id=job['job_id'])
+        if job['status'] != 'done':
+            assert client.get(download_url).status_code == 409
+            redis = redis_conn()
+            redis.lrem(QUEUE_KEY, 0, job['job_id'])
+            run_job(redis, db_conn(), job['job_id'])
+        res = client.get(status_url)
+        assert res.status_code == 200
+        assert res.json['response']['status'] == 'done'
+        res = client.get(download_url)
+        assert res.status_code == 200
+        assert res.headers['Content-Disposition'] == 'attachment; filename=post%d_descendants.xml' % post['postid']
+        assert res.data == client.get(url_for('posts.get_descendants', post_id=post['postid'], fmt='xml')).data
+
+
+def test_export_job_errors(app, client):
+    with app.app_context():
+        post = random.choice(get_posts(db_conn())[1])
+        res = client.post(url_for('exports.post_export', kind='posts', object_id=post['postid'], fmt='doc'))
+        assert res.status_code == 400
+        res = client.post(url_for('exports.post_export', kind='posts', object_id=-1, fmt='csv'))
+        assert res.status_code == 404
+        assert client.get(url_for('exports.export_status', job_id='unknown')).status_code == 404
+        assert client.get(url_for('exports.export_download', job_id='unknown')).status_code == 404
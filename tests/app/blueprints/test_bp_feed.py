@@ -0,0 +1,25 @@
+import random
+
+from flask import url_for
+
+from app.comments import new_comment
+from app.common import db_conn
+from app.posts import get_posts
+from app.users import get_users
+
+
+def test_get_feed(app, client):
+    with app.app_context():
+        userid = random.choice(get_users(db_conn())[1])['userid']
+        post = random.choice(get_posts(db_conn())[1])
+        ids = [new_comment(db_conn(), {'userid': userid, 'parentid': post['entityid'], 'text': 'Лента'})[0]
+               for _ in range(2)]
+        res = client.get(url_for('feeds.get_feed', users=str(userid), posts=str(post['postid']), per_page=1))
+        assert res.status_code == 200
+        assert [rec['commentid'] for rec in res.json['response']] == [ids[1]]
+        res = client.get(url_for('feeds.get_feed', users=str(userid), per_page=1, cursor=res.json['next']))
+        assert res.status_code == 200
+        assert [rec['commentid'] for rec in res.json['response']] == [ids[0]]
+        assert client.get(url_for('feeds.get_feed')).status_code == 400
+        assert client.get(url_for('feeds.get_feed', users='x')).status_code == 400
+        assert client.get(url_for('feeds.get_feed', users=str(userid), cursor='x')).status_code == 400
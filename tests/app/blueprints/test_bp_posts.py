@@ -1,9 +1,11 @@
+import gzip
 import random
 
 from elizabeth import Generic
 from flaky import flaky
 from flask import url_for
 
+from app.comments import new_comment
 from app.common import db_conn, to_json
 from app.posts import get_posts, get_post, new_post
 from app.types import Post
@@ -41,6 +43,24 @@ def test_get_one(app, client):
             assert name in res.json['response']
 
 
+def test_get_one_conditional(app, client):
+    with app.app_context():
+        post = random.choice(get_posts(db_conn())[1])
+        res = client.get(url_for('posts.post', post_id=post['postid']))
+        assert res.status_code == 200
+        etag = res.headers.get('ETag')
+        assert etag
+        res = client.get(url_for('posts.post', post_id=post['postid']), headers={'If-None-Match': etag})
+        assert res.status_code == 304
+        assert res.data == b''
+        res = client.put(url_for('posts.put_post', post_id=post['postid']), data=to_json({'title': g.text.title()}),
+                         content_type='application/json')
+        assert res.status_code == 200
+        res = client.get(url_for('posts.post', post_id=post['postid']), headers={'If-None-Match': etag})
+        assert res.status_code == 200
+        assert res.headers.get('ETag') != etag
+
+
 def test_put(app, client):
     with app.app_context():
         post = random.choice(get_posts(db_conn())[1])
@@ -102,6 +122,24 @@ def test_first_level_comments(app, client):
         assert isinstance(res.json['response'], list)
 
 
+def test_first_level_comments_cache(app, client):
+    with app.app_context():
+        post = random.choice(get_posts(db_conn())[1])
+        url = url_for('posts.get_first_level_comments', post_id=post['postid'], per_page=100)
+        res1 = client.get(url)
+        assert res1.status_code == 200
+        res2 = client.get(url)
+        assert res2.status_code == 200
+        assert res2.headers.get('X-Cache') == 'HIT'
+        assert res2.data == res1.data
+        userid = random.choice(get_users(db_conn())[1])['userid']
+        new_comment(db_conn(), {'userid': userid, 'parentid': post['entityid'], 'text': g.text.text(quantity=1)})
+        res3 = client.get(url)
+        assert res3.status_code == 200
+        assert res3.headers.get('X-Cache') == 'MISS'
+        assert res3.json['total'] == res1.json['total'] + 1
+
+
 @flaky(max_runs=10, min_passes=1)
 def test_get_descendants(app, client):
     with app.app_context():
@@ -111,3 +149,138 @@ def test_get_descendants(app, client):
         assert res.status_code == 200
         assert res.json is not None
         assert len(res.json) >= 1
+
+
+def test_get_descendants_export_cache(app, client):
+    with app.app_context():
+        post = random.choice(get_posts(db_conn())[1])
+        url = url_for('posts.get_descendants', post_id=post['postid'], fmt='xml')
+        res1 = client.get(url)
+        assert res1.status_code == 200
+        data = res1.data
+        res2 = client.get(url)
+        assert res2.status_code == 200
+        assert int(res2.headers['Content-Length']) == len(data)
+        assert res2.data == data
+        res3 = client.get(url, headers={'Range': 'bytes=0-9'})
+        assert res3.status_code == 206
+        assert res3.data == data[:10]
+        userid = random.choice(get_users(db_conn())[1])['userid']
+        new_comment(db_conn(), {'userid': userid, 'parentid': post['entityid'], 'text': g.text.text(quantity=1)})
+        res4 = client.get(url)
+        assert res4.status_code == 200
+        assert 'Content-Length' not in res4.headers
+        assert res4.data != data
+
+
+def test_get_descendants_compressed(app, client):
+    with app.app_context():
+        post = random.choice(get_posts(db_conn())[1])
+        url = url_for('posts.get_descendants', post_id=post['postid'])
+        plain = client.get(url)
+        assert 'Content-Encoding' not in plain.headers
+        res = client.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert res.status_code == 200
+        assert res.headers['Content-Encoding'] == 'gzip'
+        assert res.headers['Vary'] == 'Accept-Encoding'
+        assert gzip.decompress(res.data) == plain.data
+        res = client.get(url_for('posts.get_descendants', post_id=post['postid'], fmt='json.gz'))
+        assert res.status_code == 200
+        assert res.headers['Content-Type'] == 'application/gzip'
+        assert gzip.decompress(res.data) == plain.data
+
+
+def test_get_descendants_limited(app, client):
+    with app.app_context():
+        post = random.choice(get_posts(db_conn())[1])
+        res = client.get(url_for('posts.get_descendants', post_id=post['postid'], max_depth=2, per_parent_limit=1))
+        assert res.status_code == 200
+        assert all(rec['depth'] in [1, 2] and 'hidden_replies' in rec for rec in res.json)
+        assert len([rec for rec in res.json if rec['depth'] == 1]) <= 1
+        res = client.get(url_for('posts.get_descendants', post_id=post['postid'], max_depth=0))
+        assert res.status_code == 400
+        res = client.get(url_for('posts.get_descendants', post_id=post['postid'], fmt='csv', max_depth=2))
+        assert res.status_code == 400
+
+
+def test_get_descendants_fields(app, client):
+    with app.app_context():
+        post = random.choice(get_posts(db_conn())[1])
+        res = client.get(url_for('posts.get_descendants', post_id=post['postid'], fields='commentid,datetime'))
+        assert res.status_code == 200
+        assert all(sorted(rec) == ['commentid', 'datetime'] for rec in res.json)
+        res = client.get(url_for('posts.get_descendants', post_id=post['postid'], fmt='csv', fields='commentid,author'))
+        assert res.status_code == 200
+        assert res.data.decode('windows-1251').split('\r\n')[0] == 'commentid;author_userid;author_name'
+        res = client.get(url_for('posts.get_first_level_comments', post_id=post['postid'], fields='text'))
+        assert res.status_code == 200
+        assert all(list(rec) == ['text'] for rec in res.json['response'])
+        res = client.get(url_for('posts.get_descendants', post_id=post['postid'], fields='commentid,password'))
+        assert res.status_code == 400
+
+
+def test_get_thread(app, client):
+    with app.app_context():
+        post = random.choice(get_posts(db_conn())[1])
+        res = client.get(url_for('posts.get_thread', post_id=post['postid'], replies=1))
+        assert res.status_code == 200
+        assert 'total' in res.json
+        for rec in res.json['response']:
+            assert len(rec['replies']) <= 1
+            assert rec['replies_total'] >= len(rec['replies'])
+        res = client.get(url_for('posts.get_thread', post_id=post['postid'], replies=-1))
+        assert res.status_code == 400
+        res = client.get(url_for('posts.get_thread', post_id=-1))
+        assert res.status_code == 404
+
+
+def test_get_thread_cache(app, client):
+    with app.app_context():
+        userid = random.choice(get_users(db_conn())[1])['userid']
+        post = new_post(db_conn(), {'userid': userid, 'title': 'Обсуждение', 'text': 'Текст'})
+        first = new_comment(db_conn(), {'userid': userid, 'parentid': post['entityid'], 'text': 'Обсуждение'})
+        url = url_for('posts.get_thread', post_id=post['postid'], per_page=100, replies=100)
+        res1 = client.get(url)
+        assert res1.status_code == 200
+        etag = res1.headers.get('ETag')
+        assert etag
+        assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+        assert client.get(url).headers.get('X-Cache') == 'HIT'
+        assert client.get(url_for('posts.get_thread', post_id=post['postid'], per_page=100,
+                                  replies=1)).headers.get('X-Cache') == 'MISS'
+        new_comment(db_conn(), {'userid': userid, 'parentid': first[1], 'text': 'Ответ'})
+        res2 = client.get(url, headers={'If-None-Match': etag})
+        assert res2.status_code == 200
+        assert res2.headers.get('X-Cache') == 'MISS'
+        assert res2.json['response'][0]['replies_total'] == 1
+
+
+def test_get_list_ids(app, client):
+    with app.app_context():
+        posts = random.sample(get_posts(db_conn())[1], 2)
+        ids = '%d,0,%d' % (posts[0]['postid'], posts[1]['postid'])
+        res = client.get(url_for('posts.posts_list', ids=ids))
+        assert res.status_code == 200
+        assert [rec and rec['postid'] for rec in res.json['response']] == [posts[0]['postid'], None, posts[1]['postid']]
+        assert res.json['total'] == 2
+        assert res.json['errors'] == [{'error': 'Пост не найден', 'post_id': 0}]
+        assert client.get(url_for('posts.posts_list', ids='1,a')).status_code == 400
+        assert client.get(url_for('posts.posts_list', ids=','.join(['1'] * 501))).status_code == 400
+
+
+def test_get_stats(app, client):
+    with app.app_context():
+        post = random.choice(get_posts(db_conn())[1])
+        url = url_for('posts.get_stats', post_id=post['postid'], interval='week')
+        res1 = client.get(url)
+        assert res1.status_code == 200
+        assert client.get(url).headers.get('X-Cache') == 'HIT'
+        userid = random.choice(get_users(db_conn())[1])['userid']
+        first = new_comment(db_conn(), {'userid': userid, 'parentid': post['entityid'], 'text': 'Статистика'})
+        new_comment(db_conn(), {'userid': userid, 'parentid': first[1], 'text': 'Статистика'})
+        res2 = client.get(url)
+        assert res2.headers.get('X-Cache') == 'MISS'
+        assert res2.json['response']['total'] == res1.json['response']['total'] + 2
+        assert res2.json['response']['max_depth'] >= 2
+        assert client.get(url_for('posts.get_stats', post_id=post['postid'], interval='year')).status_code == 400
+        assert client.get(url_for('posts.get_stats', post_id=0)).status_code == 404
@@ -4,6 +4,7 @@ from elizabeth import Generic
 from flaky import flaky
 from flask import url_for
 
+from app.comments import new_comment, remove_comment
 from app.common import db_conn, to_json
 from app.types import User
 from app.users import get_users, get_user, new_user
@@ -117,3 +118,21 @@ def test_get_comments(app, client):
         assert res.status_code == 200
         assert res.json is not None
         assert len(res.json) >= 1
+
+
+def test_get_replies(app, client):
+    with app.app_context():
+        user, other = random.sample(get_users(db_conn())[1], 2)
+        data = {'userid': other['userid'], 'parentid': user['entityid'], 'text': 'Ответ'}
+        comment_id = new_comment(db_conn(), data)[0]
+        res = client.get(url_for('users.get_replies', user_id=user['userid'], per_page=1))
+        assert res.status_code == 200
+        assert [rec['commentid'] for rec in res.json['response']] == [comment_id]
+        assert res.json['unread'] >= 1
+        res = client.post(url_for('users.read_replies', user_id=user['userid']))
+        assert res.status_code == 200
+        assert res.json['unread'] == 0
+        assert client.get(url_for('users.get_replies', user_id=user['userid'], cursor='x')).status_code == 400
+        assert client.get(url_for('users.get_replies', user_id=0)).status_code == 404
+        assert client.post(url_for('users.read_replies', user_id=0)).status_code == 404
+        remove_comment(db_conn(), comment_id)
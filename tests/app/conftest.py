@@ -1,8 +1,16 @@
+import os
+
+import psycopg2
+import psycopg2.extensions
 import pytest
 
 from any_comment import create_app
+from app.authors import authors
 from app.common import db_conn, redis_conn
 
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                           'db_schema.sql')  # type: str
+
 
 @pytest.fixture(scope='session')
 def app():
@@ -22,3 +30,37 @@ def conn(app):
 def r_conn(app):
     with app.app_context():
         return redis_conn()
+
+
+# noinspection PyShadowingNames
+@pytest.fixture(scope='module')
+def scratch_db(app, request):
+    """
+    Временная база данных со схемой из ``db_schema.sql``, удаляемая по окончании тестов модуля: строка подключения и
+    соединение с ней.
+
+    Идентификаторы пользователей временной базы совпадают с идентификаторами общей, поэтому кэш имён процесса
+    очищается и до, и после тестов модуля.
+    """
+    name = 'any_comment_%s_%d' % (request.module.__name__.rpartition('.')[2], os.getpid())
+    admin = psycopg2.connect(app.config['DB_URI'])
+    admin.autocommit = True
+    cur = admin.cursor()
+    cur.execute("DROP DATABASE IF EXISTS " + name + ";")
+    cur.execute("CREATE DATABASE " + name + ";")
+    dsn = psycopg2.extensions.make_dsn(app.config['DB_URI'], dbname=name)
+    conn = None
+    authors.invalidate()
+    try:
+        conn = psycopg2.connect(dsn)
+        with open(SCHEMA_PATH, encoding='utf-8') as f:
+            conn.cursor().execute(f.read())
+        conn.commit()
+        yield dsn, conn
+    finally:
+        authors.invalidate()
+        if conn is not None:
+            conn.close()
+        cur.execute("DROP DATABASE IF EXISTS " + name + ";")
+        cur.close()
+        admin.close()
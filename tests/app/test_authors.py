@@ -0,0 +1,48 @@
+import random
+
+from app.authors import AuthorCache, USERS_KEY
+from app.comments import get_comment, new_comment, remove_comment
+from app.posts import get_posts
+from app.users import get_users, new_user, update_user
+
+
+def test_names(conn):
+    users = get_users(conn)[1]
+    cache = AuthorCache(size=len(users))
+    names = cache.names(conn, [x['userid'] for x in users] + [0], b'1')
+    assert names[0] is None
+    assert all(names[x['userid']] == x['name'] for x in users)
+    assert len(cache) == len(users)
+    assert 0 not in cache
+
+
+def test_size_limit(conn):
+    users = get_users(conn)[1][:3]
+    cache = AuthorCache(size=2)
+    for user in users:
+        cache.names(conn, [user['userid']], b'1')
+    assert len(cache) == 2
+    assert users[0]['userid'] not in cache
+    assert users[2]['userid'] in cache
+    assert cache.warm(conn, b'2') == 2
+
+
+def test_version(conn, r_conn):
+    user = new_user(conn, {'name': 'Автор'})
+    cache = AuthorCache()
+    version = r_conn.get(USERS_KEY) or b'0'
+    assert cache.names(conn, [user['userid']], version) == {user['userid']: 'Автор'}
+    update_user(conn, user['userid'], {'name': 'Автор 2'})
+    # Изменение в другом процессе не видно, пока не сменилась версия пользователей
+    assert cache.names(conn, [user['userid']], version) == {user['userid']: 'Автор'}
+    assert cache.names(conn, [user['userid']], r_conn.get(USERS_KEY)) == {user['userid']: 'Автор 2'}
+
+
+def test_comment_author(conn):
+    user = new_user(conn, {'name': 'Автор'})
+    post = random.choice(get_posts(conn)[1])
+    comment_id, _ = new_comment(conn, {'userid': user['userid'], 'parentid': post['entityid'], 'text': 'Текст'})
+    assert get_comment(conn, comment_id)['author'] == {'userid': user['userid'], 'name': 'Автор'}
+    update_user(conn, user['userid'], {'name': 'Автор 2'})
+    assert get_comment(conn, comment_id)['author'] == {'userid': user['userid'], 'name': 'Автор 2'}
+    remove_comment(conn, comment_id)
@@ -0,0 +1,31 @@
+import random
+
+from app.cache import bump_versions, entity_etag, resolve_entity, entity_key
+from app.posts import get_posts
+from app.types import ENTITY_TYPE
+
+
+def test_entity_etag(r_conn):
+    entity_id = random.randrange(1000000, 2000000)
+    etag = entity_etag(r_conn, entity_id, variant='/posts/1')
+    assert etag == entity_etag(r_conn, entity_id, variant='/posts/1')
+    assert etag != entity_etag(r_conn, entity_id, variant='/posts/1?page=2')
+    bump_versions(r_conn, [entity_id])
+    assert etag != entity_etag(r_conn, entity_id, variant='/posts/1')
+
+
+def test_entity_etag_users(r_conn):
+    entity_id = random.randrange(1000000, 2000000)
+    plain = entity_etag(r_conn, entity_id)
+    with_users = entity_etag(r_conn, entity_id, users=True)
+    bump_versions(r_conn, [], users=True)
+    assert entity_etag(r_conn, entity_id) == plain
+    assert entity_etag(r_conn, entity_id, users=True) != with_users
+
+
+def test_resolve_entity(conn, r_conn):
+    post = random.choice(get_posts(conn)[1])
+    r_conn.delete(entity_key(ENTITY_TYPE.post, post['postid']))
+    assert resolve_entity(r_conn, conn, ENTITY_TYPE.post, post['postid']) == post['entityid']
+    assert int(r_conn.get(entity_key(ENTITY_TYPE.post, post['postid']))) == post['entityid']
+    assert resolve_entity(r_conn, conn, ENTITY_TYPE.post, -1) is None
@@ -5,7 +5,9 @@ from dateutil.tz import tzlocal
 from elizabeth import Generic
 from flaky import flaky
 
-from app.comments import get_comments, get_comment, new_comment, remove_comment, update_comment, descendants
+from app.comments import get_comments, get_comment, new_comment, remove_comment, update_comment, descendants, \
+    history, history_stream, get_comments_by_ids, search
+from app.common import entity_ancestors
 from app.users import get_users
 
 g = Generic('ru')
@@ -61,6 +63,16 @@ def test_get_comment_error(conn):
     assert comment is None
 
 
+def test_get_comments_by_ids(conn):
+    comments = random.sample(get_comments(conn)[1], 2)
+    ids = [comments[1]['commentid'], 0, comments[0]['commentid']]
+    records = get_comments_by_ids(conn, ids)
+    assert records[1] is None
+    assert records[0] == get_comment(conn, ids[0])
+    assert records[2] == get_comment(conn, ids[2])
+    assert get_comments_by_ids(conn, []) == []
+
+
 def test_new_comment(conn, r_conn):
     userid = random.choice(get_users(conn)[1])['userid']
     parentid = random.choice(get_comments(conn)[1])['entityid']
@@ -139,3 +151,83 @@ def test_descendants(conn):
         if i > 10:
             break
     assert i > 0
+
+
+def test_entity_ancestors(conn):
+    comment = random.choice(get_comments(conn)[1])
+    ancestors = entity_ancestors(conn, comment['entityid'])
+    assert ancestors[0] == comment['entityid']
+    assert ancestors[1] == comment['parentid']
+    assert len(ancestors) == len(set(ancestors))
+    assert len(entity_ancestors(conn, comment['entityid'], limit=1)) == 1
+
+
+def test_update_comment_noop(conn, r_conn):
+    userid = random.choice(get_users(conn)[1])['userid']
+    parentid = random.choice(get_comments(conn)[1])['entityid']
+    text = g.text.text(quantity=random.randrange(1, 3))
+    comment_id = new_comment(conn, {'userid': userid, 'parentid': parentid, 'text': text}, r_conn)[0]
+    assert update_comment(conn, comment_id, {}, r_conn) == 0
+    assert update_comment(conn, comment_id, {'text': text, 'userid': userid}, r_conn) == 0
+    assert update_comment(conn, 0, {'text': text}, r_conn) == 0
+    remove_comment(conn, comment_id, r_conn)
+    assert update_comment(conn, comment_id, {'text': text + '!'}, r_conn) == 0
+
+
+def test_remove_branch_comment(conn, r_conn):
+    userid = random.choice(get_users(conn)[1])['userid']
+    parentid = random.choice(get_comments(conn)[1])['entityid']
+    text = g.text.text(quantity=random.randrange(1, 3))
+    (comment1_id, entity1_id) = new_comment(conn, {'userid': userid, 'parentid': parentid, 'text': text}, r_conn)
+    comment2_id = new_comment(conn, {'userid': userid, 'parentid': entity1_id, 'text': text}, r_conn)[0]
+    assert remove_comment(conn, comment1_id, r_conn) is None
+    assert get_comment(conn, comment1_id)['deleted'] is False
+    assert remove_comment(conn, comment2_id, r_conn) == 1
+    assert remove_comment(conn, comment2_id, r_conn) == 0
+    assert remove_comment(conn, comment1_id, r_conn) == 1
+
+
+def test_history(conn, r_conn):
+    userid = random.choice(get_users(conn)[1])['userid']
+    parentid = random.choice(get_comments(conn)[1])['entityid']
+    text1 = g.text.text(quantity=1)
+    text2 = text1 + ' 2'
+    comment_id = new_comment(conn, {'userid': userid, 'parentid': parentid, 'text': text1}, r_conn)[0]
+    assert update_comment(conn, comment_id, {'text': text2}, r_conn) == 1
+    total, versions = history(conn, comment_id)
+    assert total == 2
+    assert [v['text'] for v in versions] == [text2, text1]
+    assert versions[0]['version_id'] is None
+    assert versions[1]['changed_by']['userid'] == userid
+    assert history(conn, comment_id, offset=1, limit=1)[1][0]['text'] == text1
+    assert [v['text'] for v in history_stream(conn, comment_id)] == [text2, text1]
+    remove_comment(conn, comment_id, r_conn)
+    assert history(conn, 0) == (0, [])
+
+
+def test_search(conn, r_conn):
+    userid = random.choice(get_users(conn)[1])['userid']
+    parentid = random.choice(get_comments(conn)[1])['entityid']
+    word = 'квазислово%d' % random.randrange(10 ** 9)
+    (root_id, root_entity_id) = new_comment(conn, {'userid': userid, 'parentid': parentid, 'text': word}, r_conn)
+    ids = [new_comment(conn, {'userid': userid, 'parentid': root_entity_id, 'text': text}, r_conn)[0]
+           for text in [word + ' ' + word, word + ' и прочее', 'без него']]
+
+    records, cursor = search(conn, word, entity_id=root_entity_id)
+    assert [rec['commentid'] for rec in records] == ids[:2]
+    assert records[0]['rank'] >= records[1]['rank']
+    assert records[0]['author']['userid'] == userid
+    assert cursor is None
+
+    records, cursor = search(conn, word, user_id=userid, limit=2)
+    assert len(records) == 2 and cursor is not None
+    rest, cursor = search(conn, word, user_id=userid, cursor=cursor, limit=2)
+    assert sorted(rec['commentid'] for rec in records + rest) == sorted([root_id] + ids[:2])
+    assert cursor is None
+    assert search(conn, word + ' -прочее', entity_id=root_entity_id)[0][0]['commentid'] == ids[0]
+
+    assert update_comment(conn, ids[2], {'text': word}, r_conn) == 1
+    remove_comment(conn, ids[0], r_conn)
+    assert sorted(rec['commentid'] for rec in search(conn, word, entity_id=root_entity_id)[0]) == ids[1:]
+    for comment_id in ids[1:] + [root_id]:
+        remove_comment(conn, comment_id, r_conn)
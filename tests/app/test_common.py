@@ -1,10 +1,15 @@
 import datetime
+import gzip
 import random
+import zlib
 
+import pytest
 from flaky import flaky
 
+from app.authors import USERS_KEY
 from app.comments import first_level_comments as comments_first_level_comments
-from app.common import entity_descendants
+from app.common import entity_descendants, entity_thread, compress_stream, AttachmentManager, buffered, FLUSH, \
+    comment_columns, comment_csv_columns, entity_first_level_comments, redis_conn, users_version
 from app.posts import get_posts, first_level_comments as post_first_level_comments
 from app.users import get_users
 
@@ -74,3 +79,120 @@ def test_entity_descendants(conn):
         if i > 10:
             break
     assert i != 0
+
+
+def test_entity_descendants_limited(conn):
+    post = random.choice(get_posts(conn)[1])
+    full = list(entity_descendants(conn, post['entityid']))
+    children = {}
+    for rec in full:
+        children.setdefault(rec['parentid'], []).append(rec)
+
+    limited = list(entity_descendants(conn, post['entityid'], max_depth=2, per_parent_limit=2))
+    assert {rec['entityid'] for rec in limited} <= {rec['entityid'] for rec in full}
+    assert all(rec['depth'] in [1, 2] for rec in limited)
+    assert len([rec for rec in limited if rec['depth'] == 1]) == min(len(children.get(post['entityid'], [])), 2)
+    for rec in limited:
+        replies = len(children.get(rec['entityid'], []))
+        shown = len([x for x in limited if x['parentid'] == rec['entityid']])
+        assert shown <= 2
+        assert rec['hidden_replies'] == replies - shown
+
+    assert [rec['entityid'] for rec in entity_descendants(conn, post['entityid'], max_depth=1000)] == \
+           [rec['entityid'] for rec in full]
+
+
+def test_entity_descendants_fields(conn):
+    post = random.choice(get_posts(conn)[1])
+    full = list(entity_descendants(conn, post['entityid']))
+    narrow = list(entity_descendants(conn, post['entityid'], fields=['commentid', 'datetime']))
+    assert [list(rec) for rec in narrow[:1]] in [[], [['commentid', 'datetime']]]
+    assert narrow == [{'commentid': rec['commentid'], 'datetime': rec['datetime']} for rec in full]
+
+    total, first_level = entity_first_level_comments(conn, post['entityid'], limit=5, fields=['entityid', 'author'])
+    for rec in first_level:
+        assert list(rec) == ['entityid', 'author']
+        assert list(rec['author']) == ['userid', 'name']
+
+
+def test_comment_columns():
+    assert comment_columns(None) == 'C.entityid, C.commentid, C.datetime, C.parentid, C.text, C.deleted, C.userid'
+    assert comment_columns(['datetime', 'commentid']) == 'C.datetime, C.commentid'
+    assert comment_columns(['commentid', 'author'], 'X') == 'X.commentid, X.userid'
+    assert comment_columns(['commentid'], extra=['C.depth']) == 'C.commentid, C.depth'
+    assert comment_csv_columns(['commentid', 'author']) == ['commentid', 'author_userid', 'author_name']
+
+
+def test_attachment_csv_columns():
+    formatter = AttachmentManager('csv', ['commentid', 'deleted'])
+    assert list(formatter.iterate(iter([]))) == [b'commentid;deleted\r\n']
+    data = gzip.decompress(b''.join(AttachmentManager('csv.gz', ['commentid']).iterate(iter([{'commentid': 5}]))))
+    assert data == b'commentid\r\n5\r\n'
+
+
+def test_entity_thread(conn):
+    post = random.choice(get_posts(conn)[1])
+    total, first_level = post_first_level_comments(conn, post['postid'], limit=5)
+    total2, records = entity_thread(conn, post['entityid'], 0, 5, 2)
+    assert total2 == total
+    assert [rec['entityid'] for rec in records] == [rec['entityid'] for rec in first_level]
+    for rec in records:
+        replies_total, replies = comments_first_level_comments(conn, rec['commentid'], limit=2)
+        assert rec['replies_total'] == replies_total
+        assert [x['entityid'] for x in rec['replies']] == [x['entityid'] for x in replies]
+        assert all('author' in x for x in rec['replies'])
+    assert entity_thread(conn, post['entityid'], total, 5) == (total, [])
+
+
+def test_compress_stream():
+    chunks = ['[\n', '{"a": 1}\n', ',\n{"a": 2}\n', ']\n']
+    gz = list(compress_stream(iter(chunks), 'gzip'))
+    assert gzip.decompress(b''.join(gz)).decode('utf-8') == ''.join(chunks)
+    # Каждый фрагмент распаковывается сразу, не дожидаясь конца потока
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert d.decompress(gz[0]) == b'[\n'
+    deflated = b''.join(compress_stream(iter(chunks), 'deflate'))
+    assert zlib.decompress(deflated).decode('utf-8') == ''.join(chunks)
+
+
+def test_attachment_gz():
+    formatter = AttachmentManager('json.gz')
+    assert formatter.compressed
+    assert formatter.content_type == 'application/gzip'
+    data = gzip.decompress(b''.join(formatter.iterate(iter([]))))
+    assert data == b'[\n]\n'
+    assert not AttachmentManager('json').compressed
+
+
+def test_attachment_unknown_format():
+    with pytest.raises(ValueError):
+        AttachmentManager('pdf')
+
+
+def test_buffered():
+    assert list(buffered(iter(['ab', b'cd', 'ef']), size=4, latency=60)) == [b'abcd', b'ef']
+    assert list(buffered(iter(['ab', FLUSH, 'cd']), size=1024, latency=60)) == [b'ab', b'cd']
+    assert list(buffered(iter(['ab', FLUSH, 'cd']), size=0)) == [b'ab', b'cd']
+    assert list(buffered(iter(['ab', 'cd']), size=1024, latency=0)) == [b'ab', b'cd']
+    assert list(buffered(iter([]))) == []
+
+
+def test_redis_conn_pool(app):
+    with app.app_context():
+        assert redis_conn().connection_pool is redis_conn().connection_pool
+
+
+def test_users_version(app):
+    with app.test_request_context():
+        version = users_version()
+        assert version is not None
+        redis_conn().incr(USERS_KEY)
+        assert users_version() == version
+    with app.test_request_context():
+        assert users_version() != version
+    app.config['REDIS_URI'], uri = 'redis://localhost:1/0', app.config['REDIS_URI']
+    try:
+        with app.test_request_context():
+            assert users_version() is None
+    finally:
+        app.config['REDIS_URI'] = uri
@@ -0,0 +1,102 @@
+import json
+import random
+import time
+
+from app.events import EventCoalescer, event_message, SubscriberQueue, OVERFLOW_DROP_OLDEST, OVERFLOW_RESYNC, \
+    OVERFLOW_DISCONNECT, stats, publish_event, subtree_channel, first_level_channel
+
+
+def listen(pub_sub, timeout: float = 1.0):
+    messages = []
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        message = pub_sub.get_message(timeout=0.05)
+        if message and message['type'] == 'message':
+            messages.append(json.loads(message['data'].decode('utf-8')))
+    return messages
+
+
+def test_event_message():
+    message = event_message('update_comment', 1, 2, record={'text': 'a'}, old_record={'text': 'b'})
+    assert message['action'] == 'update_comment'
+    assert message['record'] == {'text': 'a'}
+    assert message['old_record'] == {'text': 'b'}
+    assert 'now' in message
+
+
+def test_coalescer_batch(r_conn):
+    channel = 'test_coalescer:%d' % random.randrange(1, 1000000)
+    pub_sub = r_conn.pubsub()
+    pub_sub.subscribe(channel)
+    coalescer = EventCoalescer(window=0.2, max_events=100)
+    for i in range(5):
+        coalescer.publish(r_conn, channel, {'action': 'new_comment', 'record': {'comment_id': i}})
+    messages = listen(pub_sub)
+    pub_sub.close()
+    assert len(messages) == 1
+    assert messages[0]['action'] == 'batch'
+    assert [e['record']['comment_id'] for e in messages[0]['events']] == list(range(5))
+
+
+def test_coalescer_max_events(r_conn):
+    channel = 'test_coalescer:%d' % random.randrange(1, 1000000)
+    pub_sub = r_conn.pubsub()
+    pub_sub.subscribe(channel)
+    coalescer = EventCoalescer(window=10, max_events=3)
+    for i in range(7):
+        coalescer.publish(r_conn, channel, {'action': 'new_comment', 'record': {'comment_id': i}})
+    coalescer.flush_all()
+    messages = listen(pub_sub)
+    pub_sub.close()
+    assert [m['action'] for m in messages] == ['batch', 'batch', 'new_comment']
+    assert len(messages[0]['events']) == 3
+    assert messages[2]['record']['comment_id'] == 6
+
+
+def test_subscriber_queue_drop_oldest():
+    queue = SubscriberQueue(3, OVERFLOW_DROP_OLDEST)
+    for i in range(5):
+        assert queue.put(str(i))
+    assert len(queue) == 3
+    assert queue.dropped == 2
+    assert [queue.get(0) for _ in range(3)] == ['2', '3', '4']
+    assert queue.get(0) is None
+
+
+def test_subscriber_queue_resync():
+    queue = SubscriberQueue(3, OVERFLOW_RESYNC)
+    for i in range(4):
+        assert queue.put(str(i))
+    assert len(queue) == 1
+    assert json.loads(queue.get(0))['action'] == 'resync'
+    assert queue.put('5')
+    assert queue.get(0) == '5'
+
+
+def test_subscriber_queue_disconnect():
+    queue = SubscriberQueue(2, OVERFLOW_DISCONNECT)
+    assert queue.put('1')
+    assert queue.put('2')
+    assert not queue.put('3')
+    assert queue.closed
+    assert queue.get(0) is None
+
+
+def test_stream_stats():
+    queue = SubscriberQueue(10)
+    queue.put('1')
+    queue.put('2')
+    data = stats.dict()
+    assert data['subscribers'] >= 1
+    assert data['queue_depth_max'] >= 2
+
+
+def test_publish_event_subtree(r_conn):
+    parent_id = random.randrange(1000000, 2000000)
+    pub_sub = r_conn.pubsub()
+    pub_sub.subscribe(subtree_channel(parent_id + 1), first_level_channel(parent_id))
+    publish_event(r_conn, parent_id, {'action': 'new_comment'}, ancestors=[parent_id, parent_id + 1])
+    messages = listen(pub_sub)
+    pub_sub.close()
+    assert len(messages) == 2
+    assert {m.get('parent_id') for m in messages} == {None, parent_id}
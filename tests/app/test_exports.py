@@ -0,0 +1,32 @@
+import datetime
+import os
+
+from app.exports import tee_to_file, export_prefix
+
+
+def test_export_prefix():
+    after = datetime.datetime(2017, 6, 1)
+    assert export_prefix(1, 'csv', None, None) != export_prefix(1, 'csv', after, None)
+    assert export_prefix(1, 'csv', after, None) == export_prefix(1, 'csv', after, None)
+    assert export_prefix(1, 'csv', None, None).startswith('descendants_1_csv_')
+
+
+def test_tee_to_file(tmpdir):
+    prefix = str(tmpdir.join(export_prefix(1, 'xml', None, None)))
+    old_path = prefix + 'aaaa.xml'
+    with open(old_path, 'w') as f:
+        f.write('old')
+    path = prefix + 'bbbb.xml'
+    assert list(tee_to_file(iter(['<a>', b'</a>']), path)) == ['<a>', b'</a>']
+    with open(path, 'rb') as f:
+        assert f.read() == b'<a></a>'
+    assert not os.path.exists(old_path)
+    assert os.listdir(str(tmpdir)) == [os.path.basename(path)]
+
+
+def test_tee_to_file_interrupted(tmpdir):
+    path = str(tmpdir.join(export_prefix(1, 'csv', None, None) + 'cccc.csv'))
+    it = tee_to_file(iter(['a', 'b', 'c']), path)
+    assert next(it) == 'a'
+    it.close()
+    assert os.listdir(str(tmpdir)) == []
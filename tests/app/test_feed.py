@@ -0,0 +1,42 @@
+import datetime
+import random
+
+from dateutil.tz import tzlocal
+
+from app.comments import new_comment, remove_comment
+from app.feed import feed, merge, feed_cursor, parse_feed_cursor
+from app.posts import get_posts
+from app.users import get_users
+
+
+def _rec(comment_id, minutes):
+    return {'commentid': comment_id, 'datetime': datetime.datetime(2017, 6, 23, 12, minutes, tzinfo=tzlocal())}
+
+
+def test_merge():
+    sources = [[_rec(5, 50), _rec(3, 30), _rec(1, 10)], [_rec(4, 40), _rec(3, 30), _rec(2, 20)], []]
+    assert [rec['commentid'] for rec in merge(sources)] == [5, 4, 3, 2, 1]
+
+
+def test_cursor():
+    rec = _rec(7, 15)
+    rec['datetime'] = rec['datetime'].replace(microsecond=123456)
+    assert parse_feed_cursor(feed_cursor(rec)) == (rec['datetime'], 7)
+
+
+def test_feed(conn, r_conn):
+    user1, user2 = random.sample(get_users(conn)[1], 2)
+    post = random.choice(get_posts(conn)[1])
+    ids = [new_comment(conn, {'userid': userid, 'parentid': post['entityid'], 'text': 'Лента'}, r_conn)[0]
+           for userid in [user1['userid'], user2['userid'], user1['userid']]]
+    records, cursor = feed(conn, [user1['userid'], user2['userid']], [post['postid']], limit=3)
+    assert [rec['commentid'] for rec in records] == ids[::-1]
+    assert records[0]['author']['userid'] == user1['userid']
+    assert cursor is not None
+    rest = feed(conn, [user1['userid'], user2['userid']], [post['postid']], cursor=cursor, limit=3)[0]
+    assert all(rec['datetime'] <= records[-1]['datetime'] and rec['commentid'] not in ids for rec in rest)
+    after = datetime.datetime.now(tz=tzlocal()) - datetime.timedelta(minutes=1)
+    records = feed(conn, [user2['userid']], after=after)[0]
+    assert [rec['commentid'] for rec in records] == [ids[1]]
+    for comment_id in ids:
+        remove_comment(conn, comment_id, r_conn)
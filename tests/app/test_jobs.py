@@ -0,0 +1,49 @@
+import os
+import random
+
+from app.jobs import submit_job, get_job, run_job, QUEUE_KEY, STATUS_QUEUED, STATUS_DONE, STATUS_FAILED
+from app.posts import get_posts
+from app.types import ENTITY_TYPE
+
+
+def _submit(app, conn, r_conn, fmt='xml'):
+    post = random.choice(get_posts(conn)[1])
+    with app.app_context():
+        job = submit_job(r_conn, conn, ENTITY_TYPE.post, post['postid'], fmt)
+    # Задачу выполняет сам тест, а не запущенный обработчик
+    r_conn.lrem(QUEUE_KEY, 0, job['job_id'])
+    return post, job
+
+
+def test_submit_job(app, conn, r_conn):
+    post, job = _submit(app, conn, r_conn)
+    assert job['status'] in [STATUS_QUEUED, STATUS_DONE]
+    assert job['object_id'] == post['postid']
+    assert job['entity_id'] == post['entityid']
+    assert job['filename'] == 'post%d_descendants.xml' % post['postid']
+    assert get_job(r_conn, job['job_id']) == job
+    with app.app_context():
+        assert submit_job(r_conn, conn, ENTITY_TYPE.post, -1, 'xml') is None
+    assert get_job(r_conn, 'unknown') is None
+
+
+def test_run_job(app, conn, r_conn):
+    post, job = _submit(app, conn, r_conn)
+    with app.app_context():
+        done = run_job(r_conn, conn, job['job_id'])
+    assert done['status'] == STATUS_DONE
+    assert os.path.exists(done['path'])
+    with open(done['path'], encoding='utf-8') as f:
+        assert f.read().startswith('<?xml')
+    with app.app_context():
+        again = submit_job(r_conn, conn, ENTITY_TYPE.post, post['postid'], 'xml')
+    assert again['status'] == STATUS_DONE
+    assert again['path'] == done['path']
+
+
+def test_run_job_failed(app, conn, r_conn):
+    post, job = _submit(app, conn, r_conn, fmt='bad')
+    with app.app_context():
+        failed = run_job(r_conn, conn, job['job_id'])
+    assert failed['status'] == STATUS_FAILED
+    assert failed['error']
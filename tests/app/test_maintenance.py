@@ -0,0 +1,36 @@
+import datetime
+import os
+import time
+
+from app.maintenance import add_partitions, history_retention, history_compact, export_cache_sweep
+
+
+def test_add_partitions(conn):
+    names = add_partitions(conn, months_ahead=1)
+    assert len(names) == 4
+    assert 'comments_' + datetime.date.today().strftime('%Y_%m') in names
+    assert 'comments_history_' + datetime.date.today().strftime('%Y_%m') in names
+    assert add_partitions(conn, months_ahead=1) == names
+
+
+def test_history_retention(conn):
+    assert history_retention(conn, keep_months=1200) == []
+
+
+def test_history_compact(conn):
+    cnt = history_compact(conn, older_than_days=36500)
+    assert isinstance(cnt, int)
+    assert cnt >= 0
+
+
+def test_export_cache_sweep(tmpdir):
+    now = time.time()
+    for name, age, size in [('old.json', 7200, 10), ('a.json', 300, 100), ('b.json', 200, 100), ('c.json', 100, 100),
+                            ('d.json.abc.part', 50, 100)]:
+        path = os.path.join(str(tmpdir), name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        os.utime(path, (now - age, now - age))
+    assert export_cache_sweep(str(tmpdir), 3600, 250) == ['old.json', 'a.json', 'b.json']
+    assert sorted(os.listdir(str(tmpdir))) == ['c.json', 'd.json.abc.part']
+    assert export_cache_sweep(None, 3600, 250) == []
@@ -0,0 +1,133 @@
+import json
+
+import pytest
+from psycopg2.extras import execute_values
+
+from app.migrations import available, applied, migrate, split_statements, _execute_batched
+
+USERS = 200  # type: int
+POSTS = 5000  # type: int
+COMMENTS = 20000  # type: int
+RARE = 5  # type: int
+
+
+# noinspection PyShadowingNames
+@pytest.fixture(scope='module')
+def indexed(scratch_db):
+    """
+    Выборка во временной базе, достаточная, чтобы планировщик сам выбирал индексы горячих запросов: на пользователя и
+    на пост приходится около сотни из десятков тысяч комментариев, большая часть входящих ответов прочитана, а редкое
+    слово встречается в нескольких комментариях.
+    """
+    conn = scratch_db[1]
+    cur = conn.cursor()
+    users = execute_values(cur, "INSERT INTO users (name) VALUES %s RETURNING userid;",
+                           [('Индекс %d' % i,) for i in range(USERS)], fetch=True)
+    user_ids = [rec[0] for rec in users]
+    posts = execute_values(cur, "INSERT INTO posts (userid, title, text) VALUES %s RETURNING entityid;",
+                           [(user_ids[i % USERS], 'Индекс', 'Текст') for i in range(POSTS)], fetch=True,
+                           page_size=POSTS)
+    parents = [rec[0] for rec in posts[:COMMENTS // 100]]
+    comments = execute_values(cur, "INSERT INTO comments (userid, parentid, text, deleted) VALUES %s "
+                                   "RETURNING commentid, datetime;",
+                              [(user_ids[i % USERS], parents[i % len(parents)],
+                                i < RARE and 'Редкостное слово' or 'Обычный комментарий', i % 7 == 0)
+                               for i in range(COMMENTS)], fetch=True, page_size=COMMENTS)
+    execute_values(cur, "INSERT INTO replies_inbox (userid, commentid, datetime, parentid, read) VALUES %s;",
+                   [(user_ids[i % USERS], rec[0], rec[1], parents[0], i % 19 != 0) for i, rec in enumerate(comments)],
+                   page_size=COMMENTS)
+    conn.commit()
+    cur.execute("ANALYZE users; ANALYZE posts; ANALYZE comments; ANALYZE replies_inbox;")
+    conn.commit()
+    cur.close()
+    return conn, {'user_id': user_ids[0], 'parent_id': parents[0], 'post_entity_id': posts[-1][0]}
+
+
+def _plan_indexes(conn, query: str, params: list) -> set:
+    cur = conn.cursor()
+    cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+    plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    names = set()
+    nodes = [plan[0]['Plan']]
+    while nodes:
+        node = nodes.pop()
+        if 'Index Name' in node:
+            # Индексы секций приводятся к индексу секционированной таблицы
+            cur.execute("SELECT COALESCE((SELECT inhparent :: REGCLASS :: TEXT FROM pg_inherits "
+                        "                 WHERE inhrelid = %s :: REGCLASS), %s);", [node['Index Name']] * 2)
+            names.add(cur.fetchone()[0])
+        nodes.extend(node.get('Plans', []))
+    cur.close()
+    conn.commit()
+    return names
+
+
+def test_split_statements():
+    sql = "-- migrate: no-transaction\n" \
+          "-- комментарий; с точкой с запятой\n" \
+          "CREATE INDEX CONCURRENTLY a_index\n  ON a (x)\n  WHERE NOT deleted;\n" \
+          "DROP INDEX IF EXISTS b_index;\n"
+    assert split_statements(sql) == ["CREATE INDEX CONCURRENTLY a_index\n  ON a (x)\n  WHERE NOT deleted",
+                                     "DROP INDEX IF EXISTS b_index"]
+
+
+def test_execute_batched(conn):
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE batched (id INTEGER, value INTEGER);")
+    cur.execute("INSERT INTO batched (id) SELECT generate_series(1, 25);")
+    assert _execute_batched(conn, "UPDATE batched SET value = id\n  WHERE id >= %(lo)s AND id < %(hi)s "
+                                  "AND value IS NULL", batch_size=10) == 25
+    cur.execute("SELECT COUNT(*) FROM batched WHERE value IS NULL;")
+    assert cur.fetchone()[0] == 0
+    cur.close()
+    conn.rollback()
+
+
+def test_available():
+    migrations = available()
+    assert len(migrations) >= 1
+    assert [m.version for m in migrations] == sorted({m.version for m in migrations})
+    assert migrations[0].name == 'hot_path_indexes'
+    assert not migrations[0].transactional
+
+
+def test_migrate(conn):
+    migrate(conn)
+    assert {m.version for m in available()} <= applied(conn)
+    assert migrate(conn) == []
+
+
+def test_first_level_index(indexed):
+    conn, d = indexed
+    names = _plan_indexes(conn, "SELECT entityid, commentid FROM comments WHERE parentid = %s AND deleted = %s "
+                                "ORDER BY datetime ASC LIMIT 10;", [d['parent_id'], False])
+    assert 'comments_parentid_live_index' in names
+
+
+def test_user_comments_index(indexed):
+    conn, d = indexed
+    names = _plan_indexes(conn, "SELECT entityid FROM comments WHERE userid = %s ORDER BY datetime ASC;",
+                          [d['user_id']])
+    assert 'comments_userid_datetime_index' in names
+
+
+def test_search_index(indexed):
+    conn, d = indexed
+    names = _plan_indexes(conn, "SELECT commentid FROM comments "
+                                "WHERE text_tsv @@ websearch_to_tsquery('russian', %s) AND deleted = %s;",
+                          ['редкостное', False])
+    assert 'comments_text_tsv_index' in names
+
+
+def test_replies_inbox_indexes(indexed):
+    conn, d = indexed
+    names = _plan_indexes(conn, "SELECT commentid FROM replies_inbox WHERE userid = %s "
+                                "ORDER BY datetime DESC, commentid DESC LIMIT 10;", [d['user_id']])
+    assert 'replies_inbox_pkey' in names
+    names = _plan_indexes(conn, "SELECT COUNT(*) FROM replies_inbox WHERE userid = %s AND read = %s;",
+                          [d['user_id'], False])
+    assert 'replies_inbox_unread_index' in names
+    assert 'posts_entityid_index' in _plan_indexes(conn, "SELECT userid FROM posts WHERE entityid = %s;",
+                                                   [d['post_entity_id']])
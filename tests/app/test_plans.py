@@ -0,0 +1,294 @@
+"""
+Регрессия планов выполнения горячих запросов.
+
+На сгенерированной выборке вызываются все функции модулей, обращающиеся к базе данных. Каждое выполненное ими
+SQL-выражение перехватывается и прогоняется через ``EXPLAIN (FORMAT JSON)``; тест падает, если запрос читает
+последовательным сканированием таблицу приложения, в которой больше ``SEQ_SCAN_MIN_ROWS`` строк, либо оценка
+стоимости или количества строк выходит за бюджет запроса. Тела SQL-функций (например, ``comments_tree()``),
+скрытые в плане за узлом *Function Scan*, проверяются отдельно.
+
+Выборка создаётся во временной базе данных (фикстура ``scratch_db``), которая удаляется по окончании тестов модуля, —
+общая тестовая база не растёт и не влияет на другие тесты.
+"""
+import functools
+import inspect
+import json
+import random
+import re
+
+import psycopg2
+import psycopg2.extensions
+import pytest
+from psycopg2.extras import execute_values
+
+import app.authors
+import app.comments
+import app.common
+import app.feed
+import app.posts
+import app.users
+
+USERS = 50  # type: int
+POSTS = 50  # type: int
+LEVELS = 5  # type: int
+COMMENTS_PER_LEVEL = 2000  # type: int
+EDITS = 1000  # type: int
+
+SEQ_SCAN_MIN_ROWS = 1000  # type: int
+"""Таблицы меньшего размера дешевле читать целиком, последовательное сканирование для них не считается ошибкой."""
+
+DEFAULT_BUDGET = {'cost': 2000, 'rows': 1000}
+BUDGETS = {
+    # Выгрузки всего дерева и всех комментариев пользователя отдаются потоком и законно возвращают много строк
+    'common.entity_descendants': {'cost': 100000, 'rows': 100000},
+    'common.entity_stats': {'cost': 100000, 'rows': 100000},
+    'users.comments': {'cost': 20000, 'rows': 10000},
+    # Поиск в пределах поста ранжирует совпадения среди всего дерева comments_tree()
+    'comments.search': {'cost': 100000, 'rows': 100000},
+}
+
+ALLOWED_SEQ_SCANS = {
+    # Список всех комментариев без сортировки: последовательное чтение останавливается на LIMIT
+    'comments.get_comments': {'comments'},
+}
+"""Разрешённые последовательные сканирования: сценарий → таблицы (секции проверяются по имени родительской)."""
+
+MODULES = {'authors': app.authors, 'common': app.common, 'comments': app.comments, 'feed': app.feed,
+           'posts': app.posts, 'users': app.users}
+
+
+class _RecordingCursorMixin:
+    def execute(self, query, vars=None):
+        self.connection.statements.append(self.mogrify(query, vars).decode('utf-8'))
+        return super().execute(query, vars)
+
+
+@functools.lru_cache()
+def _recording(factory):
+    return type('Recording' + factory.__name__, (_RecordingCursorMixin, factory), {})
+
+
+class RecordingConnection(psycopg2.extensions.connection):
+    """Соединение, запоминающее все выполненные через него SQL-выражения."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements = []
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _recording(factory)
+        return super().cursor(*args, **kwargs)
+
+
+def split_sql(sql: str) -> list:
+    """Разбиение строки на выражения по точке с запятой вне строковых литералов."""
+    statements, current, quoted = [], [], False
+    for ch in sql:
+        if ch == "'":
+            quoted = not quoted
+        if ch == ';' and not quoted:
+            statements.append(''.join(current).strip())
+            current = []
+            continue
+        current.append(ch)
+    statements.append(''.join(current).strip())
+    return [s for s in statements if s]
+
+
+def _explain(cur, statement: str) -> dict:
+    cur.execute("EXPLAIN (FORMAT JSON, VERBOSE) " + statement)
+    plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+
+def _nodes(plan: dict):
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop()
+        yield node
+        nodes.extend(node.get('Plans', []))
+
+
+def _function_body(cur, call: str):
+    """Тело SQL-функции с подставленными значениями аргументов из вызова вида ``comments_tree(42)``."""
+    match = re.match(r'^(?:\w+\.)?(\w+)\((.*)\)$', call, re.DOTALL)
+    if match is None:
+        return None
+    cur.execute("SELECT P.prosrc, P.proargnames FROM pg_proc AS P JOIN pg_language AS L ON L.oid = P.prolang "
+                "WHERE P.proname = %s AND L.lanname = 'sql';", [match.group(1)])
+    rec = cur.fetchone()
+    if rec is None:
+        return None
+    body, names = rec[0], rec[1] or []
+    args = [a.strip() for a in match.group(2).split(',')]
+    for name, value in zip(names, args):
+        body = re.sub(r'\b%s\b' % re.escape(name), value, body)
+    return '\n'.join(line for line in body.splitlines() if not line.strip().startswith('--')).strip().rstrip(';')
+
+
+def _parent_table(cur, relation: str) -> str:
+    cur.execute("SELECT COALESCE((SELECT inhparent :: REGCLASS :: TEXT FROM pg_inherits "
+                "                 WHERE inhrelid = %s :: REGCLASS), %s);", [relation, relation])
+    return cur.fetchone()[0]
+
+
+def check_plan(conn, scenario: str, statement: str) -> list:
+    """
+    Проверка плана выражения.
+
+    :return: Список нарушений
+    :rtype: list
+    """
+    budget = BUDGETS.get(scenario, DEFAULT_BUDGET)
+    allowed = ALLOWED_SEQ_SCANS.get(scenario, set())
+    problems = []
+    cur = conn.cursor()
+    plans = [(statement, _explain(cur, statement))]
+    while plans:
+        sql, plan = plans.pop()
+        if plan['Total Cost'] > budget['cost']:
+            problems.append('cost %.0f > %d: %s' % (plan['Total Cost'], budget['cost'], sql))
+        if plan['Plan Rows'] > budget['rows']:
+            problems.append('rows %d > %d: %s' % (plan['Plan Rows'], budget['rows'], sql))
+        for node in _nodes(plan):
+            if node['Node Type'] == 'Seq Scan' and node.get('Schema') != 'pg_catalog':
+                cur.execute("SELECT reltuples FROM pg_class WHERE oid = %s :: REGCLASS;", [node['Relation Name']])
+                if cur.fetchone()[0] >= SEQ_SCAN_MIN_ROWS and \
+                        _parent_table(cur, node['Relation Name']) not in allowed:
+                    problems.append('Seq Scan on %s: %s' % (node['Relation Name'], sql))
+            if node['Node Type'] == 'Function Scan' and 'Function Call' in node:
+                body = _function_body(cur, node['Function Call'])
+                if body:
+                    plans.append((body, _explain(cur, body)))
+    cur.close()
+    conn.rollback()
+    return problems
+
+
+# noinspection PyShadowingNames
+@pytest.fixture(scope='module')
+def dataset(scratch_db):
+    conn = scratch_db[1]
+    cur = conn.cursor()
+    users = execute_values(cur, "INSERT INTO users (name) VALUES %s RETURNING userid, entityid;",
+                           [('План %d' % i,) for i in range(USERS)], fetch=True)
+    user_ids = [rec[0] for rec in users]
+    posts = execute_values(cur, "INSERT INTO posts (userid, title, text) VALUES %s RETURNING postid, entityid;",
+                           [(random.choice(user_ids), 'План', 'Текст') for _ in range(POSTS)], fetch=True)
+    parents = [rec[1] for rec in posts]
+    comments = []
+    for _ in range(LEVELS):
+        level = execute_values(cur, "INSERT INTO comments (userid, parentid, text) VALUES %s "
+                                    "RETURNING commentid, entityid, parentid;",
+                               [(random.choice(user_ids), random.choice(parents), 'Комментарий')
+                                for _ in range(COMMENTS_PER_LEVEL)], fetch=True, page_size=COMMENTS_PER_LEVEL)
+        comments.append(level)
+        parents = [rec[1] for rec in level]
+    cur.execute("UPDATE comments SET text = text || ' (правка)' WHERE commentid = ANY(%s);",
+                [[rec[0] for rec in random.sample(comments[0], EDITS)]])
+    conn.commit()
+    cur.execute("ANALYZE users; ANALYZE posts; ANALYZE comments; ANALYZE comments_history;")
+    conn.commit()
+    cur.close()
+    branch = comments[LEVELS - 2][0]
+    return {
+        'user_id': user_ids[0],
+        'user_entity_id': users[0][1],
+        'post_id': posts[0][0],
+        'post_entity_id': posts[0][1],
+        'comment_id': branch[0],
+        'comment_entity_id': branch[1],
+        'leaf_entity_id': comments[LEVELS - 1][0][1],
+    }
+
+
+def _new_leaf(conn, redis, d):
+    return app.comments.new_comment(conn, {'userid': d['user_id'], 'parentid': d['leaf_entity_id'],
+                                           'text': 'Лист'}, redis)
+
+
+SCENARIOS = {
+    'authors.fetch_names': lambda conn, redis, d: app.authors.fetch_names(conn, [d['user_id'], 0]),
+    'authors.fetch_names.all': lambda conn, redis, d: app.authors.fetch_names(conn, limit=1000),
+    'common.entity_first_level_comments':
+        lambda conn, redis, d: app.common.entity_first_level_comments(conn, d['post_entity_id']),
+    'common.entity_descendants': lambda conn, redis, d: list(app.common.entity_descendants(conn, d['post_entity_id'])),
+    'common.entity_descendants.limited': lambda conn, redis, d: list(app.common.entity_descendants(
+        conn, d['post_entity_id'], max_depth=3, per_parent_limit=5)),
+    'common.entity_descendants.fields': lambda conn, redis, d: list(app.common.entity_descendants(
+        conn, d['post_entity_id'], fields=['commentid', 'datetime'])),
+    'common.entity_stats': lambda conn, redis, d: app.common.entity_stats(conn, d['post_entity_id'], interval='hour'),
+    'common.entity_thread': lambda conn, redis, d: app.common.entity_thread(conn, d['post_entity_id'], 0, 10, 3),
+    'common.entity_ancestors': lambda conn, redis, d: app.common.entity_ancestors(conn, d['leaf_entity_id']),
+    'comments.get_comments': lambda conn, redis, d: app.comments.get_comments(conn, 1000, 100),
+    'comments.get_comment': lambda conn, redis, d: app.comments.get_comment(conn, d['comment_id']),
+    'comments.get_comments_by_ids': lambda conn, redis, d: app.comments.get_comments_by_ids(
+        conn, [d['comment_id'], d['comment_id'] + 1, 0]),
+    'comments.new_comment': _new_leaf,
+    'comments.update_comment': lambda conn, redis, d: app.comments.update_comment(
+        conn, _new_leaf(conn, redis, d)[0], {'text': 'Правка'}, redis),
+    'comments.remove_comment': lambda conn, redis, d: app.comments.remove_comment(
+        conn, _new_leaf(conn, redis, d)[0], redis),
+    'comments.search': lambda conn, redis, d: app.comments.search(conn, 'комментарий', d['post_entity_id']),
+    'comments.search.user': lambda conn, redis, d: app.comments.search(
+        conn, 'правка', user_id=d['user_id'], cursor='0.05:%d' % d['comment_id']),
+    'comments.history': lambda conn, redis, d: app.comments.history(conn, d['comment_id']),
+    'comments.history_stream': lambda conn, redis, d: list(app.comments.history_stream(conn, d['comment_id'])),
+    'feed.source_comments': lambda conn, redis, d: app.feed.source_comments(
+        conn, 'users', [d['user_id'], 0], cursor=app.feed.feed_cursor(app.comments.get_comment(conn, d['comment_id']))),
+    'feed.source_comments.posts': lambda conn, redis, d: app.feed.source_comments(conn, 'posts', [d['post_id'], 0]),
+    'posts.get_posts': lambda conn, redis, d: app.posts.get_posts(conn),
+    'posts.get_post': lambda conn, redis, d: app.posts.get_post(conn, d['post_id']),
+    'posts.get_posts_by_ids': lambda conn, redis, d: app.posts.get_posts_by_ids(conn, [d['post_id'], 0]),
+    'posts.new_post': lambda conn, redis, d: app.posts.new_post(
+        conn, {'userid': d['user_id'], 'title': 'План', 'text': 'Текст'}),
+    'posts.update_post': lambda conn, redis, d: app.posts.update_post(conn, d['post_id'], {'title': 'План'}),
+    'posts.remove_post': lambda conn, redis, d: app.posts.remove_post(conn, 0),
+    'users.get_users': lambda conn, redis, d: app.users.get_users(conn),
+    'users.get_user': lambda conn, redis, d: app.users.get_user(conn, d['user_id']),
+    'users.get_users_by_ids': lambda conn, redis, d: app.users.get_users_by_ids(conn, [d['user_id'], 0]),
+    'users.new_user': lambda conn, redis, d: app.users.new_user(conn, {'name': 'План'}),
+    'users.update_user': lambda conn, redis, d: app.users.update_user(conn, d['user_id'], {'name': 'План'}),
+    'users.remove_user': lambda conn, redis, d: app.users.remove_user(conn, 0),
+    'users.comments': lambda conn, redis, d: list(app.users.comments(conn, d['user_id'])),
+    'users.replies': lambda conn, redis, d: app.users.replies(conn, d['user_id'], '%d:%d' % (2 ** 60, 0)),
+    'users.mark_replies_read': lambda conn, redis, d: app.users.mark_replies_read(conn, d['user_id'], 0),
+    'users.edits': lambda conn, redis, d: list(app.users.edits(conn, d['user_id'])),
+}
+
+
+def test_scenarios_cover_all_queries():
+    missing = []
+    for short, module in MODULES.items():
+        for name, func in inspect.getmembers(module, inspect.isfunction):
+            if func.__module__ == module.__name__ and '.execute(' in inspect.getsource(func):
+                if '%s.%s' % (short, name) not in SCENARIOS:
+                    missing.append('%s.%s' % (short, name))
+    assert missing == []
+
+
+def test_split_sql():
+    assert split_sql("SET timezone = 'Europe/Moscow'; SELECT ';' FROM t;") == \
+           ["SET timezone = 'Europe/Moscow'", "SELECT ';' FROM t"]
+
+
+# noinspection PyShadowingNames
+@pytest.mark.parametrize('scenario', sorted(SCENARIOS))
+def test_query_plan(app, r_conn, scratch_db, dataset, scenario):
+    dsn, conn = scratch_db
+    plan_conn = psycopg2.connect(dsn, connection_factory=RecordingConnection)
+    try:
+        with app.app_context():
+            SCENARIOS[scenario](plan_conn, r_conn, dataset)
+        statements = [s for sql in plan_conn.statements for s in split_sql(sql)
+                      if re.match(r'^(SELECT|INSERT|UPDATE|DELETE|WITH)\b', s, re.IGNORECASE)]
+        assert statements, 'Сценарий не выполнил ни одного запроса'
+        problems = []
+        for statement in statements:
+            problems.extend(check_plan(conn, scenario, statement))
+        assert problems == []
+    finally:
+        plan_conn.close()
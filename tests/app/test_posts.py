@@ -3,7 +3,8 @@ import random
 from elizabeth import Generic
 from flaky import flaky
 
-from app.posts import get_posts, get_post, new_post, remove_post, update_post, descendant_comments
+from app.posts import get_posts, get_post, get_posts_by_ids, new_post, remove_post, update_post, descendant_comments, \
+    stats
 from app.users import get_users
 
 g = Generic('ru')
@@ -42,6 +43,13 @@ def test_get_post_error(conn):
     assert post is None
 
 
+def test_get_posts_by_ids(conn):
+    posts = random.sample(get_posts(conn)[1], 2)
+    ids = [posts[1]['postid'], 0, posts[0]['postid'], posts[1]['postid']]
+    assert get_posts_by_ids(conn, ids) == [posts[1], None, posts[0], posts[1]]
+    assert get_posts_by_ids(conn, []) == []
+
+
 def test_new_post(conn):
     userid = random.choice(get_users(conn)[1])['userid']
     title = g.text.text(quantity=1)
@@ -112,3 +120,17 @@ def test_descendants(conn):
         if i > 10:
             break
     assert i > 0
+
+
+def test_stats(conn):
+    post = random.choice(get_posts(conn)[1])
+    records = list(descendant_comments(conn, post['postid']))
+    res = stats(conn, post['postid'], interval='month')
+    assert res['total'] == len(records)
+    assert res['first_level'] == len([rec for rec in records if rec['parentid'] == post['entityid']])
+    assert res['participants'] == len({rec['author']['userid'] for rec in records})
+    assert sum(x['comments'] for x in res['activity']) == res['total']
+    assert (res['max_depth'] > 0) == (res['total'] > 0)
+    if records:
+        assert res['first_comment'] == min(rec['datetime'] for rec in records)
+    assert stats(conn, 0) is None
@@ -1,9 +1,13 @@
+import datetime
 import random
 
 from elizabeth import Generic
 from flaky import flaky
 
-from app.users import get_users, get_user, new_user, remove_user, update_user, descendant_comments, comments
+from app.comments import new_comment, remove_comment, update_comment
+from app.posts import new_post, remove_post, get_post
+from app.users import get_users, get_user, get_users_by_ids, new_user, remove_user, update_user, descendant_comments, \
+    comments, replies, mark_replies_read
 
 g = Generic('ru')
 
@@ -48,6 +52,13 @@ def test_get_user_error(conn):
     assert user is None
 
 
+def test_get_users_by_ids(conn):
+    users = random.sample(get_users(conn)[1], 2)
+    ids = [users[1]['userid'], 0, users[0]['userid']]
+    assert get_users_by_ids(conn, ids) == [users[1], None, users[0]]
+    assert get_users_by_ids(conn, []) == []
+
+
 def test_new_user(conn):
     name = g.personal.full_name(gender=random.choice(['male', 'female']))
     data = {'name': name}
@@ -130,3 +141,58 @@ def test_comments(conn):
         if i > 10:
             break
     assert i > 0
+
+
+def test_replies(conn, r_conn):
+    author = new_user(conn, {'name': g.personal.full_name()})
+    other = random.choice(get_users(conn)[1])
+    post_id = new_post(conn, {'userid': author['userid'], 'title': 'Ответы', 'text': 'Текст'})['postid']
+    post_entity_id = get_post(conn, post_id)['entityid']
+    own_id, own_entity_id = new_comment(conn, {'userid': author['userid'], 'parentid': post_entity_id,
+                                               'text': 'Свой'}, r_conn)
+    ids = [new_comment(conn, {'userid': other['userid'], 'parentid': parent, 'text': 'Ответ'}, r_conn)[0]
+           for parent in [post_entity_id, own_entity_id, author['entityid']]]
+
+    unread, records, cursor = replies(conn, author['userid'], limit=2)
+    assert unread == 3
+    assert [rec['commentid'] for rec in records] == ids[:0:-1]
+    assert records[0]['author']['userid'] == other['userid'] and records[0]['read'] is False
+    unread, records, cursor = replies(conn, author['userid'], cursor, limit=2)
+    assert [rec['commentid'] for rec in records] == ids[:1]
+    assert cursor is None
+
+    assert mark_replies_read(conn, author['userid'], ids[1]) == 1
+    remove_comment(conn, ids[2], r_conn)
+    unread, records, _ = replies(conn, author['userid'])
+    assert unread == 0
+    assert [rec['commentid'] for rec in records] == [ids[1], ids[0]]
+    assert replies(conn, 0) is None
+    for comment_id in ids[:2] + [own_id]:
+        remove_comment(conn, comment_id, r_conn)
+    remove_post(conn, post_id)
+
+
+def test_replies_follow_updates(conn, r_conn):
+    author = new_user(conn, {'name': g.personal.full_name()})
+    other = new_user(conn, {'name': g.personal.full_name()})
+    comment_id, _ = new_comment(conn, {'userid': other['userid'], 'parentid': author['entityid'],
+                                       'text': 'Ответ'}, r_conn)
+    assert replies(conn, author['userid'])[0] == 1
+
+    moved = datetime.datetime(2017, 1, 15, 12, 0, tzinfo=datetime.timezone.utc)
+    assert update_comment(conn, comment_id, {'datetime': moved}, r_conn) == 1
+    unread, records, _ = replies(conn, author['userid'])
+    assert unread == 1
+    assert [rec['commentid'] for rec in records] == [comment_id]
+
+    assert update_comment(conn, comment_id, {'parentid': other['entityid']}, r_conn) == 1
+    assert replies(conn, author['userid'])[:2] == (0, [])
+    assert replies(conn, other['userid'])[:2] == (0, [])
+
+    assert update_comment(conn, comment_id, {'userid': author['userid']}, r_conn) == 1
+    unread, records, _ = replies(conn, other['userid'])
+    assert unread == 1
+    assert [rec['commentid'] for rec in records] == [comment_id]
+
+    assert update_comment(conn, comment_id, {'deleted': True}, r_conn) == 1
+    assert replies(conn, other['userid'])[:2] == (0, [])
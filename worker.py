@@ -0,0 +1,25 @@
+import argparse
+
+from colorama import Fore, Style, init
+
+from any_comment import create_app
+from app.common import redis_conn
+from app.jobs import work
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Обработчик асинхронных выгрузок any-comment')
+    parser.add_argument('--once', action='store_true', help='Обработать накопившиеся задачи и завершиться')
+    parser.add_argument('--timeout', type=int, default=5, help='Время ожидания очередной задачи в секундах')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        print('Обработчик выгрузок запущен, каталог: ' + Fore.CYAN + app.config['EXPORT_CACHE_DIR'] + Style.RESET_ALL)
+        num = work(redis_conn(), args.timeout, args.once)
+        print('Обработано задач: ' + Fore.GREEN + str(num) + Style.RESET_ALL)
+
+
+if __name__ == '__main__':
+    init(autoreset=True)
+    main()